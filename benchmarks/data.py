@@ -0,0 +1,106 @@
+"""
+Synthetic SQLite databases and media trees for the benchmarks.
+The data is generated from a seed, so every run backs up the same bytes. It
+mixes text, which compresses, with random bytes, which does not, like a
+real database of text columns and a media directory of documents and
+images.
+"""
+import os
+import random
+import sqlite3
+
+MB = 1024 * 1024
+PARAGRAPH_SIZE = 16 * 1024
+PARAGRAPHS = 64
+WORDS = 2000
+
+
+def random_bytes(rng, size):
+    """ Return size random bytes from rng. """
+    if not size:
+        return ''
+    return ('%0*x' % (size * 2, rng.getrandbits(size * 8))).decode('hex')
+
+
+def paragraphs(rng):
+    """ Return PARAGRAPHS paragraphs of text, PARAGRAPH_SIZE bytes each. """
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    words = [''.join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(WORDS)]
+    result = []
+    for _ in range(PARAGRAPHS):
+        text = []
+        size = 0
+        while size < PARAGRAPH_SIZE:
+            word = rng.choice(words)
+            text.append(word)
+            size += len(word) + 1
+        result.append(' '.join(text)[:PARAGRAPH_SIZE])
+    return result
+
+
+def make_database(filepath, size, seed=0):
+    """ Create the SQLite database at filepath, of about size bytes. """
+    rng = random.Random(seed)
+    texts = paragraphs(rng)
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+    connection = sqlite3.connect(filepath)
+    try:
+        connection.execute("CREATE TABLE benchmark_row (id INTEGER PRIMARY KEY, name TEXT, "
+                           "body TEXT, amount REAL, payload BLOB)")
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        while connection.execute("PRAGMA page_count").fetchone()[0] * page_size < size:
+            rows = []
+            for _ in range(1000):
+                text = rng.choice(texts)
+                start = rng.randint(0, PARAGRAPH_SIZE - 1500)
+                rows.append((text[start:start + 40], text[start:start + rng.randint(200, 1500)],
+                             rng.random() * 1000, sqlite3.Binary(random_bytes(rng, 64))))
+            connection.executemany("INSERT INTO benchmark_row (name, body, amount, payload) "
+                                   "VALUES (?, ?, ?, ?)", rows)
+            connection.commit()
+    finally:
+        connection.close()
+
+
+def make_media(directory, size, files=500, seed=0):
+    """ Create a tree of about size bytes in files files under directory,
+    a quarter of them random bytes and the rest text.
+    """
+    rng = random.Random(seed)
+    texts = paragraphs(rng)
+    file_size = max(1, size // files)
+    for number in range(files):
+        subdirectory = os.path.join(directory, 'dir%02d' % (number % 16), 'sub%d' % (number % 3))
+        if not os.path.isdir(subdirectory):
+            os.makedirs(subdirectory)
+        length = rng.randint(file_size // 2, file_size * 3 // 2)
+        if number % 4 == 0:
+            name, chunks = 'image%04d.bin' % number, random_chunks(rng, length)
+        else:
+            name, chunks = 'document%04d.txt' % number, text_chunks(rng, texts, length)
+        with open(os.path.join(subdirectory, name), 'wb') as media_file:
+            for chunk in chunks:
+                media_file.write(chunk)
+
+
+def random_chunks(rng, length):
+    """ Yield length random bytes in chunks of at most 1 MB. """
+    while length > 0:
+        size = min(length, MB)
+        yield random_bytes(rng, size)
+        length -= size
+
+
+def text_chunks(rng, texts, length):
+    """ Yield length bytes of text made of random paragraphs. """
+    while length > 0:
+        text = rng.choice(texts)[:length]
+        yield text
+        length -= len(text)
+
+
+def tree_size(directory):
+    """ Return the total size of the files under directory. """
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names)
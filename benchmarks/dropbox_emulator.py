@@ -0,0 +1,160 @@
+"""
+Local stand-in for Dropbox.
+The Dropbox storage runs unchanged against an in-memory client standing in
+for DropboxClient, so the chunked upload sessions and the ranged downloads
+are measured without the network. Each request sleeps
+BENCHMARK_EMULATOR_LATENCY seconds, to see how the storage copes with round
+trips. The dropbox package must be installed, as the storage imports it.
+"""
+import itertools
+import posixpath
+import threading
+import time
+
+from django.conf import settings
+from dropbox.rest import ErrorResponse
+
+from dbbackup.storage import dropbox_storage
+
+LATENCY = getattr(settings, 'BENCHMARK_EMULATOR_LATENCY', 0)
+
+# The files by path, shared by every client of the process
+FILES = {}
+# The data of the upload sessions in progress by upload id
+SESSIONS = {}
+_files_lock = threading.Lock()
+_upload_ids = itertools.count(1)
+
+
+def request():
+    """ Account for one request to Dropbox. """
+    if LATENCY:
+        time.sleep(LATENCY)
+
+
+def store(path, data, overwrite):
+    """ Write data at path and return the path written. Like Dropbox, an
+    existing file is renamed "name (1).ext" unless overwrite is set. Call
+    with _files_lock held.
+    """
+    if not overwrite:
+        base, extension = posixpath.splitext(path)
+        number = 1
+        while path in FILES:
+            path = '%s (%d)%s' % (base, number, extension)
+            number += 1
+    FILES[path] = data
+    return path
+
+
+class NotFound(ErrorResponse):
+    """ The 404 error response of Dropbox. """
+
+    def __init__(self, path):
+        Exception.__init__(self, path)
+        self.status = 404
+        self.reason = 'Not Found'
+        self.body = {'error': 'Path not found: %s' % path}
+        self.error_msg = self.user_error_msg = self.body['error']
+        self.headers = []
+
+    def __str__(self):
+        return '[404] %s' % self.error_msg
+
+
+class Response:
+    """ Stand-in for the response of a file download. """
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class Client:
+    """ Stand-in for DropboxClient. """
+
+    def account_info(self):
+        request()
+        return {'display_name': 'dbbackup benchmark'}
+
+    def metadata(self, path):
+        request()
+        path = path.rstrip('/') or '/'
+        with _files_lock:
+            if path in FILES:
+                return self._file_metadata(path)
+            prefix = path.rstrip('/') + '/'
+            children = set()
+            for filepath in FILES:
+                if filepath.startswith(prefix):
+                    children.add(prefix + filepath[len(prefix):].split('/')[0])
+            if not children:
+                raise NotFound(path)
+            contents = [self._file_metadata(child) if child in FILES else
+                        {'path': child, 'is_dir': True, 'bytes': 0} for child in sorted(children)]
+        return {'path': path, 'is_dir': True, 'bytes': 0, 'contents': contents}
+
+    @staticmethod
+    def _file_metadata(path):
+        return {'path': path, 'is_dir': False, 'bytes': len(FILES[path])}
+
+    def file_delete(self, path):
+        request()
+        with _files_lock:
+            if FILES.pop(path, None) is None:
+                raise NotFound(path)
+
+    def file_move(self, from_path, to_path):
+        request()
+        with _files_lock:
+            if from_path not in FILES:
+                raise NotFound(from_path)
+            FILES[to_path] = FILES.pop(from_path)
+
+    def put_file(self, path, fileobj, overwrite=False, parent_rev=None):
+        request()
+        data = fileobj.read()
+        with _files_lock:
+            return self._file_metadata(store(path, data, overwrite))
+
+    def upload_chunk(self, fileobj, length, offset=0, upload_id=None):
+        request()
+        data = fileobj.read(length)
+        with _files_lock:
+            if upload_id is None:
+                upload_id = str(next(_upload_ids))
+                SESSIONS[upload_id] = []
+            chunks = SESSIONS[upload_id]
+            if offset == sum(len(chunk) for chunk in chunks):
+                chunks.append(data)
+            return sum(len(chunk) for chunk in chunks), upload_id
+
+    def commit_chunked_upload(self, path, upload_id, overwrite=False, parent_rev=None):
+        request()
+        with _files_lock:
+            return self._file_metadata(store(path, ''.join(SESSIONS.pop(upload_id)), overwrite))
+
+    def get_file(self, path, start=None, length=None):
+        request()
+        with _files_lock:
+            if path not in FILES:
+                raise NotFound(path)
+            data = FILES[path]
+        if start is not None:
+            data = data[start:start + length]
+        return Response(data)
+
+
+class Storage(dropbox_storage.Storage):
+    """ The Dropbox storage, connected to the emulator. """
+
+    def _check_settings(self):
+        pass
+
+    def get_dropbox_client(self):
+        return Client()
@@ -0,0 +1,361 @@
+"""
+Benchmark the backup and restore commands against local storages.
+
+    $ python benchmarks/run.py [--db-size <MB>] [--media-size <MB>] [--storage <name>,...] [--repeat <n>] [--output <file>] [--compare <file>]
+
+A synthetic SQLite database and media tree are generated from a seed, then
+dbbackup, dbrestore, backup_media and restore_media are run against each
+storage: filesystem, memory, and emulators standing in for S3 and Dropbox
+(see s3_emulator and dropbox_emulator). Each command runs in a process of
+its own, so its peak RSS is its own, and the stage timings come from the
+metrics of the run (see dbbackup.metrics). The results are written as JSON.
+"""
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(1, os.path.dirname(BENCHMARKS_DIR))
+
+import data
+
+MB = 1024 * 1024
+STORAGES = OrderedDict([
+    ('filesystem', 'dbbackup.storage.filesystem_storage'),
+    ('memory', 'dbbackup.storage.memory_storage'),
+    ('s3', 's3_emulator'),
+    ('dropbox', 'dropbox_emulator'),
+])
+COMMANDS = ('dbbackup', 'dbrestore', 'backup_media', 'restore_media')
+# The command run, unmeasured, before a restore so there is a backup to restore
+PREPARE = {'dbrestore': 'dbbackup', 'restore_media': 'backup_media'}
+MEDIA_COMMANDS = ('backup_media', 'restore_media')
+
+
+def get_option_parser():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n\n')[1].strip())
+    parser.add_option("--db-size", help="Size of the database in MB (default: 64)", type="int", default=64)
+    parser.add_option("--media-size", help="Size of the media files in MB (default: 64)", type="int", default=64)
+    parser.add_option("--media-files", help="Number of media files (default: 500)", type="int", default=500)
+    parser.add_option("--seed", help="Seed of the generated data (default: 0)", type="int", default=0)
+    parser.add_option("--storage", help="Storages to run against, comma separated (default: all)",
+                      default=','.join(STORAGES))
+    parser.add_option("--command", help="Commands to run, comma separated (default: all)",
+                      default=','.join(COMMANDS))
+    parser.add_option("--repeat", help="Runs of each command (default: 3)", type="int", default=3)
+    parser.add_option("--codec", help="Compression codec, or 'none' (default: gzip)", default='gzip')
+    parser.add_option("--stream", help="Pass --stream to dbbackup and dbrestore", action="store_true", default=False)
+    parser.add_option("--latency", help="Seconds each request to the emulators takes (default: 0)",
+                      type="float", default=0)
+    parser.add_option("--work-dir", help="Directory of the data and the backups (default: a temporary one)")
+    parser.add_option("--output", help="File to write the results to (default: standard output)")
+    parser.add_option("--compare", help="Results of a previous run to compare with")
+    parser.add_option("--max-regression", help="Exit with an error if the throughput of a command "
+                      "dropped by more than this percentage from --compare", type="float")
+    parser.add_option("--verbose", help="Show the output of the commands", action="store_true", default=False)
+    parser.add_option("--case", help=optparse.SUPPRESS_HELP, nargs=2)
+    parser.add_option("--result", help=optparse.SUPPRESS_HELP)
+    return parser
+
+
+###################################
+#  Benchmark Process
+###################################
+
+def main(options):
+    """ Generate the data, run every case and report the results. """
+    storages = options.storage.split(',')
+    commands = options.command.split(',')
+    for name in storages:
+        if name not in STORAGES:
+            raise SystemExit("Unknown storage '%s', choose from: %s" % (name, ', '.join(STORAGES)))
+    for name in commands:
+        if name not in COMMANDS:
+            raise SystemExit("Unknown command '%s', choose from: %s" % (name, ', '.join(COMMANDS)))
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='dbbackup-benchmark-')
+    try:
+        generate_data(options, work_dir)
+        results = []
+        for storage in storages:
+            for command in commands:
+                for repeat in range(options.repeat):
+                    result = run_case(options, work_dir, storage, command)
+                    result['repeat'] = repeat
+                    results.append(result)
+                    log(describe(result))
+                    if result.get('skipped'):
+                        break
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    document = OrderedDict([
+        ('environment', environment(options)),
+        ('results', results),
+        ('summary', summarize(results)),
+    ])
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(document, output, indent=2)
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(json.load(baseline)['summary'], document['summary'])
+        if options.max_regression is not None and \
+                any(change < -options.max_regression for change in regressions):
+            raise SystemExit(1)
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+
+
+def generate_data(options, work_dir):
+    """ Generate the database and the media tree, unless already there. """
+    db_path = os.path.join(work_dir, 'benchmark.sqlite')
+    media_dir = os.path.join(work_dir, 'media')
+    if not os.path.exists(db_path):
+        log("Generating a %s MB database" % options.db_size)
+        data.make_database(db_path, options.db_size * MB, options.seed)
+    if not os.path.exists(media_dir):
+        log("Generating %s MB of media files" % options.media_size)
+        data.make_media(media_dir, options.media_size * MB, options.media_files, options.seed)
+
+
+def run_case(options, work_dir, storage, command):
+    """ Run command against storage in a new process and return its result. """
+    handle, result_path = tempfile.mkstemp(prefix='result-', suffix='.json', dir=work_dir)
+    os.close(handle)
+    arguments = [sys.executable, os.path.abspath(__file__), '--case', storage, command,
+                 '--result', result_path, '--work-dir', work_dir, '--codec', options.codec,
+                 '--latency', str(options.latency)]
+    if options.stream:
+        arguments.append('--stream')
+    if options.verbose:
+        arguments.append('--verbose')
+    try:
+        returncode = subprocess.call(arguments)
+        with open(result_path) as result_file:
+            content = result_file.read()
+        if returncode or not content:
+            return {'storage': storage, 'command': command, 'error': 'exit status %s' % returncode}
+        return json.loads(content)
+    finally:
+        os.unlink(result_path)
+
+
+def describe(result):
+    """ Return a line describing the result of a case. """
+    name = '%s %s' % (result['storage'], result['command'])
+    if result.get('skipped'):
+        return '%s: skipped (%s)' % (name, result['skipped'])
+    if result.get('error'):
+        return '%s: failed (%s)' % (name, result['error'])
+    return '%s: %.1f MB/s, %.2fs, peak RSS %.1f MB' % (
+        name, result['mb_per_s'], result['seconds'], result['peak_rss_mb'])
+
+
+def environment(options):
+    """ Return what the results depend on besides the code. """
+    import django
+    return OrderedDict([
+        ('python', platform.python_version()),
+        ('django', django.get_version()),
+        ('platform', platform.platform()),
+        ('cpus', cpu_count()),
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('options', OrderedDict((name, getattr(options, name)) for name in (
+            'db_size', 'media_size', 'media_files', 'seed', 'repeat', 'codec', 'stream', 'latency'))),
+    ])
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(results):
+    """ Return the median throughput and peak RSS of each storage and command. """
+    summary = []
+    cases = OrderedDict()
+    for result in results:
+        cases.setdefault((result['storage'], result['command']), []).append(result)
+    for (storage, command), case_results in cases.items():
+        measured = [result for result in case_results if 'mb_per_s' in result]
+        if not measured:
+            continue
+        throughputs = [result['mb_per_s'] for result in measured]
+        summary.append(OrderedDict([
+            ('storage', storage),
+            ('command', command),
+            ('runs', len(measured)),
+            ('median_seconds', median([result['seconds'] for result in measured])),
+            ('median_mb_per_s', median(throughputs)),
+            ('min_mb_per_s', min(throughputs)),
+            ('max_mb_per_s', max(throughputs)),
+            ('median_peak_rss_mb', median([result['peak_rss_mb'] for result in measured])),
+        ]))
+    return summary
+
+
+def compare(baseline, summary):
+    """ Print the change of throughput and peak RSS of each storage and
+    command from baseline, and return the throughput changes in percent.
+    """
+    baseline = dict(((entry['storage'], entry['command']), entry) for entry in baseline)
+    changes = []
+    log("Compared with the baseline:")
+    for entry in summary:
+        previous = baseline.get((entry['storage'], entry['command']))
+        if not previous or not previous['median_mb_per_s']:
+            continue
+        change = 100.0 * (entry['median_mb_per_s'] / previous['median_mb_per_s'] - 1)
+        changes.append(change)
+        log("  %s %s: %.1f MB/s (%+.1f%%), peak RSS %.1f MB (was %.1f MB)" % (
+            entry['storage'], entry['command'], entry['median_mb_per_s'], change,
+            entry['median_peak_rss_mb'], previous['median_peak_rss_mb']))
+    return changes
+
+
+###################################
+#  Case Process
+###################################
+
+def run_command_case(options, storage, command):
+    """ Run command against storage in this process and write its result. """
+    work_dir = options.work_dir
+    db_path = os.path.join(work_dir, 'benchmark.sqlite')
+    media_dir = os.path.join(work_dir, 'media')
+    case_dir = tempfile.mkdtemp(prefix='case-', dir=work_dir)
+    result = OrderedDict([('storage', storage), ('command', command)])
+    try:
+        configure(options, STORAGES[storage], db_path, media_dir, case_dir)
+        try:
+            __import__(STORAGES[storage])
+        except ImportError, err:
+            result['skipped'] = str(err)
+            return write_result(options.result, result)
+
+        from django.core.management import call_command
+        from dbbackup import signals
+        runs = []
+        signals.run_finished.connect(lambda sender, run, **kwargs: runs.append(run), weak=False)
+        arguments = command_arguments(options, command, case_dir)
+
+        stdout = sys.stdout
+        if not options.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            if command in PREPARE:
+                call_command(PREPARE[command], **command_arguments(options, PREPARE[command], case_dir))
+                del runs[:]
+            rss_reset = reset_peak_rss()
+            start = time.time()
+            call_command(command, **arguments)
+            seconds = time.time() - start
+        finally:
+            sys.stdout = stdout
+
+        size = data.tree_size(media_dir) if command in MEDIA_COMMANDS else os.path.getsize(db_path)
+        result['seconds'] = seconds
+        result['bytes'] = size
+        result['mb_per_s'] = float(size) / MB / seconds if seconds else 0.0
+        result['peak_rss_mb'] = peak_rss(rss_reset) / float(MB)
+        result['peak_rss_reset'] = rss_reset
+        result['stages'] = [OrderedDict([
+            ('name', stage.name),
+            ('seconds', stage.seconds),
+            ('bytes_in', stage.bytes_in),
+            ('bytes_out', stage.bytes_out),
+            ('mb_per_s', stage.throughput() / MB),
+            ('retries', stage.retries),
+        ]) for run in runs for stage in run.stages.values()]
+        write_result(options.result, result)
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+
+
+def configure(options, storage_module, db_path, media_dir, case_dir):
+    """ Configure Django for the case, with its own backup directory. """
+    from django.conf import settings
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='dbbackup-benchmark',
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': db_path}},
+        INSTALLED_APPS=('dbbackup',),
+        MEDIA_ROOT=media_dir,
+        DBBACKUP_STORAGE=storage_module,
+        DBBACKUP_FILESYSTEM_DIRECTORY=os.path.join(case_dir, 'backups'),
+        # Measure the copy itself, not the pauses letting writers in
+        DBBACKUP_SQLITE_BACKUP_SLEEP=0,
+        BENCHMARK_EMULATOR_LATENCY=options.latency,
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def command_arguments(options, command, case_dir):
+    """ Return the options of the command for call_command(). """
+    codec = None if options.codec == 'none' else options.codec
+    if command == 'dbbackup':
+        return {'database': 'default', 'codec': codec, 'stream': options.stream}
+    if command == 'dbrestore':
+        return {'database': 'default', 'stream': options.stream}
+    if command == 'backup_media':
+        return {'codec': codec}
+    return {'target': os.path.join(case_dir, 'restored-media')}
+
+
+def reset_peak_rss():
+    """ Reset the peak RSS of the process to its current RSS, on Linux.
+    Return whether it was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss(reset):
+    """ Return the peak RSS of the process in bytes, since the reset. """
+    if reset:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def write_result(path, result):
+    with open(path, 'w') as result_file:
+        json.dump(result, result_file)
+
+
+if __name__ == '__main__':
+    options, _ = get_option_parser().parse_args()
+    if options.case:
+        run_command_case(options, *options.case)
+    else:
+        main(options)
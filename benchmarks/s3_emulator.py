@@ -0,0 +1,205 @@
+"""
+Local stand-in for Amazon S3.
+The S3 storage runs unchanged against an in-memory bucket standing in for
+the boto connection, so the part splitting, the concurrent uploads and the
+ranged downloads are measured without the network. Each request sleeps
+BENCHMARK_EMULATOR_LATENCY seconds, to see how the storage copes with
+round trips. boto must be installed, as the storage imports it.
+
+Importing this module replaces the boto Key and MultiPartUpload classes
+the S3 storage uses, so only import it in a benchmark process.
+"""
+import itertools
+import re
+import threading
+import time
+from cStringIO import StringIO
+
+from django.conf import settings
+
+from dbbackup.storage import s3_storage
+
+LATENCY = getattr(settings, 'BENCHMARK_EMULATOR_LATENCY', 0)
+RANGE = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+# The objects by key name, shared by every connection of the process
+OBJECTS = {}
+# The parts of the multipart uploads in progress by upload id
+UPLOADS = {}
+_objects_lock = threading.Lock()
+_upload_ids = itertools.count(1)
+
+
+def request():
+    """ Account for one request to S3. """
+    if LATENCY:
+        time.sleep(LATENCY)
+
+
+def get_object(name):
+    with _objects_lock:
+        if name not in OBJECTS:
+            raise s3_storage.StorageError('NoSuchKey: %s' % name)
+        return OBJECTS[name]
+
+
+class Connection:
+    """ Stand-in for S3Connection. """
+
+    def get_bucket(self, bucket_name, validate=True):
+        if validate:
+            request()
+        return Bucket(bucket_name)
+
+
+class Bucket:
+    """ Stand-in for the boto Bucket. """
+
+    def __init__(self, name):
+        self.name = name
+
+    def initiate_multipart_upload(self, key_name):
+        request()
+        upload = MultiPartUpload(self)
+        upload.key_name = key_name
+        upload.id = str(next(_upload_ids))
+        with _objects_lock:
+            UPLOADS[upload.id] = {}
+        return upload
+
+    def list(self, prefix='', delimiter=''):
+        request()
+        with _objects_lock:
+            names = sorted(name for name in OBJECTS if name.startswith(prefix))
+        keys = []
+        prefixes = set()
+        for name in names:
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+            else:
+                keys.append(Key(self, name))
+        return keys + [Key(self, name) for name in sorted(prefixes)]
+
+    def get_key(self, name):
+        request()
+        with _objects_lock:
+            if name not in OBJECTS:
+                return None
+        return Key(self, name)
+
+    def new_key(self, name):
+        return Key(self, name)
+
+    def delete_key(self, name):
+        request()
+        with _objects_lock:
+            OBJECTS.pop(name, None)
+
+    def delete_keys(self, names, quiet=False):
+        request()
+        with _objects_lock:
+            for name in names:
+                OBJECTS.pop(name, None)
+        return DeleteResult()
+
+    def copy_key(self, new_name, src_bucket_name, src_name):
+        request()
+        data = get_object(src_name)
+        with _objects_lock:
+            OBJECTS[new_name] = data
+
+
+class DeleteResult:
+    """ Stand-in for the result of a multi-object delete. """
+    errors = []
+
+
+class MultiPartUpload:
+    """ Stand-in for the boto MultiPartUpload. """
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+
+    def upload_part_from_file(self, fp, part_num):
+        request()
+        data = fp.read()
+        with _objects_lock:
+            UPLOADS[self.id][part_num] = data
+
+    def copy_part_from_key(self, src_bucket_name, src_key_name, part_num, start=None, end=None):
+        request()
+        data = get_object(src_key_name)
+        if start is not None:
+            data = data[start:end + 1]
+        with _objects_lock:
+            UPLOADS[self.id][part_num] = data
+
+    def complete_upload(self):
+        request()
+        with _objects_lock:
+            parts = UPLOADS.pop(self.id)
+            OBJECTS[self.key_name] = ''.join(parts[number] for number in sorted(parts))
+
+    def cancel_upload(self):
+        request()
+        with _objects_lock:
+            UPLOADS.pop(self.id, None)
+
+
+class Key(object):
+    """ Stand-in for the boto Key. A new-style class, for the key property. """
+
+    def __init__(self, bucket=None, name=None):
+        self.bucket = bucket
+        self.name = name
+        self._reader = None
+
+    def _get_key(self):
+        return self.name
+
+    def _set_key(self, name):
+        self.name = name
+
+    key = property(_get_key, _set_key)
+
+    @property
+    def size(self):
+        return len(get_object(self.name))
+
+    def get_contents_to_file(self, fp):
+        request()
+        fp.write(get_object(self.name))
+
+    def get_contents_as_string(self, headers=None):
+        request()
+        data = get_object(self.name)
+        match = RANGE.match((headers or {}).get('Range', ''))
+        if match:
+            return data[int(match.group(1)):int(match.group(2)) + 1]
+        return data
+
+    def read(self, size=-1):
+        if self._reader is None:
+            request()
+            self._reader = StringIO(get_object(self.name))
+        return self._reader.read(size)
+
+    def close(self):
+        self._reader = None
+
+
+s3_storage.Key = Key
+s3_storage.MultiPartUpload = MultiPartUpload
+
+
+class Storage(s3_storage.Storage):
+    """ The S3 storage, connected to the emulator. """
+    S3_BUCKET = 'dbbackup-benchmark'
+    S3_ACCESS_KEY = 'emulator'
+    S3_SECRET_KEY = 'emulator'
+
+    def get_connection(self):
+        return Connection()
@@ -0,0 +1,236 @@
+"""
+Catalog of the backups kept in the storage.
+The catalog is a JSON file stored next to the backups, describing each of
+them, so the latest backup or the backups to clean up can be found without
+listing the whole storage. Processes never rewrite it to record a change, as
+two of them doing so at once would lose one change: each change is a new
+file of the journal directory, merged with the catalog when it is read. Once
+the journal is long it is merged into the catalog, and the journal files
+merged are deleted once older than JOURNAL_GRACE.
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from . import compression
+from .dedup import DEDUP_DIRECTORY, RUNNING_DIRECTORY
+from .mysql_binlog import MYSQL_BINLOG_DIRECTORY
+from .pipeline import iter_file
+from .storage.base import StorageError, StorageFileNotFound
+from .wal import WAL_DIRECTORY
+
+CATALOG_ENABLED = getattr(settings, 'DBBACKUP_CATALOG', False)
+CATALOG_FILENAME = getattr(settings, 'DBBACKUP_CATALOG_FILENAME', 'dbbackup-catalog.json')
+CATALOG_JOURNAL_DIRECTORY = getattr(settings, 'DBBACKUP_CATALOG_JOURNAL_DIRECTORY', 'dbbackup-catalog')
+CATALOG_MERGE_EVERY = getattr(settings, 'DBBACKUP_CATALOG_MERGE_EVERY', 50)
+CATALOG_VERSION = 1
+JOURNAL_DATE_FORMAT = '%Y%m%dT%H%M%S%f'
+# Journal files merged are kept this long, for a process merging the journal
+# at the same time which listed it before they were written
+JOURNAL_GRACE = timedelta(hours=1)
+# Times the catalog is read again when a journal file is merged meanwhile
+LOAD_ATTEMPTS = 3
+
+# Merging the journal is read-modify-write, serialise those of this process.
+_lock = threading.RLock()
+
+
+def timestamp():
+    """ Return the current time as stored in the catalog. """
+    return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def describe_backup(filepath, **info):
+    """ Return the catalog entry of filepath, completing info with what the
+    filename tells.
+    """
+    entry = {
+        'database': None,
+        'server': None,
+        'timestamp': None,
+        'size': None,
+        'codec': None,
+        'encrypted': filepath.endswith('.gpg'),
+        'md5': None,
+    }
+    codec = compression.get_codec_by_extension(filepath[:-len('.gpg')] if entry['encrypted'] else filepath)
+    if codec:
+        entry['codec'] = codec.name
+    entry.update(info)
+    return entry
+
+
+def file_checksum(filehandle):
+    """ Return the md5 checksum of the contents of filehandle. """
+    filehash = hashlib.md5()
+    filehandle.seek(0)
+    for chunk in iter_file(filehandle):
+        filehash.update(chunk)
+    filehandle.seek(0)
+    return filehash.hexdigest()
+
+
+class CatalogConflict(StorageError):
+    """ The journal kept being merged into the catalog while reading it. """
+
+
+class Catalog:
+    """ Backups of a storage, read from the catalog when DBBACKUP_CATALOG is
+    set and from a listing of the storage otherwise.
+    """
+
+    def __init__(self, storage, enabled=None):
+        self.storage = storage
+        self.enabled = CATALOG_ENABLED if enabled is None else enabled
+        self.filepath = os.path.join(storage.backup_dir(), CATALOG_FILENAME)
+
+    def load(self):
+        """ Return the entries of the catalog by filepath, with the changes
+        of the journal, or None if the storage has no catalog yet.
+        """
+        return self.read()[0]
+
+    def read(self):
+        """ Return the entries of the catalog with the changes of the
+        journal, or None, and the filepaths of the journal files.
+        """
+        for attempt in range(LOAD_ATTEMPTS):
+            journal = self.journal()
+            try:
+                data = ''.join(self.storage.read_stream(self.filepath))
+            except StorageFileNotFound:
+                return None, journal
+            try:
+                catalog = json.loads(data)
+                entries = catalog['backups']
+                merged = set(catalog.get('merged', []))
+            except (ValueError, KeyError, TypeError):
+                raise StorageError("Catalog %s is corrupt, rebuild it with dbbackup_reindex." % self.filepath)
+            try:
+                for filepath in journal:
+                    if os.path.basename(filepath) not in merged:
+                        self.apply(entries, filepath)
+            except StorageFileNotFound:
+                continue  # Merged into the catalog meanwhile, read it again
+            return entries, journal
+        raise CatalogConflict("Catalog %s keeps changing." % self.filepath)
+
+    def journal(self):
+        """ Return the filepaths of the journal files, oldest first. """
+        return sorted(self.storage.list_directory(directory=CATALOG_JOURNAL_DIRECTORY), key=os.path.basename)
+
+    def apply(self, entries, filepath):
+        """ Apply the change of the journal file at filepath to entries. """
+        try:
+            change = json.loads(''.join(self.storage.read_stream(filepath)))
+            for deleted in change['deleted']:
+                entries.pop(deleted, None)
+            entries.update(change['added'])
+        except (ValueError, KeyError, TypeError):
+            raise StorageError("Catalog journal %s is corrupt, rebuild the catalog with dbbackup_reindex." % filepath)
+
+    def save(self, entries, journal=None):
+        """ Replace the catalog with entries, which hold the changes of the
+        journal files at journal, by default all of them.
+        """
+        journal = self.journal() if journal is None else journal
+        data = json.dumps({'version': CATALOG_VERSION, 'backups': entries,
+                           'merged': [os.path.basename(filepath) for filepath in journal]},
+                          sort_keys=True, separators=(',', ':'))
+        self.storage.write_stream(CATALOG_FILENAME, [data])
+
+    def record(self, added=None, deleted=()):
+        """ Record a change in a new journal file, merging the journal into
+        the catalog once it has DBBACKUP_CATALOG_MERGE_EVERY files.
+        """
+        name = '%s/%s-%s.json' % (CATALOG_JOURNAL_DIRECTORY, datetime.utcnow().strftime(JOURNAL_DATE_FORMAT),
+                                  uuid.uuid4().hex)
+        self.storage.write_stream(name, [json.dumps({'added': added or {}, 'deleted': list(deleted)})])
+        if len(self.journal()) >= CATALOG_MERGE_EVERY:
+            self.merge()
+
+    def merge(self):
+        """ Write the catalog with the changes of the journal, then delete the
+        journal files merged older than JOURNAL_GRACE.
+        """
+        with _lock:
+            entries, journal = self.read()
+            if entries is None:
+                return
+            self.save(entries, journal)
+            expiry = (datetime.utcnow() - JOURNAL_GRACE).strftime(JOURNAL_DATE_FORMAT)
+            expired = [filepath for filepath in journal if os.path.basename(filepath) < expiry]
+            if expired:
+                self.storage.delete_files(expired)
+
+    def entries(self):
+        """ Return the entries of the catalog, building it from a listing of
+        the storage if there is none or it keeps changing while read.
+        """
+        try:
+            entries = self.load()
+        except CatalogConflict:
+            entries = None
+        if entries is None:
+            entries = self.reindex()
+        return entries
+
+    def list_directory(self, directory=''):
+        """ List all stored backups, or those under directory. """
+        if not self.enabled:
+            return self.storage.list_directory(directory=directory) if directory else self.storage.list_directory()
+        prefix = os.path.join(self.storage.backup_dir(), directory, '')
+        return sorted(path for path in self.entries() if path.startswith(prefix))
+
+    def add(self, filepath, **info):
+        """ Record a new backup in the catalog. """
+        if not self.enabled:
+            return
+        if self.load() is None:
+            self.reindex()
+        self.record(added={filepath: describe_backup(filepath, **info)})
+
+    def delete_files(self, filepaths):
+        """ Delete the backups from the storage, then from the catalog. If
+        the deletion fails the catalog is left as is, as it is unknown which
+        backups were deleted.
+        """
+        self.storage.delete_files(filepaths)
+        if self.enabled:
+            self.record(deleted=filepaths)
+
+    def move_file(self, filepath, filename):
+        """ Move the backup in the storage and in the catalog. """
+        self.storage.move_file(filepath, filename)
+        if self.enabled:
+            new_filepath = os.path.join(self.storage.backup_dir(), filename)
+            entry = (self.load() or {}).get(filepath) or describe_backup(new_filepath)
+            self.record(added={new_filepath: entry}, deleted=[filepath])
+
+    def reindex(self):
+        """ Rebuild the catalog from a full listing of the storage, keeping
+        what is known of the backups already in it. Return the new entries.
+        """
+        with _lock:
+            try:
+                old_entries = self.load() or {}
+            except StorageError:
+                old_entries = {}
+            # Listed before the storage: the changes recorded after the
+            # listing are not merged, and apply on top of it
+            journal = self.journal()
+            entries = {}
+            skipped = tuple(os.path.join(self.storage.backup_dir(), directory, '') for directory in (
+                DEDUP_DIRECTORY, RUNNING_DIRECTORY, WAL_DIRECTORY, MYSQL_BINLOG_DIRECTORY, CATALOG_JOURNAL_DIRECTORY))
+            for filepath in self.storage.list_directory():
+                if os.path.basename(filepath) == CATALOG_FILENAME or filepath.startswith(skipped):
+                    continue
+                entries[filepath] = old_entries.get(filepath) or describe_backup(filepath)
+            self.save(entries, journal)
+            return entries
+
@@ -0,0 +1,49 @@
+"""
+Chains of incremental backups.
+An incremental backup, whatever the engine, only holds the changes since the
+previous backup of the database, and is restored by applying the backups
+since the last full backup in order. Incremental backups are told apart by
+INCREMENTAL_SUFFIX after the extension of the database in their name.
+"""
+import os
+
+from django.core.management.base import CommandError
+
+INCREMENTAL_SUFFIX = '-inc'
+
+
+def is_incremental(filepath, extension):
+    """ Return whether the backup at filepath, of a database whose backups
+    have extension, is an incremental one.
+    """
+    return '.%s%s' % (extension, INCREMENTAL_SUFFIX) in os.path.basename(filepath)
+
+
+def dependencies(backups, extension):
+    """ Return the backups each of the (datetime, filepath) backups needs to
+    be restored: the last full backup and the incremental backups since.
+    """
+    needed = {}
+    chain = []
+    for _, filepath in sorted(backups):
+        if is_incremental(filepath, extension):
+            needed[filepath] = list(chain)
+            chain.append(filepath)
+        else:
+            chain = [filepath]
+    return needed
+
+
+def restore_chain(filepath, filepaths, extension):
+    """ Return the backups to apply in order to restore the backup at
+    filepath, from the last full backup before it. filepaths are the
+    backups of the database sorted by date.
+    """
+    chain = [filepath]
+    position = filepaths.index(filepath)
+    while is_incremental(chain[0], extension):
+        if position == 0:
+            raise CommandError("No full backup found before %s" % filepath)
+        position -= 1
+        chain.insert(0, filepaths[position])
+    return chain
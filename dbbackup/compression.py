@@ -0,0 +1,572 @@
+"""
+Compression codecs used for backups.
+Codecs are registered by name and selected with DBBACKUP_COMPRESSION or the
+--codec option. Restores find the codec from the file extension or, failing
+that, from the magic bytes at the start of the file.
+"""
+import bz2
+import copy
+import itertools
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from . import utils
+from .pipeline import ChunkReader, iter_file, parallel_map, prefetch, rechunk
+
+
+COMPRESSION = getattr(settings, 'DBBACKUP_COMPRESSION', 'gzip')
+COMPRESSION_LEVEL = getattr(settings, 'DBBACKUP_COMPRESSION_LEVEL', None)
+GZIP_THREADS = getattr(settings, 'DBBACKUP_GZIP_THREADS', 1)
+GZIP_BLOCK_SIZE = getattr(settings, 'DBBACKUP_GZIP_BLOCK_SIZE', 1024 * 1024)
+ZSTD_THREADS = getattr(settings, 'DBBACKUP_ZSTD_THREADS', 0)
+ZSTD_DICTIONARY = getattr(settings, 'DBBACKUP_ZSTD_DICTIONARY', None)
+ADAPTIVE_BLOCK_SIZE = getattr(settings, 'DBBACKUP_ADAPTIVE_BLOCK_SIZE', 8 * 1024 * 1024)
+
+CODECS = {}
+
+
+def register_codec(codec_class):
+    """ Register a codec class under its name. """
+    CODECS[codec_class.name] = codec_class
+    return codec_class
+
+
+def get_codec(name=None, level=None, threads=None):
+    """ Return a codec instance by name, defaulting to DBBACKUP_COMPRESSION.
+    threads is passed on to codecs able to compress on several threads.
+    """
+    name = name or COMPRESSION
+    if name not in CODECS:
+        raise CommandError("Unknown compression codec '%s', choose from: %s" % (name, ', '.join(sorted(CODECS))))
+    if level is None:
+        level = COMPRESSION_LEVEL
+    if threads is not None and CODECS[name].threads is not None:
+        return CODECS[name](level, threads=threads)
+    return CODECS[name](level)
+
+
+def get_codec_by_extension(filename):
+    """ Return the codec matching the extension of filename, or None. """
+    _, extension = os.path.splitext(filename)
+    for codec_class in CODECS.values():
+        if codec_class.extension == extension:
+            return codec_class()
+    return None
+
+
+def get_codec_by_magic(head):
+    """ Return the codec whose magic bytes start head, or None. """
+    for codec_class in CODECS.values():
+        if head.startswith(codec_class.magic):
+            return codec_class()
+    return None
+
+
+def peek(chunks, size=16):
+    """ Return the first bytes of chunks and an iterator over all of them. """
+    chunks = iter(chunks)
+    head = []
+    buffered = 0
+    for chunk in chunks:
+        head.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            break
+
+    def rejoined():
+        for chunk in head:
+            yield chunk
+        for chunk in chunks:
+            yield chunk
+    return ''.join(head)[:size], rejoined()
+
+
+def read_backup(storage, filepath, run_metrics):
+    """ Return the chunks of the backup at filepath in storage, decrypted
+    and decompressed as they are downloaded, metered in run_metrics.
+    """
+    downloaded = run_metrics.meter('download', storage.read_stream(filepath))
+    chunks = prefetch(downloaded)
+    if filepath.endswith('.gpg'):
+        chunks = downloaded = run_metrics.meter('decrypt', utils.gpg_decrypt(chunks), downloaded)
+        filepath = filepath[:-len('.gpg')]
+    head, chunks = peek(chunks)
+    codec = get_codec_by_extension(filepath) or get_codec_by_magic(head)
+    if codec:
+        print "  Decompressing with %s" % codec.name
+        chunks = run_metrics.meter('decompress', codec.decompress(chunks), downloaded)
+    return chunks
+
+
+###################################
+#  Base Codec
+###################################
+
+class BaseCodec:
+    """ Base class for a compression codec. """
+    name = None
+    extension = None
+    magic = None
+    default_level = None
+    min_level = None
+    max_level = None
+    threads = None  # Overridden by codecs able to compress on several threads
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    def compressor(self):
+        """ Return an object with compress(data) and flush() methods. """
+        raise NotImplementedError("Subclasses must implement compressor")
+
+    def decompressor(self):
+        """ Return an object with a decompress(data) method. """
+        raise NotImplementedError("Subclasses must implement decompressor")
+
+    def compress(self, chunks):
+        """ Compress an iterable of chunks. """
+        compressor = self.compressor()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        data = compressor.flush()
+        if data:
+            yield data
+
+    def decompress(self, chunks):
+        """ Decompress an iterable of chunks. Concatenated streams, as written
+        by parallel or adaptive compression, are decompressed one after another.
+        """
+        decompressor = self.decompressor()
+        for chunk in chunks:
+            while chunk:
+                if getattr(decompressor, 'eof', False):
+                    decompressor = self.decompressor()
+                try:
+                    data = decompressor.decompress(chunk)
+                except EOFError:
+                    # The previous stream ended exactly on a chunk boundary
+                    decompressor = self.decompressor()
+                    continue
+                if data:
+                    yield data
+                chunk = getattr(decompressor, 'unused_data', '')
+                if chunk:
+                    decompressor = self.decompressor()
+        flush = getattr(decompressor, 'flush', None)
+        if flush:
+            data = flush()
+            if data:
+                yield data
+
+    def compress_file(self, input_file):
+        """ Compress this file. The input and the output are filelike objects. """
+        outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        outputfile.name = input_file.name + self.extension
+        input_file.seek(0)
+        for data in self.compress(iter_file(input_file)):
+            outputfile.write(data)
+        return outputfile
+
+    def decompress_file(self, input_file):
+        """ Decompress this file. The input and the output are filelike objects. """
+        outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        input_file.seek(0)
+        for data in self.decompress(iter_file(input_file)):
+            outputfile.write(data)
+        return outputfile
+
+    def describe(self):
+        """ Return a short description of the codec and its settings. """
+        if self.threads and self.threads != 1:
+            return '%s (level %s, %s threads)' % (self.name, self.level, self.threads)
+        return '%s (level %s)' % (self.name, self.level)
+
+
+class CompressedWriter:
+    """ File-like object compressing everything written to fileobj. """
+
+    def __init__(self, codec, fileobj):
+        self.compressor = codec.compressor()
+        self.fileobj = fileobj
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+
+###################################
+#  Standard Library Codecs
+###################################
+
+# Gzip header of a block written by parallel compression: the FEXTRA flag is
+# set and the extra field holds a 'DB' subfield with the size of the member,
+# so that members can be split again for parallel decompression.
+GZIP_BLOCK_HEADER = struct.Struct('<BBBBIBBH2sHI')
+GZIP_BLOCK_TRAILER = struct.Struct('<II')
+
+
+def _gzip_block_size(header):
+    """ Return the member size recorded in a block header, or None. """
+    fields = GZIP_BLOCK_HEADER.unpack(header)
+    if fields[:4] != (0x1f, 0x8b, 8, 4) or fields[7:10] != (8, 'DB', 4):
+        return None
+    return fields[10]
+
+
+def _gzip_decompress_block(member):
+    return zlib.decompress(member, 16 + zlib.MAX_WBITS)
+
+
+@register_codec
+class GzipCodec(BaseCodec):
+    """ Gzip, the default codec. With more than one thread the stream is split
+    into blocks compressed in parallel, pigz style. The output is a standard
+    multi-member gzip file.
+    """
+    name = 'gzip'
+    extension = '.gz'
+    magic = '\x1f\x8b'
+    default_level = 6
+    min_level = 1
+    max_level = 9
+    threads = GZIP_THREADS
+
+    def __init__(self, level=None, threads=GZIP_THREADS, block_size=GZIP_BLOCK_SIZE):
+        BaseCodec.__init__(self, level)
+        self.threads = threads
+        self.block_size = block_size
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def compress(self, chunks):
+        if self.threads <= 1:
+            return BaseCodec.compress(self, chunks)
+        return self._parallel_compress(chunks)
+
+    def decompress(self, chunks):
+        if self.threads <= 1:
+            return BaseCodec.decompress(self, chunks)
+        return self._parallel_decompress(chunks)
+
+    def compress_block(self, block):
+        """ Compress block into a complete gzip member. zlib releases the GIL,
+        so blocks compress in parallel on a thread pool.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = compressor.compress(block) + compressor.flush()
+        size = GZIP_BLOCK_HEADER.size + len(body) + GZIP_BLOCK_TRAILER.size
+        header = GZIP_BLOCK_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 255, 8, 'DB', 4, size)
+        trailer = GZIP_BLOCK_TRAILER.pack(zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+        return header + body + trailer
+
+    def _parallel_compress(self, chunks):
+        empty = True
+        for member in parallel_map(self.compress_block, rechunk(chunks, self.block_size), self.threads):
+            empty = False
+            yield member
+        if empty:
+            yield self.compress_block('')
+
+    def _parallel_decompress(self, chunks):
+        rest = []
+        for data in parallel_map(_gzip_decompress_block, self._split_blocks(chunks, rest), self.threads):
+            yield data
+        if rest:
+            for data in BaseCodec.decompress(self, rest[0]):
+                yield data
+
+    def _split_blocks(self, chunks, rest):
+        """ Yield the members written by compress_block(). From the first
+        member without a recorded size, the remaining chunks are put in rest
+        to be decompressed serially.
+        """
+        chunks = iter(chunks)
+        buffer = ''
+        while True:
+            buffer = _fill(buffer, chunks, GZIP_BLOCK_HEADER.size)
+            if len(buffer) < GZIP_BLOCK_HEADER.size:
+                break
+            size = _gzip_block_size(buffer[:GZIP_BLOCK_HEADER.size])
+            if size is None:
+                break
+            buffer = _fill(buffer, chunks, size)
+            if len(buffer) < size:
+                break
+            yield buffer[:size]
+            buffer = buffer[size:]
+        rest.append(itertools.chain([buffer], chunks))
+
+
+def _fill(buffer, chunks, size):
+    """ Read from chunks until buffer holds at least size bytes. """
+    parts = [buffer]
+    buffered = len(buffer)
+    while buffered < size:
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        parts.append(chunk)
+        buffered += len(chunk)
+    return ''.join(parts)
+
+
+@register_codec
+class Bzip2Codec(BaseCodec):
+    """ Bzip2, slow but available everywhere. """
+    name = 'bzip2'
+    extension = '.bz2'
+    magic = 'BZh'
+    default_level = 9
+    min_level = 1
+    max_level = 9
+
+    def compressor(self):
+        return bz2.BZ2Compressor(self.level)
+
+    def decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+@register_codec
+class XzCodec(BaseCodec):
+    """ Xz, the best ratio for cold archives. """
+    name = 'xz'
+    extension = '.xz'
+    magic = '\xfd7zXZ\x00'
+    default_level = 6
+    min_level = 0
+    max_level = 9
+
+    def _lzma(self):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise CommandError("The xz codec requires the backports.lzma package.")
+        return lzma
+
+    def compressor(self):
+        lzma = self._lzma()
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=self.level)
+
+    def decompressor(self):
+        lzma = self._lzma()
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+
+###################################
+#  Optional Codecs
+###################################
+
+@register_codec
+class ZstdCodec(BaseCodec):
+    """ Zstandard, fast with a good ratio. Supports multi-threaded compression
+    (DBBACKUP_ZSTD_THREADS) and a trained dictionary (DBBACKUP_ZSTD_DICTIONARY).
+    """
+    name = 'zstd'
+    extension = '.zst'
+    magic = '\x28\xb5\x2f\xfd'
+    default_level = 3
+    min_level = 1
+    max_level = 19
+    threads = ZSTD_THREADS
+
+    def __init__(self, level=None, threads=ZSTD_THREADS, dictionary=ZSTD_DICTIONARY):
+        BaseCodec.__init__(self, level)
+        self.threads = threads
+        self.dictionary = dictionary
+
+    def _zstd(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError("The zstd codec requires the zstandard package.")
+        return zstandard
+
+    def _dictionary_kwargs(self, zstd):
+        if not self.dictionary:
+            return {}
+        with open(self.dictionary, 'rb') as f:
+            return {'dict_data': zstd.ZstdCompressionDict(f.read())}
+
+    def compressor(self):
+        zstd = self._zstd()
+        return zstd.ZstdCompressor(level=self.level, threads=self.threads,
+                                   **self._dictionary_kwargs(zstd)).compressobj()
+
+    def decompressor(self):
+        zstd = self._zstd()
+        return zstd.ZstdDecompressor(**self._dictionary_kwargs(zstd)).decompressobj()
+
+    def decompress(self, chunks):
+        """ Decompress an iterable of chunks, reading across frames. """
+        zstd = self._zstd()
+        decompressor = zstd.ZstdDecompressor(**self._dictionary_kwargs(zstd))
+        reader = decompressor.stream_reader(ChunkReader(chunks), read_across_frames=True)
+        return iter_file(reader)
+
+    def describe(self):
+        description = BaseCodec.describe(self)
+        if self.dictionary:
+            description += ' with dictionary %s' % self.dictionary
+        return description
+
+
+class _Lz4Compressor:
+    """ Adapt LZ4FrameCompressor to the compress()/flush() interface. """
+
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.header = compressor.begin()
+
+    def compress(self, data):
+        data = self.header + self.compressor.compress(data)
+        self.header = ''
+        return data
+
+    def flush(self):
+        data = self.header + self.compressor.flush()
+        self.header = ''
+        return data
+
+
+@register_codec
+class Lz4Codec(BaseCodec):
+    """ LZ4, the fastest codec. """
+    name = 'lz4'
+    extension = '.lz4'
+    magic = '\x04\x22\x4d\x18'
+    default_level = 0
+    min_level = 0
+    max_level = 16
+
+    def _lz4(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise CommandError("The lz4 codec requires the lz4 package.")
+        return lz4.frame
+
+    def compressor(self):
+        return _Lz4Compressor(self._lz4().LZ4FrameCompressor(compression_level=self.level))
+
+    def decompressor(self):
+        return self._lz4().LZ4FrameDecompressor()
+
+
+###################################
+#  Adaptive Compression
+###################################
+
+class AdaptiveCompression:
+    """ Compress chunks in blocks, choosing the level of each block so that
+    compression keeps pace with the upload. Each block is a complete stream;
+    concatenated streams are valid for every codec.
+
+    When compression outruns the upload the CPU has time to spare, so the
+    level goes up; when the upload waits on compression the level goes down.
+    """
+    SMOOTHING = 0.3
+    HEADROOM = 1.25
+
+    def __init__(self, codec, block_size=ADAPTIVE_BLOCK_SIZE):
+        self.codec = codec
+        self.block_size = block_size
+        self.level = codec.level
+        self.levels = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.compress_rate = None
+        self.upload_bytes = 0
+        self.upload_time = 0.0
+        self.upload_rate = None
+        self._measured = (0, 0.0)
+
+    def compress(self, chunks):
+        """ Compress the chunks, adjusting the level after each block. """
+        for block in rechunk(chunks, self.block_size):
+            codec = copy.copy(self.codec)
+            codec.level = self.level
+            start = time.time()
+            data = ''.join(codec.compress([block]))
+            elapsed = time.time() - start
+            self.levels[self.level] = self.levels.get(self.level, 0) + 1
+            self.bytes_in += len(block)
+            self.bytes_out += len(data)
+            self.compress_time += elapsed
+            self.compress_rate = self._smooth(self.compress_rate, len(block) / max(elapsed, 1e-6))
+            yield data
+            self.adjust(float(len(data)) / max(len(block), 1))
+
+    def upload(self, chunks):
+        """ Pass the chunks on to the storage, timing how long it takes to
+        consume each one.
+        """
+        for chunk in chunks:
+            start = time.time()
+            yield chunk
+            self.upload_time += time.time() - start
+            self.upload_bytes += len(chunk)
+
+    def adjust(self, ratio):
+        """ Move the level one step towards balancing compression and upload. """
+        upload_bytes, upload_time = self.upload_bytes, self.upload_time
+        if upload_time <= self._measured[1]:
+            return
+        rate = (upload_bytes - self._measured[0]) / (upload_time - self._measured[1])
+        self._measured = (upload_bytes, upload_time)
+        self.upload_rate = self._smooth(self.upload_rate, rate)
+        # Input bytes per second the upload absorbs at the current ratio
+        absorbed = self.upload_rate / max(ratio, 1e-6)
+        if self.compress_rate > absorbed * self.HEADROOM and self.level < self.codec.max_level:
+            self.level += 1
+        elif self.compress_rate * self.HEADROOM < absorbed and self.level > self.codec.min_level:
+            self.level -= 1
+
+    def _smooth(self, average, value):
+        if average is None:
+            return value
+        return average + self.SMOOTHING * (value - average)
+
+    def stats(self):
+        """ Return the levels used and the measured rates. """
+        return {
+            'codec': self.codec.name,
+            'levels': dict(self.levels),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'compress_rate': self.bytes_in / self.compress_time if self.compress_time else None,
+            'upload_rate': self.upload_bytes / self.upload_time if self.upload_time else None,
+        }
+
+    def report(self):
+        """ Return a summary of the levels used and the measured rates. """
+        stats = self.stats()
+        levels = ', '.join('%s x%s' % (level, count) for level, count in sorted(stats['levels'].items()))
+        lines = ['Adaptive %s levels (level x blocks): %s' % (self.codec.name, levels or 'none')]
+        if stats['compress_rate']:
+            lines.append('Compression: %s/s, ratio %.3f' % (
+                utils.bytes_to_str(stats['compress_rate']),
+                float(stats['bytes_out']) / max(stats['bytes_in'], 1)))
+        if stats['upload_rate']:
+            lines.append('Upload: %s/s' % utils.bytes_to_str(stats['upload_rate']))
+        return lines
@@ -5,19 +5,36 @@ import copy
 import os
 import re
 import shlex
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
-from shutil import copyfileobj
-from subprocess import Popen
+from shutil import copyfileobj, rmtree
+from subprocess import Popen, PIPE
 
 from django.conf import settings
 from django.core.management.base import CommandError
 
+from . import governor
+from . import pg_copy
+from . import sqlite_backup
+from .pipeline import iter_file, prime
+
 
 READ_FILE = '<READ_FILE>'
 WRITE_FILE = '<WRITE_FILE>'
+SQLITE_BACKUP = '<SQLITE_BACKUP>'
+SQLITE_RESTORE = '<SQLITE_RESTORE>'
+PG_COPY_BACKUP = '<PG_COPY_BACKUP>'
+PG_COPY_RESTORE = '<PG_COPY_RESTORE>'
 DATE_FORMAT = getattr(settings, 'DBBACKUP_DATE_FORMAT', '%Y-%m-%d-%H%M%S')
 SERVER_NAME = getattr(settings, 'DBBACKUP_SERVER_NAME', '')
 FILENAME_TEMPLATE = getattr(settings, 'DBBACKUP_FILENAME_TEMPLATE', '{databasename}-{servername}-{datetime}.{extension}')
+DIRECTORY_TEMPLATE = getattr(settings, 'DBBACKUP_DIRECTORY_TEMPLATE', '')
+DATE_PLACEHOLDERS = ('{year}', '{month}', '{day}')
+MYSQL_CHUNK_ROWS = getattr(settings, 'DBBACKUP_MYSQL_CHUNK_ROWS', 500000)
+# Pack and unpack the dump directory of the 'directory' backup format
+TAR_DUMP_COMMAND = 'tar --directory={dumpdir} --create --file=- dump >'
+UNTAR_DUMP_COMMAND = 'tar --directory={dumpdir} --extract --file=- <'
 
 
 ##################################
@@ -26,9 +43,15 @@ FILENAME_TEMPLATE = getattr(settings, 'DBBACKUP_FILENAME_TEMPLATE', '{databasena
 
 class BaseEngineSettings:
     """Base settings for a database engine"""
+    backup_formats = ('plain',)
 
     def __init__(self, database):
         self.database = database
+        self.backup_format = database.get('BACKUP_FORMAT', 'plain')
+        self.backup_jobs = database.get('BACKUP_JOBS', 1)
+        if self.backup_format not in self.backup_formats:
+            raise CommandError("Unknown BACKUP_FORMAT '%s', choose from: %s" % (
+                self.backup_format, ', '.join(self.backup_formats)))
         self.database_adminuser = self.database.get('ADMINUSER', self.database['USER'])
         self.database_user = self.database['USER']
         self.database_password = self.database['PASSWORD']
@@ -54,25 +77,62 @@ class BaseEngineSettings:
 ##################################
 
 class MySQLSettings(BaseEngineSettings):
-    """Settings for the MySQL database engine"""
+    """Settings for the MySQL database engine. With the BACKUP_FORMAT
+    'directory' the database is dumped by mydumper and loaded by myloader,
+    both running BACKUP_JOBS threads, and the dump directory is stored as a
+    tar archive. With the BACKUP_FORMAT 'incremental' dbbackup only stores
+    the binary log written since the previous backup (see mysql_binlog), and
+    with 'tables' the tables changed since then (see table_dump).
+    """
+    backup_formats = ('plain', 'directory', 'incremental', 'tables')
+    table_data_marker = re.compile(r'^-- Dumping data for table `(?P<table>.+)`')
+    sequence_marker = None
+    table_stats_are_hints = False
 
     def get_extension(self):
+        if self.backup_format == 'directory':
+            return getattr(settings, 'DBBACKUP_MYSQL_DIRECTORY_EXTENSION', 'mysql.tar')
+        if self.backup_format == 'tables':
+            return self.get_tables_extension()
         return getattr(settings, 'DBBACKUP_MYSQL_EXTENSION', 'mysql')
 
+    def get_tables_extension(self):
+        return getattr(settings, 'DBBACKUP_MYSQL_TABLES_EXTENSION', 'mysql-tables')
+
     def get_backup_commands(self):
         backup_commands = getattr(settings, 'DBBACKUP_MYSQL_BACKUP_COMMANDS', None)
+        if not backup_commands and self.backup_format == 'directory':
+            command = 'mydumper --user={adminuser} --password={password}'
+            if self.database_host:
+                command = '%s --host={host}' % command
+            if self.database_port:
+                command = '%s --port={port}' % command
+            command = '%s --database={databasename} --threads=%s --rows=%s --outputdir={dumpdir}/dump' % (
+                command, self.backup_jobs, MYSQL_CHUNK_ROWS)
+            return [shlex.split(command), shlex.split(TAR_DUMP_COMMAND)]
         if not backup_commands:
             command = 'mysqldump --user={adminuser} --password={password}'
             if self.database_host:
                 command = '%s --host={host}' % command
             if self.database_port:
                 command = '%s --port={port}' % command
+            if self.backup_format == 'incremental':
+                command = '%s --single-transaction --flush-logs --master-data=2' % command
             command = '%s {databasename} >' % command
             backup_commands = [shlex.split(command)]
         return backup_commands
 
     def get_restore_commands(self):
         restore_commands = getattr(settings, 'DBBACKUP_MYSQL_RESTORE_COMMANDS', None)
+        if not restore_commands and self.backup_format == 'directory':
+            command = 'myloader --user={adminuser} --password={password}'
+            if self.database_host:
+                command = '%s --host={host}' % command
+            if self.database_port:
+                command = '%s --port={port}' % command
+            command = '%s --database={databasename} --threads=%s --overwrite-tables --directory={dumpdir}/dump' % (
+                command, self.backup_jobs)
+            return [shlex.split(UNTAR_DUMP_COMMAND), shlex.split(command)]
         if not restore_commands:
             command = 'mysql --user={adminuser} --password={password}'
             if self.database_host:
@@ -83,25 +143,123 @@ class MySQLSettings(BaseEngineSettings):
             restore_commands = [shlex.split(command)]
         return restore_commands
 
+    def client_options(self):
+        """Constructs the connection options of the MySQL client programs"""
+        command = '--user={adminuser} --password={password}'
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return command
+
+    def flush_logs_command(self):
+        """Constructs the command rotating the binary log and listing its files"""
+        return shlex.split('mysql %s --batch --skip-column-names '
+                           '--execute="FLUSH BINARY LOGS; SHOW BINARY LOGS" >' % self.client_options())
+
+    def binlog_copy_command(self, log_files):
+        """Constructs the command copying binary log files into {dumpdir}/dump"""
+        command = 'mysqlbinlog %s --read-from-remote-server --raw --result-file={dumpdir}/dump/' % self.client_options()
+        return shlex.split(command) + list(log_files)
+
+    def binlog_replay_command(self, log_files, start_position=None, stop_datetime=None, stop_position=None):
+        """Constructs the command decoding the binary log files of {dumpdir}/dump
+        into the statements of the database"""
+        command = ['mysqlbinlog', '--database={databasename}']
+        if start_position:
+            command.append('--start-position=%s' % start_position)
+        if stop_datetime:
+            command.append('--stop-datetime=%s' % stop_datetime)
+        if stop_position:
+            command.append('--stop-position=%s' % stop_position)
+        return command + ['{dumpdir}/dump/%s' % log_file for log_file in log_files] + ['>']
+
+    def import_command(self):
+        """Constructs the MySQL db import command"""
+        return shlex.split('mysql %s {databasename} <' % self.client_options())
+
+    def table_list_command(self):
+        """Constructs the command listing the tables with their creation and
+        update times. The update time is NULL where it is not tracked, and
+        for tables updated in the current second: it only has a resolution of
+        a second, so a later write within that second would not change it"""
+        query = ("SELECT TABLE_NAME, IF(UPDATE_TIME IS NULL OR UPDATE_TIME >= NOW(), NULL, "
+                 "CONCAT(CREATE_TIME, '/', UPDATE_TIME)) "
+                 "FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'")
+        return shlex.split('mysql %s --batch --skip-column-names' % self.client_options()) + [
+            '--execute=%s' % query, '{databasename}', '>']
+
+    def table_checksum_command(self, tables):
+        """Constructs the command listing the checksums of the tables"""
+        query = 'CHECKSUM TABLE %s' % ', '.join('`%s`' % table.replace('`', '``') for table in tables)
+        return shlex.split('mysql %s --batch --skip-column-names' % self.client_options()) + [
+            '--execute=%s' % query, '{databasename}', '>']
+
+    def parse_checksums(self, output):
+        """Returns the checksums by table in the output of CHECKSUM TABLE,
+        which names the tables with their database"""
+        return dict((name.split('.', 1)[-1], value) for name, value in output.items())
+
+    def sequence_list_command(self):
+        """MySQL has no sequences, the AUTO_INCREMENT values are in the schema"""
+        return None
+
+    def schema_dump_commands(self):
+        """Constructs the commands dumping the schema of the database"""
+        command = 'mysqldump %s --no-data --routines --triggers {databasename} >' % self.client_options()
+        return [('pre-data', shlex.split(command))]
+
+    def table_data_command(self, tables=None):
+        """Constructs the command dumping the data of the tables, or of every
+        table, in one transaction"""
+        command = 'mysqldump %s --no-create-info --skip-triggers --single-transaction {databasename}' % self.client_options()
+        return shlex.split(command) + list(tables or []) + ['>']
+
 
 ##################################
 #  PostgreSQL Settings
 ##################################
 
 class PostgreSQLSettings(BaseEngineSettings):
-    """Settings for the PostgreSQL database engine"""
+    """Settings for the PostgreSQL database engine. With the BACKUP_FORMAT
+    'directory' the database is dumped and restored by BACKUP_JOBS parallel
+    jobs, and the dump directory is stored as a tar archive. With 'tables'
+    only the tables changed since the previous backup are dumped (see
+    table_dump). With 'copy' the tables are copied by BACKUP_JOBS parallel
+    connections of psycopg2 instead of pg_dump (see pg_copy).
+    """
+    backup_formats = ('plain', 'directory', 'tables', 'copy')
+    table_data_marker = re.compile(r'^-- Data for Name: (?P<table>.+?); Type: TABLE DATA; Schema: (?P<schema>.+?);')
+    sequence_marker = re.compile(r'^-- Name: .+?; Type: SEQUENCE SET;')
+    # The statistics counters are published after the commit and reset by
+    # pg_stat_reset() or a crash, so a table they show unchanged may not be
+    table_stats_are_hints = True
 
     def get_extension(self):
+        if self.backup_format == 'directory':
+            return getattr(settings, 'DBBACKUP_POSTGRESQL_DIRECTORY_EXTENSION', 'psql.tar')
+        if self.backup_format == 'tables':
+            return self.get_tables_extension()
+        if self.backup_format == 'copy':
+            return getattr(settings, 'DBBACKUP_POSTGRESQL_COPY_EXTENSION', 'psql-copy.tar')
         return getattr(settings, 'DBBACKUP_POSTGRESQL_EXTENSION', 'psql')
 
+    def get_tables_extension(self):
+        return getattr(settings, 'DBBACKUP_POSTGRESQL_TABLES_EXTENSION', 'psql-tables')
+
     def get_backup_commands(self):
         backup_commands = getattr(settings, 'DBBACKUP_POSTGRESQL_BACKUP_COMMANDS', None)
+        if not backup_commands and self.backup_format == 'copy':
+            return [[PG_COPY_BACKUP, '{dumpdir}/dump'], shlex.split(TAR_DUMP_COMMAND)]
         if not backup_commands:
             command = 'pg_dump --username={adminuser}'
             if self.database_host:
                 command = '%s --host={host}' % command
             if self.database_port:
                 command = '%s --port={port}' % command
+            if self.backup_format == 'directory':
+                command = '%s --format=directory --jobs=%s --file={dumpdir}/dump {databasename}' % (command, self.backup_jobs)
+                return [shlex.split(command), shlex.split(TAR_DUMP_COMMAND)]
             command = '%s {databasename} >' % command
             backup_commands = [shlex.split(command)]
         return backup_commands
@@ -109,6 +267,15 @@ class PostgreSQLSettings(BaseEngineSettings):
     def get_restore_commands(self):
         restore_commands = getattr(settings, 'DBBACKUP_POSTGRESQL_RESTORE_COMMANDS', None)
         if not restore_commands:
+            if self.backup_format == 'copy':
+                return [shlex.split(UNTAR_DUMP_COMMAND), [PG_COPY_RESTORE, '{dumpdir}/dump']]
+            if self.backup_format == 'directory':
+                return [
+                    shlex.split(UNTAR_DUMP_COMMAND),
+                    shlex.split(self.dropdb_command()),
+                    shlex.split(self.createdb_command()),
+                    shlex.split(self.pg_restore_command()),
+                ]
             restore_commands = [
                 shlex.split(self.dropdb_command()),
                 shlex.split(self.createdb_command()),
@@ -143,25 +310,104 @@ class PostgreSQLSettings(BaseEngineSettings):
             command = '%s --port={port}' % command
         return '%s --single-transaction {databasename} <' % command
 
+    def pg_restore_command(self):
+        """Constructs the PostgreSQL parallel restore command of a directory dump"""
+        command = 'pg_restore --username={adminuser}'
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return '%s --jobs=%s --dbname={databasename} {dumpdir}/dump' % (command, self.backup_jobs)
+
+    def client_options(self):
+        """Constructs the connection options of the PostgreSQL client programs"""
+        command = '--username={adminuser}'
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return command
+
+    def query_command(self, query):
+        """Constructs the psql command printing the rows of a query, tab separated"""
+        return shlex.split('psql %s --no-align --tuples-only' % self.client_options()) + [
+            '--field-separator=\t', '--command=%s' % query, '{databasename}', '>']
+
+    def table_list_command(self):
+        """Constructs the command listing the tables with their row change
+        counters and file node, which TRUNCATE changes. These only hint at
+        the tables changed, see table_stats_are_hints"""
+        return self.query_command(
+            "SELECT schemaname || '.' || relname, n_tup_ins || '/' || n_tup_upd || '/' || n_tup_del || '/' || "
+            "pg_relation_filenode(relid) FROM pg_stat_user_tables")
+
+    def table_checksum_command(self, tables):
+        """Constructs the command listing the checksums of the rows of the tables"""
+        return self.query_command(' UNION ALL '.join(
+            "SELECT '%s', md5(coalesce(string_agg(md5(t::text), '' ORDER BY md5(t::text)), '')) FROM %s t" % (
+                table.replace("'", "''"), self.quote_table(table)) for table in tables))
+
+    def parse_checksums(self, output):
+        """Returns the checksums by table"""
+        return output
+
+    def sequence_list_command(self):
+        """Constructs the command listing the sequences"""
+        return self.query_command("SELECT sequence_schema || '.' || sequence_name FROM information_schema.sequences")
+
+    def quote_table(self, table):
+        """Quotes a schema.table name for SQL and the --table option of pg_dump"""
+        return '.'.join('"%s"' % part.replace('"', '""') for part in table.split('.', 1))
+
+    def schema_dump_commands(self):
+        """Constructs the commands dumping the schema of the database, before
+        and after the data"""
+        return [('%s-data' % section, shlex.split('pg_dump %s --section=%s-data {databasename} >' % (
+            self.client_options(), section))) for section in ('pre', 'post')]
+
+    def table_data_command(self, tables=None):
+        """Constructs the command dumping the data of the tables and
+        sequences, or of all of them, in one transaction"""
+        command = shlex.split('pg_dump %s --data-only' % self.client_options())
+        command += ['--table=%s' % self.quote_table(table) for table in tables or []]
+        return command + ['{databasename}', '>']
+
+    def basebackup_command(self):
+        """Constructs the pg_basebackup command of a base backup of the whole
+        cluster as a tar archive, without the WAL which is archived apart"""
+        command = getattr(settings, 'DBBACKUP_POSTGRESQL_BASEBACKUP_COMMAND', None)
+        if command:
+            return command
+        command = 'pg_basebackup --username={adminuser}'
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return shlex.split('%s --format=tar --wal-method=none --checkpoint=fast --pgdata=- >' % command)
+
 
 ##################################
 #  Sqlite Settings
 ##################################
 
 class SQLiteSettings(BaseEngineSettings):
-    """Settings for the SQLite database engine"""
+    """Settings for the SQLite database engine. With the BACKUP_FORMAT
+    'incremental' dbbackup only stores the pages changed since the previous
+    backup (see sqlite_pages).
+    """
+    backup_formats = ('plain', 'incremental')
 
     def get_extension(self):
         return getattr(settings, 'DBBACKUP_SQLITE_EXTENSION', 'sqlite')
 
     def get_backup_commands(self):
         return getattr(settings, 'DBBACKUP_SQLITE_BACKUP_COMMANDS', [
-            [READ_FILE, '{databasename}'],
+            [SQLITE_BACKUP, '{databasename}'],
         ])
 
     def get_restore_commands(self):
         return getattr(settings, 'DBBACKUP_SQLITE_RESTORE_COMMANDS', [
-            [WRITE_FILE, '{databasename}'],
+            [SQLITE_RESTORE, '{databasename}'],
         ])
 
 
@@ -176,6 +422,7 @@ class DBCommands:
         self.database = database
         self.engine = self.database['ENGINE'].split('.')[-1]
         self.settings = self._get_settings()
+        self.dump_dir = None
 
     def _get_settings(self):
         """ Returns the proper settings dictionary. """
@@ -189,13 +436,13 @@ class DBCommands:
     def _clean_passwd(self, instr):
         return instr.replace(self.database['PASSWORD'], '******')
 
-    def filename(self, servername=None, wildcard=None):
+    def filename(self, servername=None, wildcard=None, timestamp=None, extension=None):
         """ Create a new backup filename. """
         params = {
             'databasename': self.database['NAME'].replace("/", "_"),
             'servername': servername or SERVER_NAME,
-            'timestamp': datetime.now(),
-            'extension': self.settings.EXTENSION,
+            'timestamp': timestamp or datetime.now(),
+            'extension': extension or self.settings.EXTENSION,
             'wildcard': wildcard,
         }
         if callable(FILENAME_TEMPLATE):
@@ -210,14 +457,73 @@ class DBCommands:
             filename = filename.replace('--', '-')
         return filename
 
-    def filename_match(self, servername=None, wildcard='*'):
+    def directory(self, servername=None, timestamp=None):
+        """ Return the directory of a new backup in the storage, from
+        DBBACKUP_DIRECTORY_TEMPLATE. Without a timestamp, return the leading
+        directories which do not depend on the date. Empty for the flat layout.
+        """
+        params = {
+            'databasename': self.database['NAME'].replace("/", "_"),
+            'servername': servername or SERVER_NAME,
+        }
+        if timestamp:
+            params.update(year=timestamp.strftime('%Y'), month=timestamp.strftime('%m'),
+                          day=timestamp.strftime('%d'))
+        directories = []
+        for directory in DIRECTORY_TEMPLATE.split('/'):
+            if not timestamp and any(placeholder in directory for placeholder in DATE_PLACEHOLDERS):
+                break
+            for key, value in params.iteritems():
+                directory = directory.replace('{%s}' % key, unicode(value))
+            if directory:
+                directories.append(directory)
+        return '/'.join(directories)
+
+    def filepath(self, servername=None, extension=None):
+        """ Create a new backup file path, relative to the backup directory. """
+        timestamp = datetime.now()
+        filename = self.filename(servername, timestamp=timestamp, extension=extension)
+        directory = self.directory(servername, timestamp)
+        return '%s/%s' % (directory, filename) if directory else filename
+
+    def filename_match(self, servername=None, wildcard='*', extension=None):
         """ Return the prefix for backup filenames. """
-        return self.filename(servername, wildcard)
-
-    def filter_filepaths(self, filepaths, servername=None):
-        """ Returns a list of backups file paths from the dropbox entries. """
-        regex = self.filename_match(servername, '.*?')
-        return filter(lambda path: re.search(regex, path), filepaths)
+        return self.filename(servername, wildcard, extension=extension)
+
+    def filter_filepaths(self, filepaths, servername=None, extension=None):
+        """ Returns a list of backups file paths from the storage entries,
+        sorted by filename so the backups of the flat and partitioned layouts
+        are in date order. Filenames including directories are matched and
+        sorted on the whole path.
+        """
+        regex = self.filename_match(servername, '.*?', extension)
+        name = (lambda path: path) if '/' in regex else os.path.basename
+        filepaths = filter(lambda path: re.search(regex, name(path)), filepaths)
+        return sorted(filepaths, key=name)
+
+    def filepath_datetime(self, filepath, servername=None):
+        """ Return the date in the filename of a backup. """
+        regex = self.filename_match(servername, '(.*?)')
+        name = filepath if '/' in regex else os.path.basename(filepath)
+        return datetime.strptime(re.findall(regex, name)[0], DATE_FORMAT)
+
+    def dated_filepaths(self, filepaths, servername=None, extension=None):
+        """ Return the (datetime, filepath) of the backups among filepaths,
+        skipping those without a valid date in their filename.
+        """
+        regex = self.filename_match(servername, '(.*?)', extension)
+        name = (lambda path: path) if '/' in regex else os.path.basename
+        regex = re.compile(regex)
+        backups = []
+        for filepath in filepaths:
+            match = regex.search(name(filepath))
+            if not match:
+                continue
+            try:
+                backups.append((datetime.strptime(match.group(1), DATE_FORMAT), filepath))
+            except ValueError:
+                continue
+        return backups
 
     def translate_command(self, command):
         """ Translate the specified command. """
@@ -229,16 +535,73 @@ class DBCommands:
             command[i] = command[i].replace('{databasename}', self.database['NAME'])
             command[i] = command[i].replace('{host}', self.database['HOST'])
             command[i] = command[i].replace('{port}', str(self.database['PORT']))
+            if '{dumpdir}' in command[i]:
+                command[i] = command[i].replace('{dumpdir}', self.dump_dir)
         return command
 
+    @contextmanager
+    def dump_directory(self):
+        """ Provide the commands with a temporary directory as {dumpdir}. """
+        self.dump_dir = tempfile.mkdtemp(prefix='dbbackup-')
+        try:
+            yield self.dump_dir
+        finally:
+            rmtree(self.dump_dir, ignore_errors=True)
+            self.dump_dir = None
+
     def run_backup_commands(self, stdout):
         """ Translate and run the backup commands. """
-        return self.run_commands(self.settings.BACKUP_COMMANDS, stdout=stdout)
+        with self.dump_directory():
+            return self.run_commands(self.settings.BACKUP_COMMANDS, stdout=stdout)
 
     def run_restore_commands(self, stdin):
         """ Translate and run the backup commands. """
         stdin.seek(0)
-        return self.run_commands(self.settings.RESTORE_COMMANDS, stdin=stdin)
+        with self.dump_directory():
+            return self.run_commands(self.settings.RESTORE_COMMANDS, stdin=stdin)
+
+    def stream_backup_commands(self):
+        """ Translate and run the backup commands, yielding the output in chunks. """
+        with self.dump_directory():
+            for command in self.settings.BACKUP_COMMANDS:
+                command = self.translate_command(command)
+                if (command[0] in (READ_FILE, SQLITE_BACKUP)):
+                    filepath = self.sqlite_snapshot(command[1]) if command[0] == SQLITE_BACKUP else command[1]
+                    print "  Reading: %s" % filepath
+                    with open(filepath, "rb") as f:
+                        for chunk in iter_file(f):
+                            yield chunk
+                elif (command[0] == PG_COPY_BACKUP):
+                    self.pg_copy_dump(command[1])
+                elif (command[-1] == '>'):
+                    for chunk in self.stream_command(command):
+                        yield chunk
+                else:
+                    self.run_command(command)
+
+    def stream_restore_commands(self, chunks):
+        """ Translate and run the restore commands, feeding them the chunks
+        as they arrive. The first chunk is read before any command runs, so
+        a backup that cannot be read fails before the database is dropped.
+        """
+        chunks = prime(chunks)
+        with self.dump_directory():
+            for command in self.settings.RESTORE_COMMANDS:
+                command = self.translate_command(command)
+                if (command[0] in (WRITE_FILE, SQLITE_RESTORE)):
+                    filepath = os.path.join(self.dump_dir, 'restore.sqlite') if command[0] == SQLITE_RESTORE else command[1]
+                    print "  Writing: %s" % filepath
+                    with open(filepath, 'wb') as f:
+                        for chunk in chunks:
+                            f.write(chunk)
+                    if command[0] == SQLITE_RESTORE:
+                        self.sqlite_restore(filepath, command[1])
+                elif (command[0] == PG_COPY_RESTORE):
+                    self.pg_copy_restore(command[1])
+                elif (command[-1] == '<'):
+                    self.feed_command(command, chunks)
+                else:
+                    self.run_command(command)
 
     def run_commands(self, commands, stdin=None, stdout=None):
         """ Translate and run the specified commands. """
@@ -248,6 +611,16 @@ class DBCommands:
                 self.read_file(command[1], stdout)
             elif (command[0] == WRITE_FILE):
                 self.write_file(command[1], stdin)
+            elif (command[0] == SQLITE_BACKUP):
+                self.read_file(self.sqlite_snapshot(command[1]), stdout)
+            elif (command[0] == SQLITE_RESTORE):
+                filepath = os.path.join(self.dump_dir, 'restore.sqlite')
+                self.write_file(filepath, stdin)
+                self.sqlite_restore(filepath, command[1])
+            elif (command[0] == PG_COPY_BACKUP):
+                self.pg_copy_dump(command[1])
+            elif (command[0] == PG_COPY_RESTORE):
+                self.pg_copy_restore(command[1])
             else:
                 self.run_command(command, stdin, stdout)
 
@@ -256,14 +629,89 @@ class DBCommands:
         devnull = open(os.devnull, 'w')
         pstdin = stdin if command[-1] == '<' else None
         pstdout = stdout if command[-1] == '>' else devnull
-        command = filter(lambda arg: arg not in ['<', '>'], command)
+        command = governor.priority_command(filter(lambda arg: arg not in ['<', '>'], command))
         print self._clean_passwd("  Running: %s" % ' '.join(command))
+        governor.load_monitor.wait(force=True)
         process = Popen(command, stdin=pstdin, stdout=pstdout)
         process.wait()
         devnull.close()
         if process.poll():
             raise CommandError("Error running: %s" % command)
 
+    def stream_command(self, command):
+        """ Run the specified command, yielding its output in chunks. """
+        devnull = open(os.devnull, 'w')
+        command = governor.priority_command(filter(lambda arg: arg not in ['<', '>'], command))
+        print self._clean_passwd("  Running: %s" % ' '.join(command))
+        governor.load_monitor.wait(force=True)
+        process = Popen(command, stdin=devnull, stdout=PIPE)
+        try:
+            for chunk in iter_file(process.stdout):
+                yield chunk
+            if process.wait():
+                raise CommandError("Error running: %s" % command)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            devnull.close()
+
+    def feed_command(self, command, chunks):
+        """ Run the specified command, writing the chunks to its stdin. """
+        devnull = open(os.devnull, 'w')
+        command = governor.priority_command(filter(lambda arg: arg not in ['<', '>'], command))
+        print self._clean_passwd("  Running: %s" % ' '.join(command))
+        with governor.load_monitor.running_command():
+            process = Popen(command, stdin=PIPE, stdout=devnull)
+            try:
+                try:
+                    for chunk in chunks:
+                        process.stdin.write(chunk)
+                except IOError:
+                    pass  # The command exited early, reported by its return code
+                process.stdin.close()
+                if process.wait():
+                    raise CommandError("Error running: %s" % command)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                devnull.close()
+
+    def sqlite_snapshot(self, filepath):
+        """ Copy the SQLite database into {dumpdir} with the online backup
+        API, and return the path of the copy.
+        """
+        print "  Backing up: %s" % filepath
+        snapshot = os.path.join(self.dump_dir, 'snapshot.sqlite')
+        pages = sqlite_backup.copy_database(filepath, snapshot)
+        print "  Copied %s pages" % pages
+        return snapshot
+
+    def sqlite_restore(self, snapshot, filepath):
+        """ Copy the restored SQLite database over the database with the
+        online backup API, so connections to it see the change safely.
+        """
+        print "  Restoring: %s" % filepath
+        pages = sqlite_backup.copy_database(snapshot, filepath)
+        print "  Copied %s pages" % pages
+
+    def pg_copy_dump(self, directory):
+        """ Copy the PostgreSQL database into directory with parallel COPY
+        streams over psycopg2.
+        """
+        print "  Copying: %s" % self.database['NAME']
+        governor.load_monitor.wait(force=True)
+        pg_copy.dump_database(self.database, directory, self.settings.backup_jobs)
+
+    def pg_copy_restore(self, directory):
+        """ Load the PostgreSQL database from the copy extracted into
+        directory, with parallel COPY streams over psycopg2.
+        """
+        print "  Loading: %s" % self.database['NAME']
+        governor.load_monitor.wait(force=True)
+        pg_copy.restore_database(self.database, directory, self.settings.backup_jobs)
+
     def read_file(self, filepath, stdout):
         """ Read the specified file to stdout. """
         print "  Reading: %s" % filepath
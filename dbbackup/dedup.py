@@ -0,0 +1,228 @@
+"""
+Deduplicated backups.
+The dump is split into chunks at boundaries found from its content, so rows
+inserted or deleted only change the chunks around them. Each chunk is stored
+once in DBBACKUP_DEDUP_DIRECTORY, named by its sha256, and the backup itself
+is a recipe listing its chunks. While a backup stores chunks its recipe does
+not refer to yet, a marker in RUNNING_DIRECTORY holds off the collection of
+the chunks no recipe refers to.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+from . import compression
+from .pipeline import parallel_map
+from .storage.base import StorageError
+
+DEDUP_DIRECTORY = getattr(settings, 'DBBACKUP_DEDUP_DIRECTORY', 'chunks')
+DEDUP_CHUNK_SIZE = getattr(settings, 'DBBACKUP_DEDUP_CHUNK_SIZE', 1024 * 1024)
+DEDUP_THREADS = getattr(settings, 'DBBACKUP_DEDUP_THREADS', 8)
+# Markers of backups older than this are left by backups which did not finish
+DEDUP_RUNNING_EXPIRY = getattr(settings, 'DBBACKUP_DEDUP_RUNNING_EXPIRY', 24 * 3600)
+RUNNING_DIRECTORY = DEDUP_DIRECTORY + '-running'
+RECIPE_EXTENSION = '.dedup'
+RECIPE_VERSION = 1
+# Bytes before a line end hashed to decide whether to cut there
+WINDOW_SIZE = 64
+
+
+###################################
+#  Chunking
+###################################
+
+class Chunker:
+    """ Split a stream at content-defined boundaries. The boundaries are
+    looked for at line ends only, so hashing runs once per line instead of
+    once per byte; binary data has line ends every few hundred bytes. A line
+    end is a boundary when the hash of the bytes before it is smaller than
+    the length of the line, scaled to the average chunk size.
+    """
+
+    def __init__(self, chunk_size=DEDUP_CHUNK_SIZE):
+        self.min_size = chunk_size // 4
+        self.scale = chunk_size - self.min_size
+        self.max_size = chunk_size * 4
+
+    def split(self, chunks):
+        """ Yield the data of chunks split at the boundaries. A boundary is
+        only looked for once max_size bytes are buffered, so where the data
+        is cut does not depend on how it was read.
+        """
+        buffer = ''
+        for data in chunks:
+            buffer += data
+            while len(buffer) >= self.max_size:
+                cut = self.find_boundary(buffer)
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+        while buffer:
+            cut = self.find_boundary(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+
+    def find_boundary(self, data):
+        """ Return the length of the first chunk of data. """
+        limit = min(len(data), self.max_size)
+        previous = data.rfind('\n', 0, self.min_size)
+        position = data.find('\n', self.min_size, limit)
+        while position != -1:
+            window = data[max(0, position + 1 - WINDOW_SIZE):position + 1]
+            if (zlib.crc32(window) & 0xffffffff) % self.scale < position - previous:
+                return position + 1
+            previous = position
+            position = data.find('\n', position + 1, limit)
+        return limit
+
+
+###################################
+#  Chunk Store
+###################################
+
+def chunk_name(digest, extension=''):
+    """ Return the name of a chunk in the storage, relative to the backup
+    directory.
+    """
+    return '%s/%s/%s%s' % (DEDUP_DIRECTORY, digest[:2], digest, extension)
+
+
+def chunk_names(storage, filepath):
+    """ Return the names of the chunks the recipe at filepath refers to. """
+    recipe = read_recipe(storage, filepath)
+    return set(chunk_name(digest, recipe['extension']) for digest, _ in recipe['chunks'])
+
+
+def read_recipe(storage, filepath):
+    """ Return the recipe of the deduplicated backup at filepath. """
+    try:
+        return json.loads(''.join(storage.read_stream(filepath)))
+    except ValueError:
+        raise StorageError('Recipe %s is corrupt.' % filepath)
+
+
+def referenced_chunks(storage, recipes):
+    """ Return the names of the chunks the recipes refer to. """
+    referenced = set()
+    for names in parallel_map(lambda filepath: chunk_names(storage, filepath), recipes, DEDUP_THREADS):
+        referenced.update(names)
+    return referenced
+
+
+def running_name(filename):
+    """ Return the name of the marker of the backup filename while it runs,
+    relative to the backup directory. It is named by a digest, so it is not
+    taken for a backup of the database.
+    """
+    return '%s/%s.json' % (RUNNING_DIRECTORY, hashlib.sha1(filename).hexdigest())
+
+
+def running_backups(storage):
+    """ Return the markers of the backups storing chunks now, deleting those
+    older than DBBACKUP_DEDUP_RUNNING_EXPIRY.
+    """
+    running = []
+    expired = []
+    for filepath in storage.list_directory(directory=RUNNING_DIRECTORY):
+        try:
+            started = json.loads(''.join(storage.read_stream(filepath)))['started']
+        except (StorageError, ValueError, KeyError):
+            continue  # Finished meanwhile
+        (running if started > time.time() - DEDUP_RUNNING_EXPIRY else expired).append(filepath)
+    if expired:
+        storage.delete_files(expired)
+    return running
+
+
+def write_backup(storage, filename, chunks, codec=None, recipes=()):
+    """ Store the chunks of the stream missing from the storage, each
+    compressed with codec, then its recipe as filename. The chunks the
+    recipes, all those kept in the storage, refer to are not stored again.
+    Chunks no recipe refers to are stored again, as the garbage collection
+    may be deleting them. Return the recipe and the number and size of the
+    chunks stored.
+    """
+    marker = running_name(filename)
+    storage.write_stream(marker, [json.dumps({'filename': filename, 'started': time.time()})])
+    try:
+        return _write_backup(storage, filename, chunks, codec, referenced_chunks(storage, recipes))
+    finally:
+        storage.delete_file(os.path.join(storage.backup_dir(), marker))
+
+
+def _write_backup(storage, filename, chunks, codec, known):
+    extension = codec.extension if codec else ''
+    lock = threading.Lock()
+
+    def store(data):
+        digest = hashlib.sha256(data).hexdigest()
+        name = chunk_name(digest, extension)
+        # Chunks repeated in the stream are only stored once
+        with lock:
+            if name in known:
+                return digest, len(data), None
+            known.add(name)
+        payload = ''.join(codec.compress([data])) if codec else data
+        storage.write_stream(name, [payload])
+        return digest, len(data), len(payload)
+
+    recipe = {
+        'version': RECIPE_VERSION,
+        'codec': codec.name if codec else None,
+        'extension': extension,
+        'size': 0,
+        'chunks': [],
+    }
+    stored = stored_bytes = 0
+    for digest, size, payload_size in parallel_map(store, Chunker().split(chunks), DEDUP_THREADS):
+        recipe['chunks'].append([digest, size])
+        recipe['size'] += size
+        if payload_size is not None:
+            stored += 1
+            stored_bytes += payload_size
+    storage.write_stream(filename, [json.dumps(recipe, separators=(',', ':'))])
+    return recipe, stored, stored_bytes
+
+
+def read_backup(storage, filepath):
+    """ Yield the data of the deduplicated backup at filepath, fetching
+    DBBACKUP_DEDUP_THREADS chunks at once.
+    """
+    recipe = read_recipe(storage, filepath)
+    codec = compression.get_codec(recipe['codec']) if recipe['codec'] else None
+
+    def fetch(chunk):
+        digest, _ = chunk
+        data = ''.join(storage.read_stream(os.path.join(storage.backup_dir(),
+                                                        chunk_name(digest, recipe['extension']))))
+        if codec:
+            data = ''.join(codec.decompress([data]))
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise StorageError('Chunk %s of %s is corrupt.' % (digest, filepath))
+        return data
+
+    return parallel_map(fetch, recipe['chunks'], DEDUP_THREADS)
+
+
+def collect_garbage(storage, filepaths):
+    """ Delete the chunks none of the recipes among filepaths, all the
+    backups of the storage, refers to. Nothing is deleted while a backup is
+    storing chunks, in this process or another, as its recipe does not refer
+    to them yet: return None then, or the number of chunks deleted.
+    """
+    if running_backups(storage):
+        return None
+    referenced = referenced_chunks(storage, [filepath for filepath in filepaths
+                                             if filepath.endswith(RECIPE_EXTENSION)])
+    prefix = os.path.join(storage.backup_dir(), '')
+    garbage = [filepath for filepath in storage.list_directory(directory=DEDUP_DIRECTORY)
+               if filepath[len(prefix):] not in referenced]
+    # A backup started while the recipes were read stores its chunks anew
+    if garbage and not running_backups(storage):
+        storage.delete_files(garbage)
+        return len(garbage)
+    return None if garbage else 0
@@ -0,0 +1,184 @@
+"""
+Resource governor, keeping backups from competing with the rest of the host.
+- Bandwidth: token buckets cap the bytes per second uploaded to and
+  downloaded from the storage, and read from the media directory.
+- Priority: the dump and restore commands run under nice and ionice.
+- Load: the backup pauses while the load average of the host is above
+  DBBACKUP_MAX_LOAD. The dump and restore commands only start once it drops,
+  and are never paused once running: they hold locks on the database. A
+  streamed dump is spooled to disk (see pipeline.spool()) so the stages after
+  it pause at chunk boundaries while it runs on. A streamed restore command
+  reads from the stages before it, so they do not pause while it runs.
+Everything is off unless configured.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+UPLOAD_RATE = getattr(settings, 'DBBACKUP_UPLOAD_RATE', None)
+DOWNLOAD_RATE = getattr(settings, 'DBBACKUP_DOWNLOAD_RATE', None)
+MEDIA_READ_RATE = getattr(settings, 'DBBACKUP_MEDIA_READ_RATE', None)
+NICE = getattr(settings, 'DBBACKUP_NICE', None)
+IONICE_CLASS = getattr(settings, 'DBBACKUP_IONICE_CLASS', None)
+IONICE_LEVEL = getattr(settings, 'DBBACKUP_IONICE_LEVEL', None)
+MAX_LOAD = getattr(settings, 'DBBACKUP_MAX_LOAD', None)
+LOAD_CHECK_INTERVAL = getattr(settings, 'DBBACKUP_LOAD_CHECK_INTERVAL', 5)
+MAX_LOAD_WAIT = getattr(settings, 'DBBACKUP_MAX_LOAD_WAIT', None)
+
+
+###################################
+#  Bandwidth
+###################################
+
+class TokenBucket:
+    """ Limit the rate of bytes passing through to rate bytes per second,
+    with bursts of up to a second worth. Bytes over the tokens available are
+    borrowed, and the caller sleeps until they are paid back, so sizes
+    larger than a burst are fine. Threads share the rate.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """ Take size tokens, sleeping until they are available. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - size
+            self.updated = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_bucket(rate):
+    """ Return a token bucket for rate, or None for no limit. """
+    return TokenBucket(rate) if rate else None
+
+
+upload_bucket = get_bucket(UPLOAD_RATE)
+download_bucket = get_bucket(DOWNLOAD_RATE)
+media_read_bucket = get_bucket(MEDIA_READ_RATE)
+
+
+def throttle(bucket, size):
+    """ Account for size bytes passing through bucket, pausing while the
+    load is too high.
+    """
+    load_monitor.wait()
+    if bucket:
+        bucket.consume(size)
+
+
+def throttle_upload(size):
+    """ Account for size bytes about to be uploaded to the storage. """
+    throttle(upload_bucket, size)
+
+
+def throttle_download(size):
+    """ Account for size bytes about to be downloaded from the storage. """
+    throttle(download_bucket, size)
+
+
+def throttle_media_read(size):
+    """ Account for size bytes read from the media directory. """
+    throttle(media_read_bucket, size)
+
+
+class ThrottledWriter:
+    """ File-like object passing writes on to filehandle at the rate of
+    bucket.
+    """
+
+    def __init__(self, filehandle, bucket):
+        self.filehandle = filehandle
+        self.bucket = bucket
+
+    def write(self, data):
+        throttle(self.bucket, len(data))
+        self.filehandle.write(data)
+
+
+###################################
+#  Priority
+###################################
+
+def priority_command(command):
+    """ Return command run under nice and ionice, as configured. """
+    prefix = []
+    if NICE is not None:
+        prefix += ['nice', '-n', str(NICE)]
+    if IONICE_CLASS is not None:
+        prefix += ['ionice', '-c', str(IONICE_CLASS)]
+        if IONICE_LEVEL is not None:
+            prefix += ['-n', str(IONICE_LEVEL)]
+    return prefix + list(command)
+
+
+###################################
+#  Load
+###################################
+
+class LoadMonitor:
+    """ Pause the backup while the 1 minute load average of the host is
+    above max_load, checking every interval seconds. After max_wait seconds
+    paused in total, the backup carries on regardless.
+    """
+
+    def __init__(self, max_load=None, interval=LOAD_CHECK_INTERVAL, max_wait=None):
+        self.max_load = max_load
+        self.interval = interval
+        self.max_wait = max_wait
+        self.waited = 0.0
+        self.next_check = 0
+        self.commands = 0
+        self.lock = threading.Lock()
+        self.commands_lock = threading.Lock()
+
+    def too_high(self):
+        """ Return whether the backup should pause now. """
+        if self.max_wait is not None and self.waited >= self.max_wait:
+            return False
+        return os.getloadavg()[0] > self.max_load
+
+    def wait(self, force=False):
+        """ Sleep while the load is too high, unless a restore command is
+        being fed (see running_command()). Other threads calling wait()
+        meanwhile are held too. The load is checked every interval seconds,
+        or now if force is set, as before starting a database command.
+        """
+        if self.max_load is None or self.commands or (not force and time.time() < self.next_check):
+            return
+        with self.lock:
+            if self.commands or (not force and time.time() < self.next_check):
+                return
+            if self.too_high():
+                print "  Pausing: load average %.2f is above %s" % (os.getloadavg()[0], self.max_load)
+                while self.too_high():
+                    time.sleep(self.interval)
+                    self.waited += self.interval
+                print "  Resuming: load average %.2f" % os.getloadavg()[0]
+            self.next_check = time.time() + self.interval
+
+    @contextmanager
+    def running_command(self):
+        """ Wait for the load to drop, then run the block without pausing: it
+        feeds a database command holding locks from the stages before it,
+        and pausing those would stall the command as well.
+        """
+        self.wait(force=True)
+        with self.commands_lock:
+            self.commands += 1
+        try:
+            yield
+        finally:
+            with self.commands_lock:
+                self.commands -= 1
+
+load_monitor = LoadMonitor(MAX_LOAD, LOAD_CHECK_INTERVAL, MAX_LOAD_WAIT)
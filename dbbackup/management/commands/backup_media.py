@@ -1,129 +1,205 @@
-import os
 from datetime import datetime
+import os
 import tarfile
 import tempfile
 from optparse import make_option
-import re
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
+from ... import catalog
+from ... import compression
+from ... import governor
+from ... import media
+from ... import metrics
+from ... import retention
 from ... import utils
 from ...storage.base import BaseStorage
 from ...storage.base import StorageError
 
 
 DATE_FORMAT = getattr(settings, 'DBBACKUP_DATE_FORMAT', '%Y-%m-%d-%H%M%S')
-CLEANUP_KEEP = getattr(settings, 'DBBACKUP_CLEANUP_KEEP', 10)
 
 
 class Command(BaseCommand):
-    help = "backup_media [--encrypt]"
+    help = "backup_media [--encrypt] [--codec <codec>] [--incremental | --differential]"
     option_list = BaseCommand.option_list + (
         make_option("-c", "--clean", help="Clean up old backup files", action="store_true", default=False),
         make_option("-s", "--servername", help="Specify server name to include in backup filename"),
         make_option("-e", "--encrypt", help="Encrypt the backup files", action="store_true", default=False),
+        make_option("--codec", help="Compression codec to use (default: DBBACKUP_COMPRESSION)"),
+        make_option("--compress-level", help="Compression level for the codec", type="int"),
+        make_option("--compress-threads", help="Compress on this many threads (gzip and zstd)", type="int"),
+        make_option("--incremental", help="Only backup the files changed since the previous backup",
+                    action="store_const", dest="kind", const=media.INCREMENTAL),
+        make_option("--differential", help="Only backup the files changed since the last full backup",
+                    action="store_const", dest="kind", const=media.DIFFERENTIAL),
     )
 
+    def __init__(self):
+        BaseCommand.__init__(self)
+        self.run_metrics = metrics.Run('backup_media', 'media')
+
     @utils.email_uncaught_exception
     def handle(self, *args, **options):
         try:
             self.servername = options.get('servername')
+            self.codec = compression.get_codec(options.get('codec'), options.get('compress_level'),
+                                               options.get('compress_threads'))
             self.storage = BaseStorage.storage_factory()
-
-            self.backup_mediafiles(options.get('encrypt'))
-
-            if options.get('clean'):
-                self.cleanup_old_backups()
+            self.catalog = catalog.Catalog(self.storage)
+            self.run_metrics = metrics.Run('backup_media', 'media')
+            try:
+                self.backup_mediafiles(options.get('encrypt'), options.get('kind') or media.FULL)
+                if options.get('clean'):
+                    self.cleanup_old_backups()
+            except:
+                self.run_metrics.finish(False)
+                raise
+            self.run_metrics.finish(True)
 
         except StorageError, err:
             raise CommandError(err)
 
-    def backup_mediafiles(self, encrypt):
+    def backup_mediafiles(self, encrypt, kind=media.FULL):
         print "Backing up media files"
-        output_file = self.create_backup_file(self.get_source_dir(), self.get_backup_basename())
+        source_dir = self.get_source_dir()
+        base = self.get_base_backup(kind) if kind != media.FULL else None
+        with self.run_metrics.timed('scan') as stage:
+            if base:
+                print "  Based on: %s" % base[0]
+                files = media.scan(source_dir, base[1]['files'])
+                changed, deleted = media.compare(files, base[1]['files'])
+                print "  %s files changed, %s deleted" % (len(changed), len(deleted))
+            else:
+                kind = media.FULL
+                files = media.scan(source_dir)
+                changed, deleted = None, []
+            stage.bytes_in += sum(state[0] for state in files.values())
+        backup_basename = self.get_backup_basename(kind)
+        with self.run_metrics.timed('compress') as stage:
+            output_file = self.create_backup_file(source_dir, backup_basename, changed, files)
+            stage.bytes_in += sum(files[path][0] for path in (files if changed is None else changed)
+                                  if path in files)
+            stage.bytes_out += metrics.file_size(output_file)
+        manifest = media.new_manifest(backup_basename, kind, source_dir, files, base, deleted)
 
         if encrypt:
-            encrypted_file = utils.encrypt_file(output_file)
+            with self.run_metrics.timed('encrypt') as stage:
+                encrypted_file = utils.encrypt_file(output_file)
+                stage.bytes_in += metrics.file_size(output_file)
+                stage.bytes_out += metrics.file_size(encrypted_file)
             output_file = encrypted_file
 
         print "  Backup tempfile created: %s (%s)" % (output_file.name, utils.handle_size(output_file))
         print "  Writing file to %s: %s" % (self.storage.name, self.storage.backup_dir())
-        self.storage.write_file(output_file)
-
-    def get_backup_basename(self):
+        retries = self.storage.retries
+        with self.run_metrics.timed('upload') as stage:
+            self.storage.write_file(output_file)
+            stage.bytes_in += metrics.file_size(output_file)
+            stage.bytes_out += metrics.file_size(output_file)
+            stage.retries += self.storage.retries - retries
+        checksum = catalog.file_checksum(output_file) if self.catalog.enabled else None
+        output_file.seek(0, 2)
+        self.catalog.add(os.path.join(self.storage.backup_dir(), output_file.name),
+                         server=self.get_servername(),
+                         timestamp=catalog.timestamp(),
+                         size=output_file.tell(),
+                         codec=self.codec.name,
+                         encrypted=bool(encrypt),
+                         md5=checksum)
+        manifest_filename = media.write_manifest(self.storage, media.manifest_name(backup_basename),
+                                                 manifest, self.codec, encrypt)
+        self.catalog.add(os.path.join(self.storage.backup_dir(), manifest_filename),
+                         server=self.get_servername(),
+                         timestamp=catalog.timestamp())
+
+    def get_base_backup(self, kind):
+        """ Return the (filepath, manifest) of the backup a new incremental or
+        differential backup is based on, or None if a full backup is due:
+        there is no full backup with a manifest yet, or DBBACKUP_MEDIA_FULL_EVERY
+        backups were made since the last one.
+        """
+        backups = [filepath for _, filepath in self.get_backup_file_list()]
+        fulls = [i for i, filepath in enumerate(backups) if media.backup_kind(filepath) == media.FULL]
+        if not fulls or len(backups) - fulls[-1] - 1 >= media.MEDIA_FULL_EVERY:
+            return None
+        filepath = backups[-1] if kind == media.INCREMENTAL else backups[fulls[-1]]
+        manifest = media.read_manifest(self.storage, filepath)
+        if not manifest:
+            return None
+        return filepath, manifest
+
+    def get_backup_basename(self, kind=media.FULL):
         # todo: use DBBACKUP_FILENAME_TEMPLATE
         server_name = self.get_servername()
         if server_name:
             server_name = '-%s' % server_name
 
-        return '%s%s-%s.media.tar.gz' % (
+        return '%s%s-%s%s.tar%s' % (
             self.get_databasename(),
             server_name,
-            datetime.now().strftime(DATE_FORMAT)
+            datetime.now().strftime(DATE_FORMAT),
+            media.SUFFIXES[kind],
+            self.codec.extension
         )
 
     def get_databasename(self):
-        return settings.DATABASES['default']['NAME']
+        return settings.DATABASES['default']['NAME'].replace("/", "_")
 
-    def create_backup_file(self, source_dir, backup_basename):
-        temp_dir = tempfile.mkdtemp()
+    def create_backup_file(self, source_dir, backup_basename, changed=None, files=None):
+        """ Archive source_dir, or only the changed files in it. Files which
+        cannot be archived are dropped from files, so the next backup retries
+        them.
+        """
+        print "  Compressing with %s" % self.codec.describe()
+        output_file = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        output_file.name = backup_basename
+        writer = compression.CompressedWriter(self.codec, output_file)
+        tar_file = tarfile.open(fileobj=governor.ThrottledWriter(writer, governor.media_read_bucket), mode='w|')
         try:
-            backup_filename = os.path.join(temp_dir, backup_basename)
-            try:
-                tar_file = tarfile.open(backup_filename, 'w|gz')
+            if changed is None:
+                tar_file.add(source_dir)
+            for path in changed or []:
                 try:
-                    tar_file.add(source_dir)
-                finally:
-                    tar_file.close()
-
-                return utils.create_spooled_temporary_file(backup_filename, backup_basename)
-            finally:
-                if os.path.exists(backup_filename):
-                    os.remove(backup_filename)
+                    tar_file.add(os.path.join(source_dir, path), recursive=False)
+                except (IOError, OSError), err:
+                    print "  Skipping %s: %s" % (path, err)
+                    files.pop(path, None)
         finally:
-            os.rmdir(temp_dir)
+            tar_file.close()
+        writer.close()
+        return output_file
 
     def get_source_dir(self):
         return getattr(settings, 'DBBACKUP_MEDIA_PATH', settings.MEDIA_ROOT)
 
-    def cleanup_old_backups(self):
-        """ Cleanup old backups, keeping the number of backups specified by
-        DBBACKUP_CLEANUP_KEEP and any backups that occur on first of the month.
+    def cleanup_old_backups(self, dry_run=False):
+        """ Cleanup old backups, keeping those the retention policy asks for
+        (see retention.get_policy()) and those they are based on. Manifests
+        are deleted with their backup.
         """
         print "Cleaning Old Backups for media files"
-
-        file_list = self.get_backup_file_list()
-
-        for backup_date, filename in file_list[0:-CLEANUP_KEEP]:
-            if int(backup_date.strftime("%d")) != 1:
-                print "  Deleting: %s" % filename
-                self.storage.delete_file(filename)
+        with self.run_metrics.timed('cleanup'):
+            filepaths = self.catalog.list_directory()
+            backups = media.list_backups(filepaths, self.get_databasename(), self.get_servername_suffix())
+            filepaths = set(filepaths)
+            companions = dict((filepath, [m for m in [media.manifest_name(filepath)] if m in filepaths])
+                              for _, filepath in backups)
+            retention.cleanup(self.catalog, backups, retention.get_policy(), dry_run,
+                              dependencies=media.dependencies(backups), companions=companions)
 
     def get_backup_file_list(self):
         """ Return a list of backup files including the backup date. The result is a list of tuples (datetime, filename).
             The list is sorted by date.
         """
-        server_name = self.get_servername()
-        if server_name:
-            server_name = '-%s' % server_name
+        return media.list_backups(self.catalog.list_directory(), self.get_databasename(),
+                                  self.get_servername_suffix())
 
-        media_re = re.compile(r'%s%s-(.*)\.media\.tar\.gz' % (self.get_databasename(), server_name))
-
-        def is_media_backup(filename):
-            return media_re.search(filename)
-
-        def get_datetime_from_filename(filename):
-            datestr = re.findall(media_re, filename)[0]
-            return datetime.strptime(datestr, DATE_FORMAT)
-
-        file_list = [
-            (get_datetime_from_filename(f), f)
-            for f in self.storage.list_directory()
-            if is_media_backup(f)
-        ]
-        return sorted(file_list, key=lambda v: v[0])
+    def get_servername_suffix(self):
+        server_name = self.get_servername()
+        return '-%s' % server_name if server_name else ''
 
     def get_servername(self):
-        return self.servername or getattr(settings, 'DBBACKUP_SERVER_NAME', '')
\ No newline at end of file
+        return self.servername or getattr(settings, 'DBBACKUP_SERVER_NAME', '')
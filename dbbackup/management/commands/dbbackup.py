@@ -1,38 +1,71 @@
 """
 Save backup files to Dropbox.
 """
-import re
-import datetime
+import copy
+import os
+import shlex
+import sys
 import tempfile
+import threading
+import traceback
 from optparse import make_option
-import gzip
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 from django.core.management.base import LabelCommand
 
+from ... import catalog
+from ... import chains
+from ... import compression
+from ... import dedup
+from ... import metrics
+from ... import mysql_binlog
+from ... import pipeline
+from ... import retention
+from ... import sqlite_pages
+from ... import table_dump
 from ... import utils
 from ...dbcommands import DBCommands
-from ...dbcommands import DATE_FORMAT
+from ...dbcommands import SERVER_NAME
+from ...dbcommands import TAR_DUMP_COMMAND
 from ...storage.base import BaseStorage
 from ...storage.base import StorageError
 
 
 DATABASE_KEYS = getattr(settings, 'DBBACKUP_DATABASES', settings.DATABASES.keys())
-CLEANUP_KEEP = getattr(settings, 'DBBACKUP_CLEANUP_KEEP', 10)
+PARALLEL_PER_HOST = getattr(settings, 'DBBACKUP_PARALLEL_PER_HOST', 1)
 
 
 class Command(LabelCommand):
-    help = "dbbackup [-c] [-d <dbname>] [-s <servername>] [--compress] [--encrypt]"
+    help = "dbbackup [-c] [-d <dbname>] [-s <servername>] [-p <workers>] [--compress] [--codec <codec>] [--encrypt] [--stream [--adaptive] | --dedup]"
     option_list = BaseCommand.option_list + (
         make_option("-c", "--clean", help="Clean up old backup files", action="store_true", default=False),
         make_option("-d", "--database", help="Database to backup (default: everything)"),
         make_option("-s", "--servername", help="Specifiy server name to include in backup filename"),
+        make_option("-p", "--parallel", help="Number of databases to backup at once", type="int", default=1),
         make_option("-z", "--compress", help="Compress the backup files", action="store_true", default=False),
+        make_option("--codec", help="Compression codec to use (default: DBBACKUP_COMPRESSION)"),
+        make_option("--compress-level", help="Compression level for the codec", type="int"),
+        make_option("--compress-threads", help="Compress on this many threads (gzip and zstd)", type="int"),
         make_option("-e", "--encrypt", help="Encrypt the backup files", action="store_true", default=False),
+        make_option("--stream", help="Stream the backup to the storage without a local temporary file",
+                    action="store_true", default=False),
+        make_option("--adaptive", help="Adapt the compression level to the upload speed (requires --stream)",
+                    action="store_true", default=False),
+        make_option("--dedup", help="Only store the parts of the backup not stored by previous backups",
+                    action="store_true", default=False),
     )
 
+    # Set on the backups of --parallel, which leave the unused dedup chunks
+    # to be deleted once they are all done
+    defer_garbage_collection = False
+    garbage_collection_due = False
+
+    def __init__(self):
+        LabelCommand.__init__(self)
+        self.run_metrics = metrics.Run('backup')
+
     @utils.email_uncaught_exception
     def handle(self, **options):
         """ Django command handler. """
@@ -40,66 +73,393 @@ class Command(LabelCommand):
             self.clean = options.get('clean')
             self.database = options.get('database')
             self.servername = options.get('servername')
-            self.compress = options.get('compress')
+            self.compress = options.get('compress') or bool(options.get('codec'))
+            self.codec = compression.get_codec(options.get('codec'), options.get('compress_level'),
+                                               options.get('compress_threads'))
             self.encrypt = options.get('encrypt')
+            self.stream = options.get('stream')
+            self.adaptive = options.get('adaptive')
+            self.dedup = options.get('dedup')
+            if self.adaptive and not self.stream:
+                raise CommandError("--adaptive requires --stream.")
+            if self.dedup and (self.encrypt or self.stream):
+                raise CommandError("--dedup cannot be combined with --encrypt or --stream.")
+            self.compress = self.compress or self.adaptive
             self.storage = BaseStorage.storage_factory()
+            self.catalog = catalog.Catalog(self.storage)
             database_keys = (self.database,) if self.database else DATABASE_KEYS
+            if options.get('parallel') > 1 and len(database_keys) > 1:
+                return self.backup_databases_in_parallel(database_keys, options['parallel'])
             for database_key in database_keys:
-                database = settings.DATABASES[database_key]
-                self.dbcommands = DBCommands(database)
-                self.save_new_backup(database)
-                self.cleanup_old_backups(database)
+                self.backup_database(database_key)
         except StorageError, err:
             raise CommandError(err)
 
+    def backup_database(self, database_key):
+        """ Save a new backup of a database and clean up its old backups. """
+        database = settings.DATABASES[database_key]
+        self.database_key = database_key
+        self.dbcommands = DBCommands(database)
+        self.run_metrics = metrics.Run('backup', database_key)
+        self.garbage_collection_due = False
+        try:
+            self.save_new_backup(database)
+            self.cleanup_old_backups(database)
+        except:
+            self.run_metrics.finish(False)
+            raise
+        self.run_metrics.finish(True)
+
+    def backup_databases_in_parallel(self, database_keys, workers):
+        """ Backup the databases on a pool of worker threads, running at
+        most DBBACKUP_PARALLEL_PER_HOST backups against the same server. The
+        output of each backup is printed in one piece when it finishes, and
+        a failed backup does not stop the others. Unused dedup chunks are
+        only deleted once every backup is done, as a backup still running
+        has chunks no recipe refers to yet.
+        """
+        scheduler = utils.HostScheduler(database_keys, PARALLEL_PER_HOST)
+        output = utils.ThreadedOutput(sys.stdout)
+        print_lock = threading.Lock()
+        failures = []
+        garbage_collection_due = []
+
+        def worker():
+            while True:
+                database_key = scheduler.next()
+                if database_key is None:
+                    return
+                output.capture()
+                try:
+                    job = copy.copy(self)
+                    job.storage = BaseStorage.storage_factory()
+                    job.catalog = catalog.Catalog(job.storage)
+                    job.defer_garbage_collection = True
+                    job.backup_database(database_key)
+                    if job.garbage_collection_due:
+                        garbage_collection_due.append(database_key)
+                except Exception:
+                    print "  Backup failed for %s:\n%s" % (database_key, traceback.format_exc())
+                    failures.append(database_key)
+                finally:
+                    scheduler.done(database_key)
+                    with print_lock:
+                        output.stream.write(output.release())
+
+        sys.stdout = output
+        try:
+            threads = [threading.Thread(target=worker) for _ in range(min(workers, len(database_keys)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.stdout = output.stream
+        print "Backed up %s of %s databases" % (len(database_keys) - len(failures), len(database_keys))
+        if garbage_collection_due:
+            print "Cleaning Unused Chunks"
+            self.collect_garbage()
+        if failures:
+            raise CommandError("Backup failed for: %s" % ', '.join(failures))
+
     def save_new_backup(self, database):
         """ Save a new backup file. """
         print "Backing Up Database: %s" % database['NAME']
+        if self.dedup:
+            return self.dedup_new_backup(database)
+        if self.dbcommands.settings.backup_format == 'tables':
+            return self.save_tables_backup(database)
+        if self.dbcommands.settings.backup_format == 'incremental' and self.dbcommands.engine == 'mysql':
+            return self.save_binlog_backup(database)
+        if self.dbcommands.settings.backup_format == 'incremental':
+            return self.save_incremental_backup(database)
+        if self.stream:
+            return self.stream_new_backup(database)
         output_file = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        output_file.name = self.dbcommands.filename(self.servername)
-        self.dbcommands.run_backup_commands(output_file)
+        output_file.name = self.dbcommands.filepath(self.servername)
+        with self.run_metrics.timed('dump') as stage:
+            self.dbcommands.run_backup_commands(output_file)
+            stage.bytes_out += metrics.file_size(output_file)
 
         if self.compress:
-            compressed_file = self.compress_file(output_file)
+            with self.run_metrics.timed('compress') as stage:
+                compressed_file = self.compress_file(output_file)
+                stage.bytes_in += metrics.file_size(output_file)
+                stage.bytes_out += metrics.file_size(compressed_file)
             output_file.close()
             output_file = compressed_file
 
         if self.encrypt:
-            encrypted_file = utils.encrypt_file(output_file)
+            with self.run_metrics.timed('encrypt') as stage:
+                encrypted_file = utils.encrypt_file(output_file)
+                stage.bytes_in += metrics.file_size(output_file)
+                stage.bytes_out += metrics.file_size(encrypted_file)
             output_file = encrypted_file
 
         print "  Backup tempfile created: %s (%s)" % (output_file.name, utils.handle_size(output_file))
         print "  Writing file to %s: %s" % (self.storage.name, self.storage.backup_dir())
-        self.storage.write_file(output_file)
+        retries = self.storage.retries
+        with self.run_metrics.timed('upload') as stage:
+            self.storage.write_file(output_file)
+            stage.bytes_in += metrics.file_size(output_file)
+            stage.bytes_out += metrics.file_size(output_file)
+            stage.retries += self.storage.retries - retries
+        checksum = catalog.file_checksum(output_file) if self.catalog.enabled else None
+        output_file.seek(0, 2)
+        self.record_backup(database, output_file.name, output_file.tell(), checksum)
+
+    def stream_new_backup(self, database, filename=None, chunks=None):
+        """ Stream a new backup from the dump commands, or the given chunks,
+        through compression and encryption straight into the storage. Return
+        the name of the backup in the storage.
+        """
+        filename = filename or self.dbcommands.filepath(self.servername)
+        chunks = self.run_metrics.meter('dump', pipeline.spool(chunks or self.dbcommands.stream_backup_commands()))
+        adaptive = None
+        if self.adaptive:
+            print "  Compressing with adaptive %s starting at level %s" % (self.codec.name, self.codec.level)
+            adaptive = compression.AdaptiveCompression(self.codec)
+            chunks = self.run_metrics.meter('compress', adaptive.compress(chunks), chunks)
+            filename += self.codec.extension
+        elif self.compress:
+            print "  Compressing with %s" % self.codec.describe()
+            chunks = self.run_metrics.meter('compress', self.codec.compress(chunks), chunks)
+            filename += self.codec.extension
+        if self.encrypt:
+            chunks = self.run_metrics.meter('encrypt', pipeline.gpg_encrypt(chunks), chunks)
+            filename += '.gpg'
+        counter = pipeline.ChunkCounter(chunks, 'md5' if self.catalog.enabled else None)
+        waiting = metrics.Meter(pipeline.prefetch(counter))
+        chunks = adaptive.upload(waiting) if adaptive else waiting
+        print "  Streaming file to %s: %s" % (self.storage.name, self.storage.backup_dir())
+        retries = self.storage.retries
+        with self.run_metrics.timed('upload') as stage:
+            self.storage.write_stream(filename, chunks)
+        # Not counting the time the upload waited for the stages before it
+        stage.seconds -= waiting.seconds
+        stage.bytes_in += waiting.bytes
+        stage.bytes_out += waiting.bytes
+        stage.retries += self.storage.retries - retries
+        print "  Backup streamed: %s (%s)" % (filename, utils.bytes_to_str(counter.bytes))
+        self.record_backup(database, filename, counter.bytes, counter.hexdigest())
+        if adaptive:
+            for line in adaptive.report():
+                print "  %s" % line
+        return filename
+
+    def save_incremental_backup(self, database):
+        """ Save the pages of the SQLite database changed since its previous
+        backup, or a full backup every DBBACKUP_SQLITE_FULL_EVERY backups or
+        if the page map kept next to the database is not that of the latest
+        backup.
+        """
+        extension = self.dbcommands.settings.EXTENSION
+        filepaths = self.catalog.list_directory(self.dbcommands.directory(self.servername))
+        filepaths = self.dbcommands.filter_filepaths(filepaths, self.servername)
+        page_map = sqlite_pages.load_page_map(database['NAME'])
+        with self.dbcommands.dump_directory():
+            snapshot = self.dbcommands.sqlite_snapshot(database['NAME'])
+            size = sqlite_pages.page_size(snapshot)
+            digests = sqlite_pages.page_digests(snapshot, size)
+            description = page_map[0] if page_map else None
+            if (description and filepaths and description['backup'] == filepaths[-1] and
+                    description['page_size'] == size and description['increments'] < sqlite_pages.SQLITE_FULL_EVERY):
+                pages = sqlite_pages.changed_pages(digests, page_map[1])
+                print "  %s of %s pages changed" % (len(pages), len(digests))
+                filename = self.dbcommands.filepath(self.servername, extension + chains.INCREMENTAL_SUFFIX)
+                chunks = sqlite_pages.write_delta(snapshot, size, len(digests), pages, os.path.basename(filepaths[-1]))
+                increments = description['increments'] + 1
+            else:
+                print "  Saving a full backup"
+                filename = self.dbcommands.filepath(self.servername)
+                chunks = None
+                increments = 0
+            with open(snapshot, 'rb') as snapshot_file:
+                filename = self.stream_new_backup(database, filename, chunks or pipeline.iter_file(snapshot_file))
+        sqlite_pages.save_page_map(database['NAME'], {
+            'backup': os.path.join(self.storage.backup_dir(), filename),
+            'page_size': size,
+            'increments': increments,
+        }, digests)
 
-    def cleanup_old_backups(self, database):
-        """ Cleanup old backups, keeping the number of backups specified by
-        DBBACKUP_CLEANUP_KEEP and any backups that occur on first of the month.
+    def save_binlog_backup(self, database):
+        """ Save the binary log written since the previous backup of the
+        MySQL database, or a full backup every DBBACKUP_MYSQL_FULL_EVERY
+        backups or if the position recorded for the database alias is not
+        that of the latest backup. Either way the position the backup ends
+        at is recorded.
+        """
+        filepaths = self.catalog.list_directory(self.dbcommands.directory(self.servername))
+        filepaths = self.dbcommands.filter_filepaths(filepaths, self.servername)
+        position = mysql_binlog.load_position(self.storage, self.database_key)
+        log_files = None
+        if (position and filepaths and position['backup'] == filepaths[-1] and
+                position['increments'] < mysql_binlog.MYSQL_FULL_EVERY):
+            logs = mysql_binlog.parse_binary_logs(self.query(self.dbcommands.settings.flush_logs_command()))
+            log_files = mysql_binlog.logs_since(logs, position['file'])
+            if log_files is None:
+                print "  Binary log %s was purged" % position['file']
+        if log_files is not None:
+            print "  Saving %s binary log files since %s:%s" % (len(log_files), position['file'], position['position'])
+            filename = self.dbcommands.filepath(self.servername, self.dbcommands.settings.EXTENSION +
+                                                mysql_binlog.INCREMENTAL_EXTENSION)
+            with self.dbcommands.dump_directory() as dump_dir:
+                os.mkdir(os.path.join(dump_dir, 'dump'))
+                if log_files:
+                    command = self.dbcommands.settings.binlog_copy_command(log_files)
+                    self.dbcommands.run_command(self.dbcommands.translate_command(command))
+                mysql_binlog.write_description(dump_dir, {
+                    'base': os.path.basename(filepaths[-1]),
+                    'start': [position['file'], position['position']],
+                    'end': [logs[-1], 4],
+                    'files': log_files,
+                })
+                command = self.dbcommands.translate_command(shlex.split(TAR_DUMP_COMMAND))
+                filename = self.stream_new_backup(database, filename, self.dbcommands.stream_command(command))
+            end, increments = (logs[-1], 4), position['increments'] + 1
+        else:
+            print "  Saving a full backup"
+            scanner = mysql_binlog.PositionScanner(self.dbcommands.stream_backup_commands())
+            filename = self.stream_new_backup(database, None, scanner)
+            if scanner.position is None:
+                raise CommandError("No binary log position found in the dump, is the binary log enabled?")
+            end, increments = scanner.position, 0
+        mysql_binlog.save_position(self.storage, self.database_key, {
+            'backup': os.path.join(self.storage.backup_dir(), filename),
+            'file': end[0],
+            'position': end[1],
+            'increments': increments,
+        })
+
+    def save_tables_backup(self, database):
+        """ Save the schema of the database and the data of the tables changed
+        since its previous backup, referring the other tables to the backups
+        holding their data. Every DBBACKUP_TABLES_FULL_EVERY backups, or
+        without a previous backup of this format, every table is dumped.
+        """
+        engine = self.dbcommands.settings
+        filepaths = self.catalog.list_directory(self.dbcommands.directory(self.servername))
+        filepaths = [path for path in self.dbcommands.filter_filepaths(filepaths, self.servername)
+                     if '.%s' % engine.EXTENSION in os.path.basename(path)]
+        previous = None
+        if filepaths:
+            previous = table_dump.read_manifest(compression.read_backup(self.storage, filepaths[-1],
+                                                                        self.run_metrics))
+        full = (not previous or previous['increments'] >= table_dump.TABLES_FULL_EVERY or
+                previous['detection'] != table_dump.TABLES_CHANGE_DETECTION)
+        indicators = table_dump.parse_lines(self.query(engine.table_list_command()))
+        hints = {}
+        if table_dump.TABLES_CHANGE_DETECTION == 'checksum' and indicators:
+            indicators = self.table_checksums(sorted(indicators))
+        elif engine.table_stats_are_hints:
+            hints, indicators = indicators, dict.fromkeys(indicators)
+            unchanged = table_dump.unchanged_hints(hints, previous, full)
+            if unchanged:
+                print "  Checking %s tables with unchanged statistics" % len(unchanged)
+                indicators.update(self.table_checksums(unchanged))
+        tables, changed = table_dump.plan(indicators, previous, full)
+        if full:
+            print "  Saving a full backup of %s tables" % len(changed)
+        else:
+            print "  Saving %s changed tables of %s" % (len(changed), len(indicators))
+        filename = self.dbcommands.filepath(self.servername, table_dump.filename_extension(engine.EXTENSION, not full))
+        sequences = []
+        if engine.sequence_list_command() and not full:
+            sequences = sorted(table_dump.parse_lines(self.query(engine.sequence_list_command())))
+        with self.dbcommands.dump_directory() as dump_dir:
+            os.makedirs(os.path.join(dump_dir, 'dump', 'schema'))
+            os.makedirs(os.path.join(dump_dir, 'dump', 'data'))
+            for section, command in engine.schema_dump_commands():
+                with open(os.path.join(dump_dir, 'dump', 'schema', '%s.sql' % section), 'wb') as schema_file:
+                    self.dbcommands.run_command(self.dbcommands.translate_command(command), stdout=schema_file)
+            members = {}
+            if full or changed or sequences:
+                command = self.dbcommands.translate_command(engine.table_data_command(None if full else changed + sequences))
+                members = table_dump.split_data(self.dbcommands.stream_command(command), dump_dir,
+                                                engine.table_data_marker, engine.sequence_marker)
+            for name in changed:
+                tables[name] = {'indicator': indicators[name], 'hint': hints.get(name),
+                                'backup': os.path.basename(filename), 'member': members.get(name)}
+            table_dump.write_manifest(dump_dir, {
+                'version': table_dump.MANIFEST_VERSION,
+                'detection': table_dump.TABLES_CHANGE_DETECTION,
+                'increments': 0 if full else previous['increments'] + 1,
+                'tables': tables,
+            })
+            command = self.dbcommands.translate_command(table_dump.TAR_COMMAND)
+            self.stream_new_backup(database, filename, self.dbcommands.stream_command(command))
+
+    def table_checksums(self, tables):
+        """ Return the checksums of the rows of the tables by name. """
+        engine = self.dbcommands.settings
+        return engine.parse_checksums(table_dump.parse_lines(self.query(engine.table_checksum_command(tables))))
+
+    def query(self, command):
+        """ Run a query command and return its output. """
+        return ''.join(self.dbcommands.stream_command(self.dbcommands.translate_command(command)))
+
+    def dedup_new_backup(self, database):
+        """ Split a new backup into chunks and store those not stored by the
+        previous backups of the database, compressed, then its recipe.
+        """
+        filename = self.dbcommands.filepath(self.servername) + dedup.RECIPE_EXTENSION
+        recipes = [path for path in self.catalog.list_directory() if path.endswith(dedup.RECIPE_EXTENSION)]
+        codec = self.codec if self.compress else None
+        if codec:
+            print "  Compressing with %s" % codec.describe()
+        print "  Storing new chunks to %s: %s" % (self.storage.name, self.storage.backup_dir())
+        chunks = self.run_metrics.meter('dump', pipeline.spool(self.dbcommands.stream_backup_commands()))
+        retries = self.storage.retries
+        with self.run_metrics.timed('upload') as stage:
+            recipe, stored, stored_bytes = dedup.write_backup(self.storage, filename, chunks, codec, recipes)
+        stage.seconds -= chunks.seconds
+        stage.bytes_in += recipe['size']
+        stage.bytes_out += stored_bytes
+        stage.retries += self.storage.retries - retries
+        print "  Backup stored: %s (%s in %s chunks, %s new chunks of %s)" % (
+            filename, utils.bytes_to_str(recipe['size']), len(recipe['chunks']), stored, utils.bytes_to_str(stored_bytes))
+        self.record_backup(database, filename, recipe['size'], None)
+
+    def record_backup(self, database, filename, size, checksum):
+        """ Record the new backup in the catalog. """
+        self.catalog.add(os.path.join(self.storage.backup_dir(), filename),
+                         database=database['NAME'],
+                         server=self.servername or SERVER_NAME,
+                         timestamp=catalog.timestamp(),
+                         size=size,
+                         codec=self.codec.name if self.compress else None,
+                         encrypted=bool(self.encrypt),
+                         md5=checksum)
+
+    def cleanup_old_backups(self, database, dry_run=False):
+        """ Cleanup old backups, keeping those the retention policy of the
+        database asks for (see retention.get_policy()).
         """
         if self.clean:
             print "Cleaning Old Backups for: %s" % database['NAME']
-            filepaths = self.storage.list_directory()
-            filepaths = self.dbcommands.filter_filepaths(filepaths)
-            for filepath in sorted(filepaths[0:-CLEANUP_KEEP]):
-                regex = self.dbcommands.filename_match(self.servername, '(.*?)')
-                datestr = re.findall(regex, filepath)[0]
-                dateTime = datetime.datetime.strptime(datestr, DATE_FORMAT)
-                if int(dateTime.strftime("%d")) != 1:
-                    print "  Deleting: %s" % filepath
-                    self.storage.delete_file(filepath)
+            with self.run_metrics.timed('cleanup'):
+                filepaths = self.catalog.list_directory(self.dbcommands.directory(self.servername))
+                backups = self.dbcommands.dated_filepaths(filepaths, self.servername)
+                dependencies = chains.dependencies(backups, self.dbcommands.settings.EXTENSION)
+                deleted = retention.cleanup(self.catalog, backups, retention.get_policy(database), dry_run,
+                                            dependencies=dependencies)
+                if not dry_run and any(path.endswith(dedup.RECIPE_EXTENSION) for path in deleted):
+                    if self.defer_garbage_collection:
+                        self.garbage_collection_due = True
+                    else:
+                        self.collect_garbage()
+
+    def collect_garbage(self):
+        """ Delete the dedup chunks no backup refers to any more. """
+        count = dedup.collect_garbage(self.storage, self.catalog.list_directory())
+        if count is None:
+            print "  Backups are storing chunks, keeping the chunks no backup refers to until the next cleanup"
+        else:
+            print "  Deleted %s chunks no backup refers to" % count
 
     def compress_file(self, input_file):
-        """ Compress this file using gzip.
+        """ Compress this file using the selected codec.
         The input and the output are filelike objects.
         """
-        outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        outputfile.name = input_file.name + '.gz'
-
-        zipfile = gzip.GzipFile(fileobj=outputfile, mode="wb")
-        try:
-            input_file.seek(0)
-            zipfile.write(input_file.read())
-        finally:
-            zipfile.close()
-
-        return outputfile
\ No newline at end of file
+        print "  Compressing with %s" % self.codec.describe()
+        return self.codec.compress_file(input_file)
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Save a base backup of a PostgreSQL cluster, or restore one for point in time
+recovery from the WAL archived with dbbackup_wal_push.
+"""
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import catalog
+from ... import compression
+from ... import metrics
+from ... import retention
+from ... import wal
+from ...dbcommands import DBCommands
+from ...dbcommands import PostgreSQLSettings
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+from . import dbbackup
+
+
+class Command(BaseCommand):
+    help = "dbbackup_basebackup [-c] [-d <dbname>] [-s <servername>] [--codec <codec>] [--encrypt] | --restore -t <pgdata> [-f <filepath>] [--target-time <time>]"
+    option_list = BaseCommand.option_list + (
+        make_option("-c", "--clean", help="Clean up old base backups and the WAL only they need",
+                    action="store_true", default=False),
+        make_option("-d", "--database", help="Database whose server to back up (default: 'default')",
+                    default='default'),
+        make_option("-s", "--servername", help="Specifiy server name to include in backup filename"),
+        make_option("-z", "--compress", help="Compress the base backup", action="store_true", default=False),
+        make_option("--codec", help="Compression codec to use (default: DBBACKUP_COMPRESSION)"),
+        make_option("-e", "--encrypt", help="Encrypt the base backup", action="store_true", default=False),
+        make_option("--restore", help="Restore a base backup instead of saving one",
+                    action="store_true", default=False),
+        make_option("-f", "--filepath", help="Base backup to restore (default: the latest)"),
+        make_option("-t", "--target", help="Empty data directory to restore into"),
+        make_option("--target-time", help="Replay the WAL up to this time, e.g. '2014-05-01 12:00:00+00'"),
+    )
+
+    def handle(self, **options):
+        """ Django command handler. """
+        try:
+            database = settings.DATABASES[options['database']]
+            self.backup_command = dbbackup.Command()
+            self.backup_command.servername = options.get('servername')
+            self.backup_command.dbcommands = DBCommands(database)
+            if not isinstance(self.backup_command.dbcommands.settings, PostgreSQLSettings):
+                raise CommandError("Base backups are only supported for PostgreSQL databases.")
+            self.backup_command.storage = self.storage = BaseStorage.storage_factory()
+            self.backup_command.catalog = catalog.Catalog(self.storage)
+            self.backup_command.compress = options.get('compress') or bool(options.get('codec'))
+            self.backup_command.codec = compression.get_codec(options.get('codec'))
+            self.backup_command.encrypt = options.get('encrypt')
+            self.backup_command.adaptive = False
+            if options.get('restore') and not options.get('target'):
+                raise CommandError("--restore requires the data directory to restore into (-t).")
+            self.run_metrics = metrics.Run('basebackup_restore' if options.get('restore') else 'basebackup',
+                                           options['database'])
+            self.backup_command.run_metrics = self.run_metrics
+            try:
+                if options.get('restore'):
+                    self.restore_basebackup(options.get('filepath'), options['target'], options.get('target_time'))
+                else:
+                    self.save_basebackup(database)
+                    if options.get('clean'):
+                        self.cleanup_old_basebackups(database)
+            except:
+                self.run_metrics.finish(False)
+                raise
+            self.run_metrics.finish(True)
+        except StorageError, err:
+            raise CommandError(err)
+
+    def get_backup_file_list(self):
+        """ Return the (datetime, filepath) of the base backups, oldest first. """
+        dbcommands = self.backup_command.dbcommands
+        servername = self.backup_command.servername
+        filepaths = self.backup_command.catalog.list_directory(dbcommands.directory(servername))
+        return sorted(dbcommands.dated_filepaths(filepaths, servername, wal.BASEBACKUP_EXTENSION))
+
+    def save_basebackup(self, database):
+        """ Stream a new base backup into the storage. Its label is the name
+        of the backup, which PostgreSQL writes in the backup history file it
+        archives, so the WAL each base backup needs is known.
+        """
+        print "Backing Up Server of: %s" % database['NAME']
+        dbcommands = self.backup_command.dbcommands
+        filepath = dbcommands.filepath(self.backup_command.servername, extension=wal.BASEBACKUP_EXTENSION)
+        command = dbcommands.translate_command(dbcommands.settings.basebackup_command())
+        command.insert(-1, '--label=%s' % os.path.basename(filepath))
+        self.backup_command.stream_new_backup(database, filepath, dbcommands.stream_command(command))
+
+    def cleanup_old_basebackups(self, database):
+        """ Delete the base backups the retention policy does not keep, then
+        the WAL older than the oldest base backup kept.
+        """
+        print "Cleaning Old Base Backups for: %s" % database['NAME']
+        with self.run_metrics.timed('cleanup'):
+            backups = self.get_backup_file_list()
+            deleted = retention.cleanup(self.backup_command.catalog, backups, retention.get_policy(database))
+            kept = [os.path.basename(filepath) for _, filepath in backups if filepath not in deleted]
+            wal_filepaths = self.storage.list_directory(directory=wal.WAL_DIRECTORY)
+            starts = [start for label, start in wal.backup_start_segments(self.storage, wal_filepaths).items()
+                      if any(filename.startswith(label) for filename in kept)]
+            if not starts:
+                print "  No backup history file of a kept base backup found, keeping all the WAL"
+                return
+            oldest = wal.oldest_segment(starts)
+            obsolete = wal.obsolete_files(wal_filepaths, oldest)
+            if obsolete:
+                self.storage.delete_files(obsolete)
+            print "  Deleted %s WAL files older than %s" % (len(obsolete), oldest)
+
+    def restore_basebackup(self, filepath, target, target_time=None):
+        """ Extract the base backup into the data directory target and
+        configure PostgreSQL to replay the archived WAL when started.
+        """
+        if not filepath:
+            backups = self.get_backup_file_list()
+            if not backups:
+                raise CommandError("No base backups found in: %s" % self.storage.backup_dir())
+            filepath = backups[-1][1]
+        if os.path.isdir(target) and os.listdir(target):
+            raise CommandError("The data directory %s is not empty." % target)
+        if not os.path.isdir(target):
+            os.makedirs(target, 0700)
+        print "Restoring base backup into: %s" % target
+        print "  Restoring: %s" % filepath
+        chunks = compression.read_backup(self.storage, filepath, self.run_metrics)
+        with self.run_metrics.timed('restore'):
+            self.backup_command.dbcommands.feed_command(['tar', '--extract', '--file=-', '--directory=%s' % target, '<'],
+                                                        chunks)
+        wal.write_recovery_settings(target, target_time)
+        print "  Recovery configured%s, start PostgreSQL on %s to replay the WAL" % (
+            ' up to %s' % target_time if target_time else '', target)
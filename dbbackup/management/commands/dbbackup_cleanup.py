@@ -0,0 +1,53 @@
+"""
+Delete old backups according to the retention policy, without making a new
+backup.
+"""
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import catalog
+from ...dbcommands import DBCommands
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+from . import backup_media
+from . import dbbackup
+
+
+DATABASE_KEYS = getattr(settings, 'DBBACKUP_DATABASES', settings.DATABASES.keys())
+
+
+class Command(BaseCommand):
+    help = "dbbackup_cleanup [-d <dbname>] [-s <servername>] [--media] [--dry-run]"
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--database", help="Database to clean up (default: everything)"),
+        make_option("-s", "--servername", help="Clean up backups of a different servername"),
+        make_option("--media", help="Clean up the media backups instead of the databases",
+                    action="store_true", default=False),
+        make_option("--dry-run", help="Only print which backups would be kept and deleted",
+                    action="store_true", default=False),
+    )
+
+    def handle(self, **options):
+        """ Django command handler. """
+        try:
+            storage = BaseStorage.storage_factory()
+            if options.get('media'):
+                command = backup_media.Command()
+            else:
+                command = dbbackup.Command()
+                command.clean = True
+            command.servername = options.get('servername')
+            command.storage = storage
+            command.catalog = catalog.Catalog(storage)
+            if options.get('media'):
+                return command.cleanup_old_backups(options.get('dry_run'))
+            database_keys = (options['database'],) if options.get('database') else DATABASE_KEYS
+            for database_key in database_keys:
+                database = settings.DATABASES[database_key]
+                command.dbcommands = DBCommands(database)
+                command.cleanup_old_backups(database, options.get('dry_run'))
+        except StorageError, err:
+            raise CommandError(err)
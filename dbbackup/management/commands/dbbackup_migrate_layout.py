@@ -0,0 +1,63 @@
+"""
+Move backups of the flat layout into the directories of
+DBBACKUP_DIRECTORY_TEMPLATE.
+"""
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import catalog
+from ...dbcommands import DBCommands
+from ...dbcommands import DIRECTORY_TEMPLATE
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+
+
+DATABASE_KEYS = getattr(settings, 'DBBACKUP_DATABASES', settings.DATABASES.keys())
+
+
+class Command(BaseCommand):
+    help = "dbbackup_migrate_layout [-d <dbname>] [-s <servername>] [--dry-run]"
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--database", help="Database whose backups are moved (default: everything)"),
+        make_option("-s", "--servername", help="Move backups of a different servername"),
+        make_option("--dry-run", help="Only print where the backups would be moved",
+                    action="store_true", default=False),
+    )
+
+    def handle(self, **options):
+        """ Django command handler. """
+        if not DIRECTORY_TEMPLATE:
+            raise CommandError("Set DBBACKUP_DIRECTORY_TEMPLATE to the layout to migrate to.")
+        try:
+            self.servername = options.get('servername')
+            self.dry_run = options.get('dry_run')
+            self.storage = BaseStorage.storage_factory()
+            self.catalog = catalog.Catalog(self.storage)
+            _, filepaths = self.storage.list_partition()
+            database_keys = (options['database'],) if options.get('database') else DATABASE_KEYS
+            for database_key in database_keys:
+                self.migrate_database(settings.DATABASES[database_key], filepaths)
+        except StorageError, err:
+            raise CommandError(err)
+
+    def migrate_database(self, database, filepaths):
+        """ Move the flat layout backups of database into their directories. """
+        print "Migrating backups of database: %s" % database['NAME']
+        dbcommands = DBCommands(database)
+        moved = 0
+        for filepath in dbcommands.filter_filepaths(filepaths, self.servername):
+            try:
+                timestamp = dbcommands.filepath_datetime(filepath, self.servername)
+            except (IndexError, ValueError):
+                print "  Skipping backup without a date: %s" % filepath
+                continue
+            filename = '%s/%s' % (dbcommands.directory(self.servername, timestamp), os.path.basename(filepath))
+            print "  Moving: %s -> %s" % (filepath, filename)
+            if not self.dry_run:
+                self.catalog.move_file(filepath, filename)
+            moved += 1
+        print "  %s backups %s" % (moved, 'to move' if self.dry_run else 'moved')
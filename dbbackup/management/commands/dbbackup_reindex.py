@@ -0,0 +1,24 @@
+"""
+Rebuild the catalog of backups from a listing of the storage.
+"""
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import catalog
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+
+
+class Command(BaseCommand):
+    help = "dbbackup_reindex"
+
+    def handle(self, **options):
+        """ Django command handler. """
+        try:
+            storage = BaseStorage.storage_factory()
+            backup_catalog = catalog.Catalog(storage, enabled=True)
+            print "Listing backups in %s: %s" % (storage.name, storage.backup_dir())
+            entries = backup_catalog.reindex()
+            print "  Catalog written: %s (%s backups)" % (backup_catalog.filepath, len(entries))
+        except StorageError, err:
+            raise CommandError(err)
@@ -0,0 +1,85 @@
+"""
+Train a zstd dictionary on previous backups.
+"""
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import compression
+from ... import pipeline
+from ... import utils
+from ...dbcommands import DBCommands
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+
+
+DATABASE_KEYS = getattr(settings, 'DBBACKUP_DATABASES', settings.DATABASES.keys())
+SAMPLE_SIZE = 128 * 1024
+
+
+class Command(BaseCommand):
+    help = "dbbackup_train_dictionary [-d <dbname>] [-s <servername>] [-n <count>] [--size <bytes>] [-o <filepath>]"
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--database", help="Database whose backups are used (default: everything)"),
+        make_option("-s", "--servername", help="Use backups of a different servername"),
+        make_option("-n", "--count", help="Number of recent backups per database to sample", type="int", default=50),
+        make_option("--sample-bytes", help="Bytes to sample from each backup", type="int", default=1024 * 1024),
+        make_option("--size", help="Size of the dictionary in bytes", type="int", default=112640),
+        make_option("-o", "--output", help="Dictionary file to write (default: DBBACKUP_ZSTD_DICTIONARY)"),
+    )
+
+    def handle(self, **options):
+        """ Django command handler. """
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError("Training a dictionary requires the zstandard package.")
+        output = options.get('output') or compression.ZSTD_DICTIONARY
+        if not output:
+            raise CommandError("Specify the dictionary file with --output or DBBACKUP_ZSTD_DICTIONARY.")
+        try:
+            self.storage = BaseStorage.storage_factory()
+            database_keys = (options['database'],) if options.get('database') else DATABASE_KEYS
+            filepaths = self.storage.list_directory()
+            samples = []
+            for database_key in database_keys:
+                dbcommands = DBCommands(settings.DATABASES[database_key])
+                backups = dbcommands.filter_filepaths(filepaths, options.get('servername'))
+                for filepath in backups[-options['count']:]:
+                    samples.extend(self.read_samples(filepath, options['sample_bytes']))
+        except StorageError, err:
+            raise CommandError(err)
+        if not samples:
+            raise CommandError("No unencrypted backups found to train on.")
+        print "Training a %s dictionary on %s samples" % (utils.bytes_to_str(options['size']), len(samples))
+        try:
+            dictionary = zstandard.train_dictionary(options['size'], samples)
+        except zstandard.ZstdError, err:
+            raise CommandError("Dictionary training failed, try sampling more backups: %s" % err)
+        with open(output, 'wb') as f:
+            f.write(dictionary.as_bytes())
+        print "  Dictionary written: %s" % output
+
+    def read_samples(self, filepath, sample_bytes):
+        """ Return the first sample_bytes of the backup, split into samples. """
+        if filepath.endswith('.gpg'):
+            print "  Skipping encrypted backup: %s" % filepath
+            return []
+        print "  Sampling: %s" % filepath
+        chunks = self.storage.read_stream(filepath)
+        codec = compression.get_codec_by_extension(filepath)
+        if codec:
+            chunks = codec.decompress(chunks)
+        samples = []
+        remaining = sample_bytes
+        try:
+            for sample in pipeline.rechunk(chunks, SAMPLE_SIZE):
+                samples.append(sample[:remaining])
+                remaining -= len(samples[-1])
+                if remaining <= 0:
+                    break
+        finally:
+            chunks.close()
+        return samples
@@ -0,0 +1,31 @@
+"""
+Fetch an archived PostgreSQL WAL file from the storage. Set it as the
+restore_command of PostgreSQL.
+"""
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import wal
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+from ...storage.base import StorageFileNotFound
+
+
+class Command(BaseCommand):
+    help = "dbbackup_wal_fetch <walname> <destination>"
+    args = "<walname> <destination>"
+
+    def handle(self, *args, **options):
+        """ Django command handler. A WAL file not archived makes the command
+        fail, which tells PostgreSQL the end of the archive is reached.
+        """
+        if len(args) != 2:
+            raise CommandError("Usage: %s" % self.help)
+        name, destination = args
+        try:
+            wal.fetch(BaseStorage.storage_factory(), name, destination)
+        except StorageFileNotFound:
+            raise CommandError("WAL file %s is not archived" % name)
+        except StorageError, err:
+            raise CommandError(err)
+        wal.prefetch_in_background(name, destination)
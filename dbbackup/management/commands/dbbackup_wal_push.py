@@ -0,0 +1,30 @@
+"""
+Archive a PostgreSQL WAL file to the storage. Set it as the archive_command
+of PostgreSQL.
+"""
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import wal
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+
+
+class Command(BaseCommand):
+    help = "dbbackup_wal_push <path>"
+    args = "<path>"
+
+    def handle(self, *args, **options):
+        """ Django command handler. """
+        if len(args) != 1:
+            raise CommandError("Usage: %s" % self.help)
+        path = args[0]
+        if not os.path.isfile(path):
+            raise CommandError("WAL file not found: %s" % path)
+        try:
+            paths = wal.push(BaseStorage.storage_factory, path)
+        except StorageError, err:
+            raise CommandError(err)
+        print "Archived: %s" % ', '.join(os.path.basename(pushed) for pushed in paths)
@@ -3,12 +3,23 @@ Restore pgdump files from Dropbox.
 See __init__.py for a list of options.
 """
 import os
-import stat
+import shlex
 import tempfile
-import gzip
+from shutil import copyfileobj
 
+from ... import catalog
+from ... import chains
+from ... import compression
+from ... import dedup
+from ... import metrics
+from ... import mysql_binlog
+from ... import pipeline
+from ... import sqlite_pages
+from ... import table_dump
 from ... import utils
 from ...dbcommands import DBCommands
+from ...dbcommands import DIRECTORY_TEMPLATE
+from ...dbcommands import UNTAR_DUMP_COMMAND
 from ...storage.base import BaseStorage
 from ...storage.base import StorageError
 from django.conf import settings
@@ -18,37 +29,42 @@ from django.core.management.base import LabelCommand
 from django.db import connection
 from optparse import make_option
 
-def is_gpg_agent_running():
-    """ Check if gpg agent is running """
-    if 'GPG_AGENT_INFO' not in os.environ:
-        return False
-
-    # Example GPG_AGENT_INFO:
-    # /Users/lorin/.gnupg/S.gpg-agent:192:1
-    socket = os.environ['GPG_AGENT_INFO'].split(':')[0]
-    # Verify it's there and it's a socket
-    return os.path.exists(socket) and stat.S_ISSOCK(os.stat(socket).st_mode)
-
-
-
 class Command(LabelCommand):
-    help = "dbrestore [-d <dbname>] [-f <filename>] [-s <servername>]"
+    help = "dbrestore [-d <dbname>] [-f <filename>] [-s <servername>] [--stream] [--target-time <time> | --target-position <file>:<offset>]"
     option_list = BaseCommand.option_list + (
         make_option("-d", "--database", help="Database to restore"),
         make_option("-f", "--filepath", help="Specific file to backup from"),
         make_option("-s", "--servername", help="Use a different servername backup"),
+        make_option("--stream", help="Stream the backup from the storage without a local temporary file",
+                    action="store_true", default=False),
+        make_option("--target-time", help="Replay the MySQL binary log up to this time, e.g. '2014-05-01 12:00:00'"),
+        make_option("--target-position", help="Replay the MySQL binary log up to this position, e.g. mysql-bin.000012:4711"),
     )
 
+    def __init__(self):
+        LabelCommand.__init__(self)
+        self.run_metrics = metrics.Run('restore')
+
     def handle(self, **options):
         """ Django command handler. """
         try:
             connection.close()
             self.filepath = options.get('filepath')
             self.servername = options.get('servername')
+            self.stream = options.get('stream')
+            self.target_time = options.get('target_time')
+            self.target_position = options.get('target_position')
             self.database = self._get_database(options)
             self.storage = BaseStorage.storage_factory()
+            self.catalog = catalog.Catalog(self.storage)
             self.dbcommands = DBCommands(self.database)
-            self.restore_backup()
+            self.run_metrics = metrics.Run('restore', self.database_key)
+            try:
+                self.restore_backup()
+            except:
+                self.finish_metrics(False)
+                raise
+            self.finish_metrics(True)
         except StorageError, err:
             raise CommandError(err)
 
@@ -61,57 +77,209 @@ class Command(LabelCommand):
                 errmsg += " must specify the --database option."
                 raise CommandError(errmsg)
             database_key = settings.DATABASES.keys()[0]
+        self.database_key = database_key
         return settings.DATABASES[database_key]
 
+    def finish_metrics(self, success):
+        """ Finish the metrics of the restore, with the retries of the storage. """
+        self.run_metrics.stage('download').retries += self.storage.retries
+        self.run_metrics.finish(success)
+
     def restore_backup(self):
         """ Restore the specified database. """
         print "Restoring backup for database: %s" % self.database['NAME']
         # Fetch the latest backup if filepath not specified
         if not self.filepath:
             print "  Finding latest backup"
-            filepaths = self.storage.list_directory()
-            filepaths = self.dbcommands.filter_filepaths(filepaths, self.servername)
-            if not filepaths:
+            self.filepath = self.find_latest_backup()
+            if not self.filepath:
                 raise CommandError("No backup files found in: %s" % self.storage.backup_dir())
-            self.filepath = filepaths[-1]
         # Restore the specified filepath backup
         print "  Restoring: %s" % self.filepath
+        if self.filepath.endswith(dedup.RECIPE_EXTENSION):
+            return self.dedup_restore()
+        if self.is_tables_backup(self.filepath):
+            return self.tables_restore()
+        if chains.is_incremental(self.filepath, self.dbcommands.settings.EXTENSION):
+            if self.dbcommands.engine == 'mysql':
+                return self.binlog_restore()
+            return self.incremental_restore()
+        if self.stream:
+            return self.stream_restore()
         input_filename = self.filepath
-        inputfile = self.storage.read_file(input_filename)
+        with self.run_metrics.timed('download') as stage:
+            inputfile = self.storage.read_file(input_filename)
+            stage.bytes_out += metrics.file_size(inputfile)
         if self.get_extension(input_filename) == '.gpg':
-            unencrypted_file = self.unencrypt_file(inputfile)
+            with self.run_metrics.timed('decrypt') as stage:
+                unencrypted_file = self.unencrypt_file(inputfile)
+                stage.bytes_in += metrics.file_size(inputfile)
+                stage.bytes_out += metrics.file_size(unencrypted_file)
             inputfile.close()
             inputfile = unencrypted_file
             input_filename = inputfile.name
-        if self.get_extension(input_filename) == '.gz':
-            uncompressed_file = self.uncompress_file(inputfile)
+        inputfile.seek(0)
+        codec = self.get_codec(input_filename, inputfile.read(16))
+        if codec:
+            with self.run_metrics.timed('decompress') as stage:
+                uncompressed_file = self.uncompress_file(inputfile, codec)
+                stage.bytes_in += metrics.file_size(inputfile)
+                stage.bytes_out += metrics.file_size(uncompressed_file)
             inputfile.close()
             inputfile = uncompressed_file
         print "  Restore tempfile created: %s" % utils.handle_size(inputfile)
-        self.dbcommands.run_restore_commands(inputfile)
+        with self.run_metrics.timed('restore') as stage:
+            stage.bytes_in += metrics.file_size(inputfile)
+            self.dbcommands.run_restore_commands(inputfile)
+
+    def find_latest_backup(self):
+        """ Return the latest backup, listing only the most recent directories
+        of the partitioned layout if it is used. Without a catalog, or if the
+        partitions hold no backup, the whole storage is listed.
+        """
+        if DIRECTORY_TEMPLATE and not self.catalog.enabled:
+            regex = self.dbcommands.filename_match(self.servername, '.*?')
+            latest = self.storage.latest_backup(regex, self.dbcommands.directory(self.servername))
+            if latest:
+                return latest
+        filepaths = self.catalog.list_directory()
+        filepaths = self.dbcommands.filter_filepaths(filepaths, self.servername)
+        return filepaths[-1] if filepaths else None
+
+    def stream_restore(self):
+        """ Stream the backup from the storage through decryption and
+        decompression into the restore commands.
+        """
+        restored = self.stream_into_restore(self.read_stream(self.filepath))
+        print "  Restore streamed: %s" % utils.bytes_to_str(restored)
+
+    def stream_into_restore(self, chunks):
+        """ Feed the chunks into the restore commands as they arrive,
+        returning the number of bytes restored.
+        """
+        waiting = metrics.Meter(pipeline.prefetch(chunks))
+        with self.run_metrics.timed('restore') as stage:
+            self.dbcommands.stream_restore_commands(waiting)
+        # Not counting the time the restore waited for the stages before it
+        stage.seconds -= waiting.seconds
+        stage.bytes_in += waiting.bytes
+        return waiting.bytes
+
+    def read_stream(self, filepath):
+        """ Return the chunks of the backup at filepath, decrypted and
+        decompressed as they are downloaded.
+        """
+        return compression.read_backup(self.storage, filepath, self.run_metrics)
+
+    def incremental_restore(self):
+        """ Rebuild the SQLite database from the last full backup and the
+        incremental backups since, then restore it.
+        """
+        filepaths = self.dbcommands.filter_filepaths(self.catalog.list_directory(), self.servername)
+        if self.filepath not in filepaths:
+            filepaths = sorted(filepaths + [self.filepath], key=os.path.basename)
+        chain = chains.restore_chain(self.filepath, filepaths, self.dbcommands.settings.EXTENSION)
+        rebuilt = tempfile.TemporaryFile()
+        try:
+            print "  Rebuilding from: %s" % chain[0]
+            for chunk in self.read_stream(chain[0]):
+                rebuilt.write(chunk)
+            for base, filepath in zip(chain, chain[1:]):
+                print "  Applying: %s" % filepath
+                sqlite_pages.apply_delta(self.read_stream(filepath), rebuilt, os.path.basename(base))
+            rebuilt.seek(0)
+            restored = self.stream_into_restore(pipeline.iter_file(rebuilt))
+            print "  Restore streamed: %s" % utils.bytes_to_str(restored)
+        finally:
+            rebuilt.close()
+
+    def binlog_restore(self):
+        """ Restore the last full backup of the MySQL database, then replay
+        the binary log of the incremental backups since, up to the target
+        time or position if given.
+        """
+        filepaths = self.dbcommands.filter_filepaths(self.catalog.list_directory(), self.servername)
+        if self.filepath not in filepaths:
+            filepaths = sorted(filepaths + [self.filepath], key=os.path.basename)
+        chain = chains.restore_chain(self.filepath, filepaths, self.dbcommands.settings.EXTENSION)
+        target = mysql_binlog.parse_position(self.target_position) if self.target_position else None
+        print "  Restoring full backup: %s" % chain[0]
+        self.stream_into_restore(self.read_stream(chain[0]))
+        for base, filepath in zip(chain, chain[1:]):
+            print "  Replaying: %s" % filepath
+            with self.dbcommands.dump_directory() as dump_dir:
+                self.dbcommands.feed_command(self.dbcommands.translate_command(shlex.split(UNTAR_DUMP_COMMAND)),
+                                             self.read_stream(filepath))
+                description = mysql_binlog.read_description(dump_dir, os.path.basename(base))
+                log_files = description['files']
+                stop_position = None
+                if target and target[0] in log_files:
+                    log_files = log_files[:log_files.index(target[0]) + 1]
+                    stop_position = target[1]
+                replay = self.dbcommands.settings.binlog_replay_command(log_files, description['start'][1],
+                                                                        self.target_time, stop_position)
+                statements = self.dbcommands.stream_command(self.dbcommands.translate_command(replay))
+                with self.run_metrics.timed('restore'):
+                    self.dbcommands.feed_command(
+                        self.dbcommands.translate_command(self.dbcommands.settings.import_command()), statements)
+            if stop_position is not None:
+                print "  Reached position %s:%s" % target
+                return
+        if target:
+            raise CommandError("Position %s:%s is not in the binary log of %s" % (target[0], target[1], self.filepath))
+
+    def tables_restore(self):
+        """ Restore the schema of the backup, then the data of each table from
+        the backup its manifest refers it to, in one stream into the restore
+        commands.
+        """
+        filepaths = self.dbcommands.filter_filepaths(self.catalog.list_directory(), self.servername)
+        if self.filepath not in filepaths:
+            filepaths = sorted(filepaths + [self.filepath], key=os.path.basename)
+        manifest = table_dump.read_manifest(self.read_stream(self.filepath))
+        wanted = table_dump.sources(manifest, self.filepath, filepaths)
+        for filepath in sorted(wanted):
+            if filepath != self.filepath:
+                print "  Reading tables from: %s" % filepath
+        restored = self.stream_into_restore(table_dump.assemble(self.filepath, wanted, self.read_stream))
+        print "  Restore streamed: %s" % utils.bytes_to_str(restored)
+
+    def dedup_restore(self):
+        """ Stream the chunks of a deduplicated backup, fetched several at
+        once, into the restore commands.
+        """
+        chunks = self.run_metrics.meter('download', dedup.read_backup(self.storage, self.filepath))
+        restored = self.stream_into_restore(chunks)
+        print "  Restore streamed: %s" % utils.bytes_to_str(restored)
+
+    def is_tables_backup(self, filepath):
+        """ Return whether the backup at filepath is of the tables format,
+        whatever the format of the database is set to now.
+        """
+        engine = self.dbcommands.settings
+        return hasattr(engine, 'get_tables_extension') and table_dump.is_tables_backup(
+            filepath, engine.get_tables_extension())
 
     def get_extension(self, filename):
         _, extension = os.path.splitext(filename)
         return extension
 
-    def uncompress_file(self, inputfile):
-        """ Uncompress this file using gzip. The input and the output are filelike objects. """
-        outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        zipfile = gzip.GzipFile(fileobj=inputfile, mode="rb")
-        try:
-            inputfile.seek(0)
-            outputfile.write(zipfile.read())
-        finally:
-            zipfile.close()
-        return outputfile
+    def get_codec(self, filename, head):
+        """ Return the codec the backup was compressed with, from the file
+        extension or the first bytes of the file, or None if uncompressed.
+        """
+        codec = compression.get_codec_by_extension(filename) or compression.get_codec_by_magic(head)
+        if codec:
+            print "  Decompressing with %s" % codec.name
+        return codec
+
+    def uncompress_file(self, inputfile, codec):
+        """ Uncompress this file using codec. The input and the output are filelike objects. """
+        return codec.decompress_file(inputfile)
 
     def unencrypt_file(self, inputfile):
         """ Unencrypt this file using gpg. The input and the output are filelike objects. """
         import gnupg
-        def get_passphrase():
-            print 'Input Passphrase: '
-            return raw_input()
-
         temp_dir = tempfile.mkdtemp()
         try:
             inputfile.fileno()   # Convert inputfile from SpooledTemporaryFile to regular file (Fixes Issue #21)
@@ -120,16 +288,13 @@ class Command(LabelCommand):
             try:
                 inputfile.seek(0)
                 # If there's an agent present, use it
-                if is_gpg_agent_running():
+                if utils.is_gpg_agent_running():
                     g = gnupg.GPG(use_agent=True)
                     result = g.decrypt_file(file=inputfile, output=temp_filename)
                 else:
                     # If there's no agent, we need to retrieve the passphrase
                     g = gnupg.GPG(use_agent=False)
-                    try:
-                        passphrase = os.environ['GPG_PASSPHRASE']
-                    except:
-                        passphrase=get_passphrase()
+                    passphrase = utils.get_passphrase()
                     result = g.decrypt_file(file=inputfile, passphrase=passphrase, output=temp_filename)
 
                 if not result:
@@ -138,7 +303,7 @@ class Command(LabelCommand):
                 outputfile.name = new_basename
                 f = open(temp_filename)
                 try:
-                    outputfile.write(f.read())
+                    copyfileobj(f, outputfile)
                 finally:
                     f.close()
             finally:
@@ -0,0 +1,98 @@
+"""
+Restore media files from a full, incremental or differential media backup.
+"""
+import os
+import shutil
+import tarfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ... import catalog
+from ... import compression
+from ... import media
+from ... import pipeline
+from ... import utils
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+from . import backup_media
+
+
+class Command(BaseCommand):
+    help = "restore_media [-f <filepath>] [-s <servername>] [-t <target>]"
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--filepath", help="Media backup to restore (default: the latest)"),
+        make_option("-s", "--servername", help="Use a different servername backup"),
+        make_option("-t", "--target", help="Directory to restore into (default: the media directory)"),
+    )
+
+    def handle(self, **options):
+        """ Django command handler. """
+        try:
+            self.backup_command = backup_media.Command()
+            self.backup_command.servername = options.get('servername')
+            self.storage = self.backup_command.storage = BaseStorage.storage_factory()
+            self.catalog = self.backup_command.catalog = catalog.Catalog(self.storage)
+            self.target = options.get('target') or self.backup_command.get_source_dir()
+            self.restore_mediafiles(options.get('filepath'))
+        except StorageError, err:
+            raise CommandError(err)
+
+    def restore_mediafiles(self, filepath=None):
+        """ Restore the media backup at filepath, after the full backup and
+        the incremental backups it is based on.
+        """
+        print "Restoring media files into: %s" % self.target
+        filepaths = [path for _, path in self.backup_command.get_backup_file_list()]
+        if not filepath:
+            if not filepaths:
+                raise CommandError("No media backups found in: %s" % self.storage.backup_dir())
+            filepath = filepaths[-1]
+        for backup_filepath, manifest in media.restore_chain(self.storage, filepath, filepaths):
+            print "  Restoring: %s" % backup_filepath
+            if manifest:
+                self.delete_files(manifest['deleted'])
+                root = manifest['root']
+            else:
+                root = self.backup_command.get_source_dir()
+            self.extract_backup(backup_filepath, root)
+
+    def delete_files(self, paths):
+        """ Delete the files deleted since the previous backup. """
+        for path in paths:
+            fullpath = os.path.join(self.target, path)
+            if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+                shutil.rmtree(fullpath)
+            elif os.path.lexists(fullpath):
+                os.unlink(fullpath)
+
+    def extract_backup(self, filepath, root):
+        """ Stream the backup from the storage through decryption and
+        decompression and extract it into the target directory. The members
+        are archived with their path under root, which is stripped.
+        """
+        chunks = pipeline.prefetch(self.storage.read_stream(filepath))
+        filename = filepath
+        if filename.endswith('.gpg'):
+            chunks = utils.gpg_decrypt(chunks)
+            filename = filename[:-len('.gpg')]
+        head, chunks = compression.peek(chunks)
+        codec = compression.get_codec_by_extension(filename) or compression.get_codec_by_magic(head)
+        if codec:
+            chunks = codec.decompress(chunks)
+        prefix = root.strip('/') + '/'
+        tar_file = tarfile.open(fileobj=pipeline.ChunkReader(chunks, filename), mode='r|')
+        try:
+            for member in tar_file:
+                if not member.name.startswith(prefix):
+                    continue
+                member.name = member.name[len(prefix):]
+                if member.islnk() and member.linkname.startswith(prefix):
+                    member.linkname = member.linkname[len(prefix):]
+                if os.path.isabs(member.name) or '..' in member.name.split('/'):
+                    print "  Skipping unsafe path: %s" % member.name
+                    continue
+                tar_file.extract(member, self.target)
+        finally:
+            tar_file.close()
@@ -0,0 +1,236 @@
+"""
+Incremental and differential media backups.
+Each media backup has a manifest next to it, recording the size, mtime and
+optionally md5 of every file in the media directory, the files deleted since
+the backup it is based on, and the name of that backup. Incremental backups
+are based on the previous backup, differential backups on the last full one.
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime
+
+from django.conf import settings
+
+from . import compression
+from . import governor
+from . import pipeline
+from . import utils
+from .storage.base import StorageError, StorageFileNotFound
+
+DATE_FORMAT = getattr(settings, 'DBBACKUP_DATE_FORMAT', '%Y-%m-%d-%H%M%S')
+MEDIA_FULL_EVERY = getattr(settings, 'DBBACKUP_MEDIA_FULL_EVERY', 7)
+MEDIA_HASH = getattr(settings, 'DBBACKUP_MEDIA_HASH', False)
+MEDIA_MANIFEST_DIR = getattr(settings, 'DBBACKUP_MEDIA_MANIFEST_DIR', None)
+
+FULL = 'full'
+INCREMENTAL = 'incremental'
+DIFFERENTIAL = 'differential'
+SUFFIXES = {FULL: '.media', INCREMENTAL: '.media-inc', DIFFERENTIAL: '.media-diff'}
+MANIFEST_VERSION = 1
+
+
+###################################
+#  Backup Names
+###################################
+
+def backup_regex(databasename, servername):
+    """ Return the regex matching media backups, with the date as first group. """
+    return re.compile(r'%s%s-(.*?)\.media(-inc|-diff)?\.tar' % (re.escape(databasename), re.escape(servername)))
+
+
+def list_backups(filepaths, databasename, servername):
+    """ Return the (datetime, filepath) of the media backups among filepaths,
+    sorted by date.
+    """
+    media_re = backup_regex(databasename, servername)
+    backups = []
+    for filepath in filepaths:
+        match = media_re.search(os.path.basename(filepath))
+        if match:
+            backups.append((datetime.strptime(match.group(1), DATE_FORMAT), filepath))
+    return sorted(backups)
+
+
+def backup_kind(filepath):
+    """ Return whether the media backup is full, incremental or differential. """
+    name = os.path.basename(filepath)
+    for kind, suffix in SUFFIXES.items():
+        if '%s.tar' % suffix in name:
+            return kind
+    return None
+
+
+def manifest_name(filepath):
+    """ Return the name of the manifest of a media backup. """
+    head, tail = filepath.rsplit('.tar', 1)
+    return head + '.json' + tail
+
+
+def dependencies(backups):
+    """ Return the backups each of the (datetime, filepath) backups needs to
+    be restored, guessed from their names.
+    """
+    needed = {}
+    last_full = None
+    chain = []
+    for _, filepath in sorted(backups):
+        kind = backup_kind(filepath)
+        if kind == FULL:
+            last_full = filepath
+            chain = []
+        elif kind == INCREMENTAL:
+            needed[filepath] = ([last_full] if last_full else []) + chain
+            chain.append(filepath)
+        elif kind == DIFFERENTIAL:
+            needed[filepath] = [last_full] if last_full else []
+            chain.append(filepath)
+    return needed
+
+
+###################################
+#  File State
+###################################
+
+def file_md5(path):
+    """ Return the md5 of the file at path. """
+    filehash = hashlib.md5()
+    with open(path, 'rb') as filehandle:
+        for chunk in pipeline.iter_file(filehandle):
+            governor.throttle_media_read(len(chunk))
+            filehash.update(chunk)
+    return filehash.hexdigest()
+
+
+def scan(source_dir, base_files=None, use_hash=MEDIA_HASH):
+    """ Return the state of the files under source_dir as a dictionary of
+    {relative path: [size, mtime, md5]}. With use_hash, the md5 of the files
+    whose size and mtime match base_files is taken from there.
+    """
+    base_files = base_files or {}
+    if not isinstance(source_dir, unicode):
+        # Unicode paths, to match those of the manifests
+        source_dir = source_dir.decode(sys.getfilesystemencoding() or 'utf-8')
+    files = {}
+    for root, dirnames, filenames in os.walk(source_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            info = os.lstat(path)
+            relpath = os.path.relpath(path, source_dir)
+            state = [info.st_size, info.st_mtime, None]
+            base = base_files.get(relpath)
+            if use_hash:
+                if base and base[:2] == state[:2]:
+                    state[2] = base[2]
+                elif not os.path.islink(path):
+                    state[2] = file_md5(path)
+            files[relpath] = state
+    return files
+
+
+def compare(files, base_files):
+    """ Return the paths changed or added, and the paths deleted, since
+    base_files. Files whose mtime changed but whose md5 did not are unchanged.
+    """
+    changed = []
+    for path, state in sorted(files.iteritems()):
+        base = base_files.get(path)
+        if base is None or (base[:2] != state[:2] and (state[2] is None or state[2] != base[2])):
+            changed.append(path)
+    deleted = sorted(set(base_files) - set(files))
+    return changed, deleted
+
+
+###################################
+#  Manifests
+###################################
+
+def new_manifest(filename, kind, source_dir, files, base=None, deleted=None):
+    """ Return the manifest of a new media backup. base is the (filepath,
+    manifest) of the backup it is based on.
+    """
+    return {
+        'version': MANIFEST_VERSION,
+        'type': kind,
+        'root': source_dir,
+        'base': os.path.basename(base[0]) if base else None,
+        'full': base[1]['full'] if base else os.path.basename(filename),
+        'files': files,
+        'deleted': deleted or [],
+    }
+
+
+def write_manifest(storage, filename, manifest, codec, encrypt=False):
+    """ Write the manifest of a media backup, compressed with codec and
+    encrypted like the backup, and keep a copy in DBBACKUP_MEDIA_MANIFEST_DIR.
+    """
+    data = json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+    chunks = codec.compress([data])
+    if encrypt:
+        chunks = pipeline.gpg_encrypt(chunks)
+        filename += '.gpg'
+    storage.write_stream(filename, chunks)
+    if MEDIA_MANIFEST_DIR:
+        cache_manifest(os.path.basename(filename), data, manifest)
+    return filename
+
+
+def cache_manifest(filename, data, manifest):
+    """ Save the manifest in DBBACKUP_MEDIA_MANIFEST_DIR, keeping only the
+    manifests later backups can be based on.
+    """
+    if not os.path.isdir(MEDIA_MANIFEST_DIR):
+        os.makedirs(MEDIA_MANIFEST_DIR)
+    name = cached_manifest_name(filename)
+    with open(os.path.join(MEDIA_MANIFEST_DIR, name), 'wb') as manifest_file:
+        manifest_file.write(data)
+    keep = set([name, cached_manifest_name(manifest_name(manifest['full']))])
+    for cached in os.listdir(MEDIA_MANIFEST_DIR):
+        if cached not in keep and cached.endswith('.json'):
+            os.unlink(os.path.join(MEDIA_MANIFEST_DIR, cached))
+
+
+def cached_manifest_name(filename):
+    """ Return the name of a manifest in DBBACKUP_MEDIA_MANIFEST_DIR. """
+    return os.path.basename(filename).split('.json')[0] + '.json'
+
+
+def read_manifest(storage, filepath):
+    """ Return the manifest of the media backup at filepath, or None if it
+    has none, such as the backups of older versions.
+    """
+    filepath = manifest_name(filepath)
+    if MEDIA_MANIFEST_DIR:
+        cached = os.path.join(MEDIA_MANIFEST_DIR, cached_manifest_name(filepath))
+        if os.path.exists(cached):
+            with open(cached, 'rb') as manifest_file:
+                return json.load(manifest_file)
+    try:
+        _, chunks = compression.peek(storage.read_stream(filepath))
+    except StorageFileNotFound:
+        return None
+    if filepath.endswith('.gpg'):
+        chunks = utils.gpg_decrypt(chunks)
+    codec = compression.get_codec_by_extension(filepath[:-len('.gpg')] if filepath.endswith('.gpg') else filepath)
+    if codec:
+        chunks = codec.decompress(chunks)
+    try:
+        return json.loads(''.join(chunks))
+    except ValueError:
+        raise StorageError('Manifest %s is corrupt.' % filepath)
+
+
+def restore_chain(storage, filepath, filepaths):
+    """ Return the (filepath, manifest) of the backups to restore in order,
+    from the last full backup to the media backup at filepath.
+    """
+    by_name = dict((os.path.basename(path), path) for path in filepaths)
+    chain = [(filepath, read_manifest(storage, filepath))]
+    while chain[0][1] and chain[0][1]['type'] != FULL:
+        base = chain[0][1]['base']
+        if base not in by_name:
+            raise StorageError('Backup %s is based on %s, which is missing.' % (chain[0][0], base))
+        chain.insert(0, (by_name[base], read_manifest(storage, by_name[base])))
+    return chain
@@ -0,0 +1,265 @@
+"""
+Metrics of backup and restore runs.
+Each run records, per stage (dump, compress, encrypt, upload, cleanup,
+download, decrypt, decompress, restore), the seconds spent, the bytes in and
+out and the retries. When the run finishes they are sent as Django signals
+and exported to a Prometheus textfile and StatsD if configured.
+
+The stages of a streamed backup run at once, each stage counts the time
+spent in it alone: the time spent producing its chunks, less the time spent
+waiting for the stage before it.
+"""
+import os
+import re
+import socket
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import signals
+
+METRICS_TEXTFILE_DIRECTORY = getattr(settings, 'DBBACKUP_METRICS_TEXTFILE_DIRECTORY', None)
+METRICS_STATSD = getattr(settings, 'DBBACKUP_METRICS_STATSD', None)
+METRICS_PREFIX = getattr(settings, 'DBBACKUP_METRICS_PREFIX', 'dbbackup')
+
+STATSD_NAME = re.compile(r'[^A-Za-z0-9_-]')
+STATSD_PACKET_SIZE = 512
+PROMETHEUS_METRICS = (
+    ('run_success', 'gauge', 'Whether the last run succeeded.'),
+    ('run_timestamp_seconds', 'gauge', 'When the last run finished, in seconds since the epoch.'),
+    ('run_duration_seconds', 'gauge', 'Wall time of the last run.'),
+    ('compression_ratio', 'gauge', 'Bytes in over bytes out of the compression of the last run.'),
+    ('stage_duration_seconds', 'gauge', 'Time spent in each stage of the last run.'),
+    ('stage_bytes_in', 'gauge', 'Bytes each stage of the last run read.'),
+    ('stage_bytes_out', 'gauge', 'Bytes each stage of the last run wrote.'),
+    ('stage_throughput_bytes_per_second', 'gauge', 'Bytes each stage of the last run processed per second.'),
+    ('stage_retries', 'gauge', 'Requests each stage of the last run retried.'),
+)
+
+
+class Stage:
+    """ The metrics of one stage of a run. """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+
+    def throughput(self):
+        """ Bytes processed per second: read, or written by a stage reading nothing. """
+        return (self.bytes_in or self.bytes_out) / self.seconds if self.seconds > 0 else 0.0
+
+    def ratio(self):
+        """ Bytes in over bytes out. """
+        return float(self.bytes_in) / self.bytes_out if self.bytes_out else 0.0
+
+
+class Meter:
+    """ Pass chunks through unchanged while counting their bytes and the
+    seconds spent waiting for them.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        chunks = iter(self.chunks)
+        while True:
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.seconds += time.time() - start
+                return
+            self.seconds += time.time() - start
+            self.bytes += len(chunk)
+            yield chunk
+
+
+def file_size(filehandle):
+    """ Return the size of filehandle, keeping its position. """
+    position = filehandle.tell()
+    filehandle.seek(0, 2)
+    size = filehandle.tell()
+    filehandle.seek(position)
+    return size
+
+
+###################################
+#  Runs
+###################################
+
+class Run:
+    """ The metrics of the backup or restore (command) of a database alias. """
+
+    def __init__(self, command, database=None):
+        self.command = command
+        self.database = database
+        self.stages = OrderedDict()
+        self.meters = []
+        self.started = time.time()
+        self.finished = None
+        self.success = None
+
+    def stage(self, name):
+        """ Return the stage name, added on first use. """
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    @contextmanager
+    def timed(self, name):
+        """ Add the time spent in the block to the stage name, which the
+        block is given to record its bytes.
+        """
+        stage = self.stage(name)
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.time() - start
+
+    def meter(self, name, chunks, upstream=None):
+        """ Return chunks metered as the output of the stage name. Its input
+        is the output of upstream, a meter too, whose time is not counted in
+        the stage.
+        """
+        meter = Meter(chunks)
+        self.meters.append((self.stage(name), meter, upstream))
+        return meter
+
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    def finish(self, success):
+        """ Record the end of the run, then send and export its metrics. """
+        if self.finished:
+            return
+        for stage, meter, upstream in self.meters:
+            stage.bytes_out += meter.bytes
+            stage.bytes_in += upstream.bytes if upstream else 0
+            stage.seconds += max(0.0, meter.seconds - (upstream.seconds if upstream else 0.0))
+        self.meters = []
+        self.finished = time.time()
+        self.success = success
+        for stage in self.stages.values():
+            signals.stage_finished.send(sender=Run, run=self, stage=stage)
+        signals.run_finished.send(sender=Run, run=self)
+        try:
+            if METRICS_TEXTFILE_DIRECTORY:
+                write_textfile(self, METRICS_TEXTFILE_DIRECTORY)
+            if METRICS_STATSD:
+                send_statsd(self, METRICS_STATSD)
+        except (IOError, OSError, ValueError, socket.error), err:
+            print "  Could not export the metrics: %s" % err
+
+
+###################################
+#  Prometheus
+###################################
+
+def prometheus_labels(labels):
+    """ Return labels, a list of (name, value), in the Prometheus format. """
+    escaped = []
+    for name, value in labels:
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(escaped)
+
+
+def prometheus_samples(run):
+    """ Return the samples of the run by metric name, each a list of
+    (labels, value).
+    """
+    labels = [('command', run.command), ('database', run.database)]
+    samples = {
+        'run_success': [(labels, 1 if run.success else 0)],
+        'run_timestamp_seconds': [(labels, run.finished)],
+        'run_duration_seconds': [(labels, run.duration())],
+    }
+    if 'compress' in run.stages:
+        samples['compression_ratio'] = [(labels, run.stages['compress'].ratio())]
+    for stage in run.stages.values():
+        stage_labels = labels + [('stage', stage.name)]
+        samples.setdefault('stage_duration_seconds', []).append((stage_labels, stage.seconds))
+        samples.setdefault('stage_bytes_in', []).append((stage_labels, stage.bytes_in))
+        samples.setdefault('stage_bytes_out', []).append((stage_labels, stage.bytes_out))
+        samples.setdefault('stage_throughput_bytes_per_second', []).append((stage_labels, stage.throughput()))
+        samples.setdefault('stage_retries', []).append((stage_labels, stage.retries))
+    return samples
+
+
+def write_textfile(run, directory):
+    """ Write the metrics of the run into directory, for the textfile
+    collector of the Prometheus node exporter. Each command and database
+    alias has its own file, replaced atomically.
+    """
+    samples = prometheus_samples(run)
+    lines = []
+    for name, metric_type, description in PROMETHEUS_METRICS:
+        if name not in samples:
+            continue
+        lines.append('# HELP dbbackup_%s %s' % (name, description))
+        lines.append('# TYPE dbbackup_%s %s' % (name, metric_type))
+        for labels, value in samples[name]:
+            lines.append('dbbackup_%s%s %r' % (name, prometheus_labels(labels), float(value)))
+    filename = 'dbbackup_%s_%s.prom' % (run.command, STATSD_NAME.sub('_', run.database or ''))
+    handle, temp_path = tempfile.mkstemp(prefix='.%s.' % filename, dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, os.path.join(directory, filename))
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+###################################
+#  StatsD
+###################################
+
+def statsd_lines(run, prefix=METRICS_PREFIX):
+    """ Return the metrics of the run as StatsD lines, named
+    <prefix>.<command>.<database>[.<stage>].<metric>.
+    """
+    name = '.'.join(STATSD_NAME.sub('_', part) for part in (prefix, run.command, run.database or ''))
+    lines = ['%s.duration:%d|ms' % (name, run.duration() * 1000),
+             '%s.%s:1|c' % (name, 'success' if run.success else 'failure')]
+    if 'compress' in run.stages:
+        lines.append('%s.compression_ratio:%f|g' % (name, run.stages['compress'].ratio()))
+    for stage in run.stages.values():
+        stage_name = '%s.%s' % (name, STATSD_NAME.sub('_', stage.name))
+        lines += ['%s.duration:%d|ms' % (stage_name, stage.seconds * 1000),
+                  '%s.bytes_in:%d|g' % (stage_name, stage.bytes_in),
+                  '%s.bytes_out:%d|g' % (stage_name, stage.bytes_out),
+                  '%s.throughput:%d|g' % (stage_name, stage.throughput()),
+                  '%s.retries:%d|c' % (stage_name, stage.retries)]
+    return lines
+
+
+def send_statsd(run, address):
+    """ Send the metrics of the run to the StatsD server at address, given
+    as host:port, over UDP. Lines are grouped in packets small enough not to
+    be fragmented.
+    """
+    host, _, port = address.rpartition(':')
+    packets = []
+    for line in statsd_lines(run):
+        if packets and len(packets[-1]) + len(line) < STATSD_PACKET_SIZE:
+            packets[-1] += '\n' + line
+        else:
+            packets.append(line)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for packet in packets:
+            sock.sendto(packet, (host or 'localhost', int(port)))
+    finally:
+        sock.close()
@@ -0,0 +1,126 @@
+"""
+Incremental backups of MySQL databases from the binary log.
+A full backup is a mysqldump which rotates the binary log and records the
+position it starts at. An incremental backup rotates the binary log again
+and holds the files written since the previous backup, copied as they are
+with mysqlbinlog. A database is restored by loading the last full backup and
+replaying the binary logs since with mysqlbinlog, up to a target time or
+position if given. The position each database alias is backed up to is kept
+in DBBACKUP_MYSQL_BINLOG_DIRECTORY of the storage.
+"""
+import json
+import os
+import re
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from .chains import INCREMENTAL_SUFFIX
+from .storage.base import StorageFileNotFound
+
+MYSQL_FULL_EVERY = getattr(settings, 'DBBACKUP_MYSQL_FULL_EVERY', 7)
+MYSQL_BINLOG_DIRECTORY = getattr(settings, 'DBBACKUP_MYSQL_BINLOG_DIRECTORY', 'binlog')
+
+INCREMENTAL_EXTENSION = INCREMENTAL_SUFFIX + '.tar'
+POSITION_FILENAME = 'position.json'
+# Written by mysqldump --master-data=2, or --source-data=2 from MySQL 8.0.26
+DUMP_POSITION = re.compile(r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)', *(?:MASTER|SOURCE)_LOG_POS=(\d+)")
+DUMP_HEADER_SIZE = 64 * 1024
+
+
+class PositionScanner:
+    """ Pass the chunks of a mysqldump through, recording the binary log
+    position written in its header as position, a (file, offset) tuple.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.position = None
+
+    def __iter__(self):
+        head = ''
+        for chunk in self.chunks:
+            if self.position is None and len(head) < DUMP_HEADER_SIZE:
+                head += chunk
+                match = DUMP_POSITION.search(head)
+                if match:
+                    self.position = (match.group(1), int(match.group(2)))
+            yield chunk
+
+
+###################################
+#  Positions
+###################################
+
+def position_path(database_key):
+    """ Return the name of the position file of a database alias in the
+    storage, relative to the backup directory.
+    """
+    return '%s/%s.json' % (MYSQL_BINLOG_DIRECTORY, database_key)
+
+
+def load_position(storage, database_key):
+    """ Return the description of the last backup of the database alias,
+    with the binary log position it ends at, or None if there is none.
+    """
+    try:
+        return json.loads(''.join(storage.read_stream(os.path.join(storage.backup_dir(),
+                                                                   position_path(database_key)))))
+    except (StorageFileNotFound, ValueError):
+        return None
+
+
+def save_position(storage, database_key, description):
+    """ Replace the position file of the database alias. """
+    storage.write_stream(position_path(database_key), [json.dumps(description)])
+
+
+###################################
+#  Binary Logs
+###################################
+
+def parse_binary_logs(output):
+    """ Return the names of the binary log files in the output of SHOW
+    BINARY LOGS, oldest first.
+    """
+    return [line.split('\t')[0] for line in output.splitlines() if line.strip()]
+
+
+def logs_since(logs, log_file):
+    """ Return the binary log files from log_file to the last one closed,
+    after the logs were flushed, or None if log_file was purged.
+    """
+    if log_file not in logs:
+        return None
+    return logs[logs.index(log_file):-1]
+
+
+def write_description(dump_dir, description):
+    """ Write the description of an incremental backup next to its binary
+    log files in {dumpdir}/dump.
+    """
+    with open(os.path.join(dump_dir, 'dump', POSITION_FILENAME), 'w') as description_file:
+        json.dump(description, description_file)
+
+
+def read_description(dump_dir, base=None):
+    """ Return the description of the incremental backup extracted into
+    {dumpdir}/dump. With base, check it was made after the backup named
+    base.
+    """
+    try:
+        with open(os.path.join(dump_dir, 'dump', POSITION_FILENAME)) as description_file:
+            description = json.load(description_file)
+    except (IOError, ValueError):
+        raise CommandError("Not an incremental MySQL backup")
+    if base is not None and description['base'] != base:
+        raise CommandError("Incremental backup based on %s, not %s" % (description['base'], base))
+    return description
+
+
+def parse_position(position):
+    """ Return the (file, offset) of a position given as file:offset. """
+    log_file, _, offset = position.rpartition(':')
+    if not log_file or not offset.isdigit():
+        raise CommandError("Invalid binary log position '%s', expected <file>:<offset>" % position)
+    return log_file, int(offset)
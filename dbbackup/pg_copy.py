@@ -0,0 +1,378 @@
+"""
+Native PostgreSQL backups with parallel COPY streams, without pg_dump.
+The schema is read from the system catalogs and the data of each table is
+copied with COPY ... TO STDOUT over BACKUP_JOBS connections, which share the
+snapshot of the first one (pg_export_snapshot) so the backup is consistent.
+The backup is a tar archive of a manifest holding the schema and a file per
+table. A database is restored by creating its tables, loading them with
+parallel COPY ... FROM STDIN, then creating the indexes and constraints.
+With BACKUP_JOBS = 1 the restore runs in one transaction, which leaves the
+database as it was on error. With more, the tables are dropped and created
+in a first transaction and each table is loaded in its own, so a failed
+restore leaves the database partly restored: restore it again.
+
+Tables, sequences, views, materialized views, indexes and constraints are
+backed up. Partitioned and inherited tables are not supported, and neither
+are functions, triggers, types, extensions, comments and privileges: use the
+'plain' or 'directory' format for such databases. Requires psycopg2 and
+PostgreSQL 10 or later.
+"""
+import json
+import os
+from Queue import Queue
+
+from django.core.management.base import CommandError
+
+from .pipeline import parallel_map
+from .utils import bytes_to_str
+
+MANIFEST_VERSION = 1
+MANIFEST_MEMBER = 'manifest.json'
+DATA_DIRECTORY = 'data'
+MIN_SERVER_VERSION = 100000
+# Connection options of Django, not of psycopg2
+DJANGO_OPTIONS = ('autocommit', 'isolation_level')
+
+USER_OBJECT = ("n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname !~ '^pg_' "
+               "AND NOT EXISTS (SELECT 1 FROM pg_depend e WHERE e.classid = 'pg_class'::regclass "
+               "AND e.objid = c.oid AND e.deptype = 'e')")
+TABLES_QUERY = (
+    "SELECT c.oid, n.nspname, c.relname, c.relkind, c.relpersistence, "
+    "EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid OR i.inhparent = c.oid) "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind IN ('r', 'p') AND " + USER_OBJECT + " "
+    "ORDER BY pg_total_relation_size(c.oid) DESC, n.nspname, c.relname")
+COLUMNS_QUERY = (
+    "SELECT a.attrelid, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull, "
+    "pg_get_expr(d.adbin, d.adrelid), a.attidentity, %s "
+    "FROM pg_attribute a LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum "
+    "WHERE a.attrelid = ANY(%%s::oid[]) AND a.attnum > 0 AND NOT a.attisdropped "
+    "ORDER BY a.attrelid, a.attnum")
+SEQUENCES_QUERY = (
+    "SELECT n.nspname, c.relname, format_type(s.seqtypid, NULL), s.seqstart, s.seqincrement, "
+    "s.seqmin, s.seqmax, s.seqcache, s.seqcycle, o.deptype, tn.nspname, t.relname, ta.attname "
+    "FROM pg_sequence s JOIN pg_class c ON c.oid = s.seqrelid "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "LEFT JOIN pg_depend o ON o.classid = 'pg_class'::regclass AND o.objid = c.oid "
+    "AND o.refclassid = 'pg_class'::regclass AND o.deptype IN ('a', 'i') "
+    "LEFT JOIN pg_class t ON t.oid = o.refobjid "
+    "LEFT JOIN pg_namespace tn ON tn.oid = t.relnamespace "
+    "LEFT JOIN pg_attribute ta ON ta.attrelid = o.refobjid AND ta.attnum = o.refobjsubid "
+    "WHERE " + USER_OBJECT + " ORDER BY n.nspname, c.relname")
+VIEWS_QUERY = (
+    "SELECT c.oid, n.nspname, c.relname, c.relkind, pg_get_viewdef(c.oid) "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind IN ('v', 'm') AND " + USER_OBJECT + " ORDER BY c.oid")
+CONSTRAINTS_QUERY = (
+    "SELECT con.conrelid, con.conname, con.contype, pg_get_constraintdef(con.oid) "
+    "FROM pg_constraint con WHERE con.conrelid = ANY(%s::oid[]) AND con.contype IN ('p', 'u', 'c', 'x', 'f') "
+    "ORDER BY con.contype = 'f', con.conrelid, con.conname")
+# The indexes of primary key, unique and exclusion constraints come with them
+INDEXES_QUERY = (
+    "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = ANY(%s::oid[]) "
+    "AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = i.indexrelid "
+    "AND con.contype IN ('p', 'u', 'x')) ORDER BY i.indrelid, i.indexrelid")
+
+
+def quote(name):
+    """ Return name quoted as an SQL identifier. """
+    return '"%s"' % name.replace('"', '""')
+
+
+def qualify(schema, name):
+    """ Return the quoted name of an object in schema. """
+    return '%s.%s' % (quote(schema), quote(name))
+
+
+def copy_statement(table, direction):
+    """ Return the COPY statement of a table of the manifest, direction
+    being 'TO STDOUT' or 'FROM STDIN'. Generated columns are not copied.
+    """
+    columns = ' (%s)' % ', '.join(table['columns']) if table['columns'] else ''
+    return 'COPY %s%s %s' % (table['name'], columns, direction)
+
+
+def literal(value):
+    """ Return value quoted as an SQL string. """
+    return "'%s'" % value.replace("'", "''")
+
+
+###################################
+#  Connections
+###################################
+
+def connect(database):
+    """ Return a new psycopg2 connection to the database, with the settings
+    Django connects with.
+    """
+    try:
+        import psycopg2
+    except ImportError:
+        raise CommandError("The copy format requires the psycopg2 package.")
+    options = dict((key, value) for key, value in database.get('OPTIONS', {}).items()
+                   if key not in DJANGO_OPTIONS)
+    try:
+        connection = psycopg2.connect(database=database['NAME'], user=database['USER'] or None,
+                                      password=database['PASSWORD'] or None, host=database.get('HOST') or None,
+                                      port=database.get('PORT') or None, **options)
+    except psycopg2.Error, err:
+        raise CommandError("Cannot connect to %s: %s" % (database['NAME'], err))
+    if connection.server_version < MIN_SERVER_VERSION:
+        connection.close()
+        raise CommandError("The copy format requires PostgreSQL 10 or later.")
+    connection.set_client_encoding('UTF8')
+    # Names outside pg_catalog are schema qualified in the definitions read
+    cursor = connection.cursor()
+    cursor.execute("SELECT set_config('search_path', '', false)")
+    connection.commit()
+    return connection
+
+
+def parallel_run(connections, func, items):
+    """ Return func(connection, item) for each item, running func on a
+    thread per connection with a connection no other thread uses meanwhile.
+    """
+    pool = Queue()
+    for connection in connections:
+        pool.put(connection)
+
+    def run(item):
+        connection = pool.get()
+        try:
+            return func(connection, item)
+        finally:
+            pool.put(connection)
+    return list(parallel_map(run, items, len(connections)))
+
+
+def close_all(connections):
+    """ Close the connections, ignoring those already broken. """
+    for connection in connections:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+###################################
+#  Schema
+###################################
+
+def sequence_options(start, increment, minimum, maximum, cache, cycle):
+    """ Return the options of a sequence in CREATE SEQUENCE or of an identity
+    column.
+    """
+    return 'INCREMENT BY %s MINVALUE %s MAXVALUE %s START WITH %s CACHE %s %sCYCLE' % (
+        increment, minimum, maximum, start, cache, '' if cycle else 'NO ')
+
+
+def column_definition(name, column_type, not_null, default, identity, generated, options=None):
+    """ Return the definition of a column in CREATE TABLE, options being
+    those of its sequence if it is an identity column.
+    """
+    definition = '%s %s' % (quote(name), column_type)
+    if generated:
+        definition += ' GENERATED ALWAYS AS (%s) STORED' % default
+    elif default is not None:
+        definition += ' DEFAULT %s' % default
+    if identity:
+        definition += ' GENERATED %s AS IDENTITY' % ('ALWAYS' if identity == 'a' else 'BY DEFAULT')
+        if options:
+            definition += ' (%s)' % options
+    if not_null:
+        definition += ' NOT NULL'
+    return definition
+
+
+def read_schema(connection):
+    """ Return the manifest of the database: the statements creating its
+    objects before and after its data is loaded, and its tables with the
+    columns to copy, biggest first.
+    """
+    cursor = connection.cursor()
+    manifest = {'version': MANIFEST_VERSION, 'server_version': connection.server_version,
+                'schemas': [], 'drop': [], 'pre_data': [], 'tables': [], 'sequences': [],
+                'views': [], 'indexes': [], 'foreign_keys': []}
+    cursor.execute(TABLES_QUERY)
+    tables = cursor.fetchall()
+    for oid, schema, name, kind, persistence, inherits in tables:
+        if kind == 'p' or inherits:
+            raise CommandError("Table %s.%s is partitioned or inherited, which the copy format does not "
+                               "support." % (schema, name))
+    table_names = dict((oid, qualify(schema, name)) for oid, schema, name, _, _, _ in tables)
+    cursor.execute(COLUMNS_QUERY % ('a.attgenerated' if connection.server_version >= 120000 else "''"),
+                   (list(table_names),))
+    columns = {}
+    for oid, name, column_type, not_null, default, identity, generated in cursor.fetchall():
+        columns.setdefault(oid, []).append((name, column_type, not_null, default, identity, generated))
+    cursor.execute(VIEWS_QUERY)
+    views = cursor.fetchall()
+
+    schemas = set(schema for _, schema, _, _, _, _ in tables) | set(schema for _, schema, _, _, _ in views)
+    for oid, schema, name, kind, definition in reversed(views):
+        manifest['drop'].append('DROP %sVIEW IF EXISTS %s CASCADE' % (
+            'MATERIALIZED ' if kind == 'm' else '', qualify(schema, name)))
+    manifest['drop'].extend('DROP TABLE IF EXISTS %s CASCADE' % table_names[oid] for oid, _, _, _, _, _ in tables)
+
+    owned_by = []
+    identity_options = {}
+    cursor.execute(SEQUENCES_QUERY)
+    for (schema, name, sequence_type, start, increment, minimum, maximum, cache, cycle,
+         dependency, table_schema, table, column) in cursor.fetchall():
+        schemas.add(schema)
+        sequence = qualify(schema, name)
+        values = connection.cursor()
+        values.execute('SELECT last_value, is_called FROM %s' % sequence)
+        last_value, is_called = values.fetchone()
+        options = sequence_options(start, increment, minimum, maximum, cache, cycle)
+        if dependency == 'i':
+            # Identity sequences are created with their column
+            identity_options[(qualify(table_schema, table), column)] = options
+            sequence = "pg_get_serial_sequence(%s, %s)" % (literal(qualify(table_schema, table)), literal(column))
+        else:
+            manifest['drop'].append('DROP SEQUENCE IF EXISTS %s CASCADE' % sequence)
+            manifest['pre_data'].append(
+                'CREATE SEQUENCE %s AS %s %s' % (sequence, sequence_type, options))
+            sequence = "%s::regclass" % literal(sequence)
+            if dependency == 'a':
+                owned_by.append('ALTER SEQUENCE %s OWNED BY %s.%s' % (
+                    qualify(schema, name), qualify(table_schema, table), quote(column)))
+        manifest['sequences'].append('SELECT setval(%s, %s, %s)' % (sequence, last_value, 'true' if is_called else 'false'))
+
+    for oid, schema, name, kind, persistence, _ in tables:
+        manifest['pre_data'].append('CREATE %sTABLE %s (\n    %s\n)' % (
+            'UNLOGGED ' if persistence == 'u' else '', table_names[oid],
+            ',\n    '.join(column_definition(*column, options=identity_options.get((table_names[oid], column[0])))
+                          for column in columns.get(oid, []))))
+        manifest['tables'].append({
+            'name': table_names[oid],
+            'columns': [quote(column[0]) for column in columns.get(oid, []) if not column[5]],
+            'member': '%s/%04d.copy' % (DATA_DIRECTORY, len(manifest['tables'])),
+        })
+    manifest['pre_data'].extend(owned_by)
+    manifest['schemas'] = sorted(schemas)
+
+    for oid, schema, name, kind, definition in views:
+        if kind == 'm':
+            manifest['views'].append('CREATE MATERIALIZED VIEW %s AS %s' % (qualify(schema, name), definition))
+            manifest['views'].append('REFRESH MATERIALIZED VIEW %s' % qualify(schema, name))
+        else:
+            manifest['views'].append('CREATE VIEW %s AS %s' % (qualify(schema, name), definition))
+
+    relations = list(table_names) + [oid for oid, _, _, kind, _ in views if kind == 'm']
+    cursor.execute(CONSTRAINTS_QUERY, (list(table_names),))
+    for oid, name, kind, definition in cursor.fetchall():
+        statement = 'ALTER TABLE %s ADD CONSTRAINT %s %s' % (table_names[oid], quote(name), definition)
+        manifest['foreign_keys' if kind == 'f' else 'indexes'].append(statement)
+    cursor.execute(INDEXES_QUERY, (relations,))
+    manifest['indexes'].extend(definition for definition, in cursor.fetchall())
+    return manifest
+
+
+###################################
+#  Backup
+###################################
+
+def dump_database(database, directory, jobs=1):
+    """ Write the manifest and the data of each table of the database into
+    directory, copying the tables over jobs connections which share a
+    snapshot.
+    """
+    os.makedirs(os.path.join(directory, DATA_DIRECTORY))
+    connection = connect(database)
+    workers = []
+    try:
+        connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_export_snapshot()')
+        snapshot = cursor.fetchone()[0]
+        manifest = read_schema(connection)
+        # The snapshot stays valid while the transaction exporting it is open
+        for _ in range(max(1, min(jobs, len(manifest['tables'])))):
+            worker = connect(database)
+            worker.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            worker.cursor().execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+            workers.append(worker)
+        print "  Copying %s tables over %s connections" % (len(manifest['tables']), len(workers))
+
+        def copy_table(worker, table):
+            filepath = os.path.join(directory, table['member'])
+            with open(filepath, 'wb') as data_file:
+                worker.cursor().copy_expert(copy_statement(table, 'TO STDOUT'), data_file)
+            return os.path.getsize(filepath)
+
+        sizes = parallel_run(workers, copy_table, manifest['tables'])
+        for table, size in zip(manifest['tables'], sizes):
+            table['size'] = size
+        print "  Copied %s of data" % bytes_to_str(sum(sizes))
+        with open(os.path.join(directory, MANIFEST_MEMBER), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+    finally:
+        close_all(workers + [connection])
+
+
+###################################
+#  Restore
+###################################
+
+def execute_all(connection, statements, commit=True):
+    """ Execute the statements and commit them in one transaction, unless
+    commit is False.
+    """
+    cursor = connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    if commit:
+        connection.commit()
+
+
+def restore_database(database, directory, jobs=1):
+    """ Restore the backup extracted into directory over the database: drop
+    and create its objects, load the tables over jobs connections, then
+    create the indexes and constraints, in parallel too, and the foreign
+    keys. With one job, all of it runs in one transaction.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_MEMBER)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        raise CommandError("Not a backup of the copy format")
+    connection = connect(database)
+    # Other connections would not see the tables of an open transaction
+    single = jobs <= 1
+    workers = []
+    try:
+        execute_all(connection, ['CREATE SCHEMA IF NOT EXISTS %s' % quote(schema) for schema in manifest['schemas']] +
+                    manifest['drop'] + manifest['pre_data'], commit=not single)
+        if not single:
+            for _ in range(jobs):
+                workers.append(connect(database))
+        loaders = workers or [connection]
+        print "  Loading %s tables over %s connections" % (len(manifest['tables']), len(loaders))
+
+        def load_table(worker, table):
+            with open(os.path.join(directory, table['member']), 'rb') as data_file:
+                try:
+                    worker.cursor().copy_expert(copy_statement(table, 'FROM STDIN'), data_file)
+                    if not single:
+                        worker.commit()
+                except Exception, err:
+                    worker.rollback()
+                    raise CommandError("Error loading %s: %s" % (table['name'], err))
+
+        parallel_run(loaders, load_table, manifest['tables'])
+        execute_all(connection, manifest['sequences'] + manifest['views'], commit=not single)
+        print "  Creating %s indexes and constraints" % len(manifest['indexes'])
+
+        def create(worker, statement):
+            try:
+                execute_all(worker, [statement], commit=not single)
+            except Exception, err:
+                worker.rollback()
+                raise CommandError("Error running %s: %s" % (statement, err))
+
+        parallel_run(loaders, create, manifest['indexes'])
+        # Foreign keys lock the tables they refer to, they are added in turn
+        execute_all(connection, manifest['foreign_keys'])
+    finally:
+        close_all(workers + [connection])
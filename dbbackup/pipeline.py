@@ -0,0 +1,354 @@
+"""
+Streaming pipeline stages.
+Each stage takes an iterable of byte strings (chunks) and yields new chunks, so
+a backup can flow from the dump process to the storage without being spooled.
+"""
+import hashlib
+import itertools
+import os
+import re
+import sys
+import tempfile
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from subprocess import Popen, PIPE
+
+from django.conf import settings
+
+from . import governor
+
+
+CHUNK_SIZE = getattr(settings, 'DBBACKUP_CHUNK_SIZE', 1024 * 1024)
+QUEUE_SIZE = getattr(settings, 'DBBACKUP_QUEUE_SIZE', 8)
+GPG_BINARY = getattr(settings, 'DBBACKUP_GPG_BINARY', 'gpg')
+
+_END = object()
+# The version of GPG_BINARY, once asked (see gpg_version())
+_gpg_version = []
+
+
+###################################
+#  Sources and Sinks
+###################################
+
+def iter_file(filehandle, chunk_size=CHUNK_SIZE):
+    """ Yield the contents of filehandle in chunks. """
+    while True:
+        data = filehandle.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def prime(chunks):
+    """ Pull the first chunk through the stages producing chunks, so that a
+    backup which cannot be downloaded, decrypted or decompressed fails now,
+    and return an iterator over all the chunks.
+    """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        return itertools.chain([chunk], chunks)
+    return iter([])
+
+
+def rechunk(chunks, chunk_size):
+    """ Regroup chunks so each one is chunk_size bytes (except the last).
+    chunk_size may also be an iterator giving the size of each chunk in turn.
+    """
+    sizes = iter(chunk_size) if hasattr(chunk_size, '__iter__') else itertools.repeat(chunk_size)
+    size = next(sizes)
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            data = ''.join(buffer)
+            offset = 0
+            while len(data) - offset >= size:
+                yield data[offset:offset + size]
+                offset += size
+                size = next(sizes)
+            rest = data[offset:]
+            buffer = [rest] if rest else []
+            buffered = len(rest)
+    if buffered:
+        yield ''.join(buffer)
+
+
+class ChunkReader:
+    """ File-like object reading from an iterable of chunks. """
+
+    def __init__(self, chunks, name=None):
+        self.chunks = iter(chunks)
+        self.name = name
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+class ChunkCounter:
+    """ Pass chunks through unchanged while counting the bytes, and hashing
+    them with hash_name (a hashlib algorithm) if given.
+    """
+
+    def __init__(self, chunks, hash_name=None):
+        self.chunks = chunks
+        self.bytes = 0
+        self.hash = hashlib.new(hash_name) if hash_name else None
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.bytes += len(chunk)
+            if self.hash:
+                self.hash.update(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash else None
+
+
+###################################
+#  Threads
+###################################
+
+def child_thread(target):
+    """ Return a daemon thread running target on behalf of the current
+    thread, whose captured output it shares (see utils.ThreadedOutput).
+    """
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.parent = threading.current_thread()
+    return thread
+
+
+def prefetch(chunks, size=QUEUE_SIZE):
+    """ Consume chunks in a background thread, keeping at most size chunks
+    buffered. This lets the producing stages run while the consumer is busy.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    queue = Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(_END)
+        except:
+            put(sys.exc_info())
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    thread = child_thread(produce)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                break
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        stopped.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+        thread.join()
+
+
+def spool(chunks):
+    """ Return chunks read ahead into a temporary file by a background
+    thread, pausing at chunk boundaries while the load of the host is too
+    high (see governor.LoadMonitor), so the stages after them pause without
+    holding the command producing them. Without DBBACKUP_MAX_LOAD the chunks
+    are returned as they are.
+    """
+    if governor.load_monitor.max_load is None:
+        return chunks
+    return _spooled(chunks)
+
+
+def _spooled(chunks):
+    spool_file = tempfile.TemporaryFile()
+    sizes = deque()
+    done = []
+    condition = threading.Condition()
+    stopped = threading.Event()
+
+    def produce():
+        result = _END
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    break
+                with condition:
+                    spool_file.seek(0, os.SEEK_END)
+                    spool_file.write(chunk)
+                    sizes.append(len(chunk))
+                    condition.notify()
+        except:
+            result = sys.exc_info()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        with condition:
+            done.append(result)
+            condition.notify()
+
+    thread = child_thread(produce)
+    thread.start()
+    position = 0
+    try:
+        while True:
+            governor.load_monitor.wait()
+            with condition:
+                while not sizes and not done:
+                    condition.wait(0.1)
+                if not sizes:
+                    if done[0] is _END:
+                        break
+                    raise done[0][0], done[0][1], done[0][2]
+                size = sizes.popleft()
+                spool_file.seek(position)
+                chunk = spool_file.read(size)
+                position += size
+                if not sizes:
+                    # Caught up with the producer, start the file over
+                    spool_file.seek(0)
+                    spool_file.truncate()
+                    position = 0
+            yield chunk
+    finally:
+        stopped.set()
+        thread.join()
+        spool_file.close()
+
+
+def parallel_map(func, items, threads, inflight=None):
+    """ Yield func(item) for each item, in order, running func on a pool of
+    threads. At most inflight items (default: twice the threads) are pending
+    at once, so items are consumed no faster than results are used.
+    """
+    inflight = inflight or 2 * threads
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= inflight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+###################################
+#  Encryption
+###################################
+
+def gpg_encrypt(chunks, recipient=None):
+    """ Encrypt chunks with gpg for DBBACKUP_GPG_RECIPIENT. """
+    recipient = recipient or settings.DBBACKUP_GPG_RECIPIENT
+    command = [GPG_BINARY, '--batch', '--yes', '--always-trust', '--recipient', recipient, '--encrypt']
+    return filter_command(command, chunks)
+
+
+def gpg_version():
+    """ Return the version of GPG_BINARY as a tuple of integers. """
+    if not _gpg_version:
+        output = Popen([GPG_BINARY, '--version'], stdout=PIPE).communicate()[0]
+        match = re.search(r'(\d+)\.(\d+)', output)
+        _gpg_version.append(tuple(int(part) for part in match.groups()) if match else (0, 0))
+    return _gpg_version[0]
+
+
+def gpg_decrypt(chunks, passphrase=None):
+    """ Decrypt chunks with gpg. Without a passphrase the gpg agent is used.
+    From GnuPG 2.1 the passphrase is only read from --passphrase-fd with the
+    loopback pinentry, otherwise the agent asks for it and fails in batch mode.
+    """
+    command = [GPG_BINARY, '--batch', '--yes', '--decrypt']
+    if passphrase is None:
+        return filter_command(command + ['--use-agent'], chunks)
+    if gpg_version() >= (2, 1):
+        command += ['--pinentry-mode', 'loopback']
+    return filter_command(command + ['--passphrase-fd', '0'], chunks, stdin_prefix=passphrase + '\n')
+
+
+def filter_command(command, chunks, stdin_prefix=None):
+    """ Pipe chunks through the stdin of command, yielding its stdout. """
+    stderr = tempfile.TemporaryFile()
+    process = Popen(governor.priority_command(command), stdin=PIPE, stdout=PIPE, stderr=stderr)
+    errors = []
+
+    def feed():
+        try:
+            if stdin_prefix:
+                process.stdin.write(stdin_prefix)
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except IOError:
+            pass  # The command exited early, reported by its return code
+        except:
+            errors.append(sys.exc_info())
+        finally:
+            process.stdin.close()
+
+    thread = child_thread(feed)
+    thread.start()
+    try:
+        for chunk in iter_file(process.stdout):
+            yield chunk
+        thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        if process.wait():
+            stderr.seek(0)
+            raise Exception('Error running %s:\n%s' % (command[0], stderr.read()))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        stderr.close()
@@ -0,0 +1,100 @@
+"""
+Retention policies deciding which old backups to delete.
+"""
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+CLEANUP_KEEP = getattr(settings, 'DBBACKUP_CLEANUP_KEEP', 10)
+RETENTION = getattr(settings, 'DBBACKUP_RETENTION', None)
+
+PERIODS = (
+    ('daily', lambda timestamp: timestamp.date()),
+    ('weekly', lambda timestamp: timestamp.isocalendar()[:2]),
+    ('monthly', lambda timestamp: (timestamp.year, timestamp.month)),
+    ('yearly', lambda timestamp: timestamp.year),
+)
+
+
+def get_policy(database=None):
+    """ Return the retention policy of a database, or of the media files.
+    DBBACKUP_RETENTION overrides the default of keeping DBBACKUP_CLEANUP_KEEP
+    backups and those of the 1st of the month, and the BACKUP_RETENTION key of
+    the database settings overrides DBBACKUP_RETENTION.
+    """
+    options = {'keep': CLEANUP_KEEP, 'first_of_month': RETENTION is None}
+    options.update(RETENTION or {})
+    if database:
+        options.update(database.get('BACKUP_RETENTION', {}))
+    return RetentionPolicy(**options)
+
+
+class RetentionPolicy:
+    """ Keep the newest `keep` backups, the newest backup of each of the last
+    `daily` days, `weekly` weeks, `monthly` months and `yearly` years that
+    have one, and with first_of_month the backups made on the 1st of a month.
+    Backups older than max_age days are deleted whatever the other rules say.
+    The latest backup is always kept.
+    """
+
+    def __init__(self, keep=0, daily=0, weekly=0, monthly=0, yearly=0, max_age=None, first_of_month=False):
+        self.keep = keep
+        self.counts = {'daily': daily, 'weekly': weekly, 'monthly': monthly, 'yearly': yearly}
+        self.max_age = max_age
+        self.first_of_month = first_of_month
+
+    def plan(self, backups, now=None, dependencies=None):
+        """ Split the (datetime, filepath) backups in one pass, newest first.
+        Return the kept backups as (filepath, reasons) and the filepaths of
+        the backups to delete. Backups listed in dependencies, a dictionary of
+        {filepath: [filepaths it needs]}, are kept with those needing them.
+        """
+        oldest = (now or datetime.now()) - timedelta(days=self.max_age) if self.max_age is not None else None
+        periods = dict((name, set()) for name, _ in PERIODS)
+        kept = []
+        deleted = []
+        for index, (timestamp, filepath) in enumerate(sorted(backups, reverse=True)):
+            reasons = []
+            if index == 0:
+                reasons.append('latest')
+            elif index < self.keep:
+                reasons.append('last %s' % self.keep)
+            for name, period in PERIODS:
+                key = period(timestamp)
+                if key not in periods[name] and len(periods[name]) < self.counts[name]:
+                    periods[name].add(key)
+                    reasons.append(name)
+            if self.first_of_month and timestamp.day == 1:
+                reasons.append('1st of month')
+            if index > 0 and oldest and timestamp < oldest:
+                reasons = []
+            if reasons:
+                kept.append((filepath, reasons))
+            else:
+                deleted.append(filepath)
+        if dependencies:
+            needed = set()
+            for filepath, _ in kept:
+                needed.update(dependencies.get(filepath, []))
+            kept.extend((filepath, ['needed']) for filepath in deleted if filepath in needed)
+            deleted = [filepath for filepath in deleted if filepath not in needed]
+        return kept, deleted
+
+
+def cleanup(catalog, backups, policy, dry_run=False, dependencies=None, companions=None):
+    """ Delete the (datetime, filepath) backups the policy does not keep,
+    in batches, along with the files listed for them in companions. With
+    dry_run only print what would be kept and deleted. Return the filepaths
+    of the backups deleted.
+    """
+    kept, deleted = policy.plan(backups, dependencies=dependencies)
+    if dry_run:
+        for filepath, reasons in reversed(kept):
+            print "  Keeping: %s (%s)" % (filepath, ', '.join(reasons))
+    for filepath in deleted:
+        print "  %s: %s" % ('Would delete' if dry_run else 'Deleting', filepath)
+    if deleted and not dry_run:
+        companions = companions or {}
+        catalog.delete_files(deleted + [path for filepath in deleted for path in companions.get(filepath, [])])
+    print "  Kept %s backups, %s %s" % (len(kept), 'would delete' if dry_run else 'deleted', len(deleted))
+    return deleted
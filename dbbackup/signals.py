@@ -0,0 +1,9 @@
+"""
+Signals sent with the metrics of backup and restore runs (see metrics).
+"""
+from django.dispatch import Signal
+
+# Sent for each stage of a run when the run finishes
+stage_finished = Signal(providing_args=['run', 'stage'])
+# Sent when the backup or restore of a database finishes, failed or not
+run_finished = Signal(providing_args=['run'])
@@ -0,0 +1,106 @@
+"""
+Consistent copies of SQLite databases with the online backup API.
+The sqlite3 module of Python 2 does not expose the backup API, so it is
+called through ctypes, from the SQLite library the sqlite3 module uses.
+"""
+import ctypes
+import ctypes.util
+import time
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+SQLITE_BACKUP_PAGES = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_PAGES', 1024)
+SQLITE_BACKUP_SLEEP = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_SLEEP', 0.05)
+SQLITE_BACKUP_RESTARTS = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_RESTARTS', 3)
+
+SQLITE_OK = 0
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+SQLITE_DONE = 101
+SQLITE_OPEN_READONLY = 0x1
+SQLITE_OPEN_READWRITE = 0x2
+SQLITE_OPEN_CREATE = 0x4
+
+_library = []
+
+
+def library():
+    """ Return the SQLite library, loaded once. """
+    if not _library:
+        import _sqlite3
+        for path in (getattr(_sqlite3, '__file__', None), ctypes.util.find_library('sqlite3')):
+            if not path:
+                continue
+            lib = ctypes.CDLL(path)
+            if hasattr(lib, 'sqlite3_backup_init'):
+                break
+        else:
+            raise CommandError("The SQLite library with the backup API was not found.")
+        lib.sqlite3_open_v2.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.c_char_p]
+        lib.sqlite3_close.argtypes = [ctypes.c_void_p]
+        lib.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+        lib.sqlite3_errmsg.restype = ctypes.c_char_p
+        lib.sqlite3_backup_init.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+        lib.sqlite3_backup_init.restype = ctypes.c_void_p
+        lib.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.sqlite3_backup_remaining.argtypes = [ctypes.c_void_p]
+        lib.sqlite3_backup_pagecount.argtypes = [ctypes.c_void_p]
+        lib.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+        _library.append(lib)
+    return _library[0]
+
+
+def open_database(filepath, flags):
+    """ Open the database at filepath, returning its handle. """
+    lib = library()
+    handle = ctypes.c_void_p()
+    if lib.sqlite3_open_v2(filepath.encode('utf-8') if isinstance(filepath, unicode) else filepath,
+                           ctypes.byref(handle), flags, None) != SQLITE_OK:
+        message = lib.sqlite3_errmsg(handle) if handle else 'out of memory'
+        lib.sqlite3_close(handle)
+        raise CommandError("Cannot open %s: %s" % (filepath, message))
+    return handle
+
+
+def copy_database(source, destination, pages=SQLITE_BACKUP_PAGES, sleep=SQLITE_BACKUP_SLEEP):
+    """ Copy the database at source over the database at destination, pages
+    pages at a time, sleeping between the steps. Each step only locks the
+    databases while it runs, so writers are not blocked for the whole copy.
+    When another connection writes to source the copy restarts, and after
+    DBBACKUP_SQLITE_BACKUP_RESTARTS restarts the rest is copied in one step.
+    Return the number of pages copied.
+    """
+    lib = library()
+    source_handle = open_database(source, SQLITE_OPEN_READONLY)
+    try:
+        destination_handle = open_database(destination, SQLITE_OPEN_READWRITE | SQLITE_OPEN_CREATE)
+        try:
+            backup = lib.sqlite3_backup_init(destination_handle, 'main', source_handle, 'main')
+            if not backup:
+                raise CommandError("Cannot back up %s: %s" % (source, lib.sqlite3_errmsg(destination_handle)))
+            try:
+                restarts = 0
+                remaining = None
+                while True:
+                    result = lib.sqlite3_backup_step(backup, pages)
+                    if result == SQLITE_DONE:
+                        break
+                    if result not in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED):
+                        raise CommandError("Backup of %s failed: %s" % (source, lib.sqlite3_errmsg(destination_handle)))
+                    if remaining is not None and lib.sqlite3_backup_remaining(backup) > remaining:
+                        restarts += 1
+                        if restarts >= SQLITE_BACKUP_RESTARTS:
+                            pages = -1
+                    remaining = lib.sqlite3_backup_remaining(backup)
+                    time.sleep(sleep)
+                page_count = lib.sqlite3_backup_pagecount(backup)
+            finally:
+                result = lib.sqlite3_backup_finish(backup)
+            if result != SQLITE_OK:
+                raise CommandError("Backup of %s failed: %s" % (source, lib.sqlite3_errmsg(destination_handle)))
+            return page_count
+        finally:
+            lib.sqlite3_close(destination_handle)
+    finally:
+        lib.sqlite3_close(source_handle)
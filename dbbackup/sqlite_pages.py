@@ -0,0 +1,122 @@
+"""
+Page-level incremental backups of SQLite databases.
+A full backup is a copy of the database. An incremental backup holds the
+pages changed since the previous backup, found by comparing the md5 of each
+page with a page map kept next to the database. A database is rebuilt by
+applying the incremental backups in order to the last full backup.
+"""
+import hashlib
+import json
+import os
+import struct
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from .pipeline import ChunkReader, iter_file
+
+SQLITE_FULL_EVERY = getattr(settings, 'DBBACKUP_SQLITE_FULL_EVERY', 7)
+SQLITE_PAGE_MAP_DIR = getattr(settings, 'DBBACKUP_SQLITE_PAGE_MAP_DIR', None)
+
+DELTA_MAGIC = 'DBBACKUP-SQLITE-PAGES\n'
+DELTA_VERSION = 1
+DIGEST_SIZE = 16
+
+
+###################################
+#  Page Maps
+###################################
+
+def page_size(filepath):
+    """ Return the page size of the database at filepath, from its header. """
+    with open(filepath, 'rb') as database_file:
+        header = database_file.read(18)
+    size, = struct.unpack('>H', header[16:18])
+    return 65536 if size == 1 else size
+
+
+def page_digests(filepath, size):
+    """ Return the md5 digests of the pages of the database at filepath. """
+    digests = []
+    with open(filepath, 'rb') as database_file:
+        for page in iter_file(database_file, size):
+            digests.append(hashlib.md5(page).digest())
+    return digests
+
+
+def page_map_path(database_path):
+    """ Return the path of the page map of the database, in
+    DBBACKUP_SQLITE_PAGE_MAP_DIR or next to the database.
+    """
+    directory, name = os.path.split(os.path.abspath(database_path))
+    return os.path.join(SQLITE_PAGE_MAP_DIR or directory, '.%s.dbbackup-pages' % name)
+
+
+def load_page_map(database_path):
+    """ Return the page map of the last backup of the database as a
+    (description, digests) tuple, or None if there is none.
+    """
+    try:
+        with open(page_map_path(database_path), 'rb') as map_file:
+            description = json.loads(map_file.readline())
+            data = map_file.read()
+    except (IOError, ValueError):
+        return None
+    digests = [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+    return description, digests
+
+
+def save_page_map(database_path, description, digests):
+    """ Replace the page map of the database. """
+    path = page_map_path(database_path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'wb') as map_file:
+        map_file.write(json.dumps(description) + '\n')
+        map_file.write(''.join(digests))
+    os.rename(path + '.tmp', path)
+
+
+###################################
+#  Deltas
+###################################
+
+def changed_pages(digests, base_digests):
+    """ Return the numbers of the pages changed or added since base_digests. """
+    return [number for number, digest in enumerate(digests)
+            if number >= len(base_digests) or base_digests[number] != digest]
+
+
+def write_delta(filepath, size, page_count, pages, base):
+    """ Yield an incremental backup of the database at filepath holding the
+    pages numbered in pages. base is the name of the previous backup.
+    """
+    header = {'version': DELTA_VERSION, 'base': base, 'page_size': size,
+              'page_count': page_count, 'pages': pages}
+    yield DELTA_MAGIC + json.dumps(header, separators=(',', ':')) + '\n'
+    with open(filepath, 'rb') as database_file:
+        for number in pages:
+            database_file.seek(number * size)
+            yield database_file.read(size)
+
+
+def apply_delta(chunks, database_file, base=None):
+    """ Write the pages of an incremental backup into database_file, a
+    rebuilt database open for update, and truncate it to its page count.
+    With base, check the backup was made after the one named base.
+    """
+    reader = ChunkReader(chunks)
+    if reader.readline() != DELTA_MAGIC:
+        raise CommandError("Not an incremental SQLite backup")
+    header = json.loads(reader.readline())
+    if base is not None and header['base'] != base:
+        raise CommandError("Incremental backup based on %s, not %s" % (header['base'], base))
+    size = header['page_size']
+    for number in header['pages']:
+        page = reader.read(size)
+        if len(page) != size:
+            raise CommandError("Incremental backup is truncated")
+        database_file.seek(number * size)
+        database_file.write(page)
+    database_file.truncate(header['page_count'] * size)
+
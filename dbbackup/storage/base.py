@@ -1,13 +1,26 @@
 """
 Abstract Storage class.
 """
+import os
+import re
+import tempfile
+import threading
+
 from django.conf import settings
 from django.utils.importlib import import_module
 
+from ..pipeline import iter_file, parallel_map
+
+_retries_lock = threading.Lock()
+
 class StorageError(Exception):
     pass
 
 
+class StorageFileNotFound(StorageError):
+    pass
+
+
 ###################################
 #  Abstract Storage Class
 ###################################
@@ -15,6 +28,8 @@ class StorageError(Exception):
 class BaseStorage:
     """ Abstract storage class. """
     BACKUP_STORAGE = getattr(settings, 'DBBACKUP_STORAGE', None)
+    DELETE_THREADS = getattr(settings, 'DBBACKUP_DELETE_THREADS', 8)
+    retries = 0
 
     def __init__(self, server_name=None):
         if not self.name:
@@ -31,9 +46,27 @@ class BaseStorage:
         storage_module = import_module(cls.BACKUP_STORAGE)
         return storage_module.Storage()
 
-    def latest_backup(self, regex):
-        """ Return the latest backup file matching regex. """
-        pass
+    def count_retry(self):
+        """ Count a request retried, for the metrics of the run. """
+        with _retries_lock:
+            self.retries += 1
+
+    def latest_backup(self, regex, directory=''):
+        """ Return the latest backup file whose name matches regex, or None.
+            Only the most recent subdirectories of directory are listed, so
+            their names must sort in date order, like those of
+            DBBACKUP_DIRECTORY_TEMPLATE.
+        """
+        subdirectories, filepaths = self.list_partition(directory)
+        filepaths = [path for path in filepaths if re.search(regex, os.path.basename(path))]
+        for subdirectory in sorted(subdirectories, reverse=True):
+            latest = self.latest_backup(regex, subdirectory)
+            if latest:
+                filepaths.append(latest)
+                break
+        if not filepaths:
+            return None
+        return max(filepaths, key=os.path.basename)
 
     ###################################
     #  Storage Access Methods
@@ -45,11 +78,74 @@ class BaseStorage:
     def delete_file(self, filepath):
         raise StorageError("Programming Error: delete_file() not defined.")
 
+    def delete_files(self, filepaths):
+        """ Delete the specified filepaths. Storages able to delete several
+            files in one request should override this; by default
+            DELETE_THREADS files are deleted at once.
+        """
+        for _ in parallel_map(self.delete_file, filepaths, self.DELETE_THREADS):
+            pass
+
     def list_backups(self, database):
         raise StorageError("Programming Error: list_backups() not defined.")
 
+    def list_partition(self, directory=''):
+        """ Return the subdirectories and the files directly in directory. The
+            directories are relative to the backup directory and the files are
+            paths as returned by list_directory(). Storages able to list a
+            single directory should override this; by default everything is
+            listed.
+        """
+        prefix = os.path.join(self.backup_dir(), directory, '')
+        subdirectories = set()
+        filepaths = []
+        for filepath in self.list_directory():
+            if not filepath.startswith(prefix):
+                continue
+            name = filepath[len(prefix):]
+            if '/' in name:
+                subdirectories.add(os.path.join(directory, name.split('/')[0]))
+            else:
+                filepaths.append(filepath)
+        return sorted(subdirectories), filepaths
+
+    def move_file(self, filepath, filename):
+        """ Move the file at filepath to filename, relative to the backup
+            directory. Storages able to move files should override this; by
+            default the file is copied and deleted.
+        """
+        self.write_stream(filename, self.read_stream(filepath))
+        self.delete_file(filepath)
+
     def write_file(self, filehandle):
         raise StorageError("Programming Error: write_file() not defined.")
 
     def read_file(self, filepath):
         raise StorageError("Programming Error: read_file() not defined.")
+
+    def read_stream(self, filepath):
+        """ Return an iterator over the contents of filepath in chunks. Storages
+            able to download while the chunks are consumed should override this;
+            by default the file is fetched with read_file().
+        """
+        filehandle = self.read_file(filepath)
+        try:
+            filehandle.seek(0)
+            for chunk in iter_file(filehandle):
+                yield chunk
+        finally:
+            filehandle.close()
+
+    def write_stream(self, filename, chunks):
+        """ Write the iterable of byte strings chunks to filename. Storages able
+            to upload while the chunks are produced should override this; by
+            default the chunks are spooled and passed to write_file().
+        """
+        filehandle = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        filehandle.name = filename
+        try:
+            for chunk in chunks:
+                filehandle.write(chunk)
+            self.write_file(filehandle)
+        finally:
+            filehandle.close()
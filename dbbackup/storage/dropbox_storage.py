@@ -3,9 +3,14 @@ Dropbox API Storage object.
 """
 import pickle
 import os
+import re
+import sys
 import tempfile
-from shutil import copyfileobj
-from .base import BaseStorage, StorageError
+import time
+from cStringIO import StringIO
+from .base import BaseStorage, StorageError, StorageFileNotFound
+from .. import governor
+from ..pipeline import iter_file, parallel_map, prefetch, rechunk
 from dropbox.rest import ErrorResponse
 from django.conf import settings
 from dropbox.client import DropboxClient
@@ -14,7 +19,7 @@ from dropbox import session
 DEFAULT_ACCESS_TYPE = 'app_folder'
 
 MAX_SPOOLED_SIZE = 10 * 1024 * 1024
-FILE_SIZE_LIMIT = 145 * 1024 * 1024
+NUMBERED_PART = re.compile(r'^(.*)\.(\d+)$')
 
 ################################
 #  Dropbox Storage Object
@@ -29,6 +34,10 @@ class Storage(BaseStorage):
     DBBACKUP_DROPBOX_APP_KEY = getattr(settings, 'DBBACKUP_DROPBOX_APP_KEY', None)
     DBBACKUP_DROPBOX_APP_SECRET = getattr(settings, 'DBBACKUP_DROPBOX_APP_SECRET', None)
     DBBACKUP_DROPBOX_ACCESS_TYPE = getattr(settings, 'DBBACKUP_DROPBOX_ACCESS_TYPE', DEFAULT_ACCESS_TYPE)
+    DROPBOX_CHUNK_SIZE = getattr(settings, 'DBBACKUP_DROPBOX_CHUNK_SIZE', 4 * 1024 * 1024)
+    DROPBOX_RETRIES = getattr(settings, 'DBBACKUP_DROPBOX_RETRIES', 3)
+    DROPBOX_DOWNLOAD_THREADS = getattr(settings, 'DBBACKUP_DROPBOX_DOWNLOAD_THREADS', 4)
+    DROPBOX_RANGE_SIZE = getattr(settings, 'DBBACKUP_DROPBOX_RANGE_SIZE', 8 * 1024 * 1024)
     _request_token = None
     _access_token = None
 
@@ -54,84 +63,192 @@ class Storage(BaseStorage):
         return self.DROPBOX_DIRECTORY
 
     def delete_file(self, filepath):
-        """ Delete the specified filepath. """
-        files = self.list_directory(raw=True)
-        to_be_deleted = [x for x in files if os.path.splitext(x)[0] == filepath]
-
-        for name in to_be_deleted:
-            self.run_dropbox_action(self.dropbox.file_delete, name)
-
-    def list_directory(self, raw=False):
-        """ List all stored backups for the specified. """
-        metadata = self.run_dropbox_action(self.dropbox.metadata, self.DROPBOX_DIRECTORY)
-        filepaths = [x['path'] for x in metadata['contents'] if not x['is_dir']]
+        """ Delete the specified filepath, or the numbered parts older versions
+            split it into.
+        """
+        if self.run_dropbox_action(self.dropbox.file_delete, filepath, ignore_404=True) is not None:
+            return
+        files = [x['path'] for x in self.list_metadata(os.path.dirname(filepath))]
+        to_be_deleted = [x for x in files if self.strip_part_number(x) == filepath]
+        for _ in parallel_map(lambda name: self.run_dropbox_action(self.dropbox.file_delete, name),
+                              to_be_deleted, self.DELETE_THREADS):
+            pass
+
+    def delete_files(self, filepaths):
+        """ Delete the specified filepaths and their numbered parts, listing
+            each folder once and deleting DELETE_THREADS files at once.
+        """
+        to_be_deleted = []
+        for folder in set(os.path.dirname(filepath) for filepath in filepaths):
+            names = set(filepath for filepath in filepaths if os.path.dirname(filepath) == folder)
+            to_be_deleted.extend(x['path'] for x in self.list_metadata(folder)
+                                 if self.strip_part_number(x['path']) in names)
+        for _ in parallel_map(lambda name: self.run_dropbox_action(self.dropbox.file_delete, name),
+                              to_be_deleted, self.DELETE_THREADS):
+            pass
+
+    def list_directory(self, raw=False, directory=''):
+        """ List all stored backups for the specified, including those in
+            subdirectories.
+        """
+        filepaths = []
+        folders = [os.path.join(self.DROPBOX_DIRECTORY, directory)]
+        while folders:
+            contents = self.list_metadata(folders.pop(), files=False)
+            folders.extend(x['path'] for x in contents if x['is_dir'])
+            filepaths.extend(x['path'] for x in contents if not x['is_dir'])
         if not raw:
-            filepaths = [os.path.splitext(x)[0] for x in filepaths]
+            filepaths = [self.strip_part_number(x) for x in filepaths]
             filepaths = list(set(filepaths))
 
         return sorted(filepaths)
 
+    def list_partition(self, directory=''):
+        """ Return the subdirectories and the files directly in directory. """
+        contents = self.list_metadata(os.path.join(self.DROPBOX_DIRECTORY, directory), files=False)
+        subdirectories = [x['path'][len(self.DROPBOX_DIRECTORY):] for x in contents if x['is_dir']]
+        filepaths = set(self.strip_part_number(x['path']) for x in contents if not x['is_dir'])
+        return sorted(subdirectories), sorted(filepaths)
+
+    def list_metadata(self, folder, files=True):
+        """ Return the metadata of the files, and of the subfolders unless
+            files is set, in the folder.
+        """
+        metadata = self.run_dropbox_action(self.dropbox.metadata, folder, ignore_404=True)
+        if not metadata or metadata.get('is_deleted'):
+            return []
+        return [x for x in metadata['contents'] if not (files and x['is_dir'])]
+
+    def move_file(self, filepath, filename):
+        """ Move the file at filepath, or its numbered parts, to filename. """
+        path = os.path.join(self.DROPBOX_DIRECTORY, filename)
+        parts = self.get_parts(filepath)
+        if len(parts) == 1 and parts[0][0] == filepath:
+            self.run_dropbox_action(self.dropbox.file_move, filepath, path)
+            return
+        for part_path, _ in parts:
+            self.run_dropbox_action(self.dropbox.file_move, part_path,
+                                    path + part_path[len(filepath):])
+
     def get_numbered_path(self, path, number):
         return "{}.{}".format(path, number)
 
     @staticmethod
-    def chunked_file(filehandle, chunk_size=FILE_SIZE_LIMIT):
-        eof = False
-        while not eof:
-            with tempfile.SpooledTemporaryFile(max_size=MAX_SPOOLED_SIZE) as t:
-                chunk_space = chunk_size
-                while chunk_space > 0:
-                    data = filehandle.read(min(16384, chunk_space))
-                    if not data:
-                        eof = True
-                        break
-
-                    chunk_space -= len(data)
-                    t.write(data)
-
-                if t.tell() > 0:
-                    t.seek(0)
-                    yield t
+    def strip_part_number(path):
+        """ Return the path without the numeric suffix of a numbered part. """
+        match = NUMBERED_PART.match(path)
+        return match.group(1) if match else path
 
     def write_file(self, filehandle):
         """ Write the specified file. """
         filehandle.seek(0)
-        total_files = 0
-        path = os.path.join(
-            self.DROPBOX_DIRECTORY, 
-            filehandle.name,
-        )
-        for chunk in self.chunked_file(filehandle):
-            self.run_dropbox_action(
-                self.dropbox.put_file, 
-                self.get_numbered_path(path, total_files), 
-                chunk,
-            )
-            total_files += 1
+        self.upload_session(filehandle.name, iter_file(filehandle))
+
+    def write_stream(self, filename, chunks):
+        """ Write the chunks, uploading each one as soon as it is available. """
+        self.upload_session(filename, chunks)
+
+    def upload_session(self, filename, chunks):
+        """ Upload the chunks to a single file through a chunked upload session.
+            Chunks of the session must be appended in order, so the next chunk
+            is read while the current one is being sent. An existing file is
+            replaced, not renamed.
+        """
+        path = os.path.join(self.DROPBOX_DIRECTORY, filename)
+        offset, upload_id = 0, None
+        for chunk in prefetch(rechunk(chunks, self.DROPBOX_CHUNK_SIZE), 1):
+            offset, upload_id = self.upload_chunk(chunk, offset, upload_id)
+        if upload_id is None:
+            self.run_dropbox_action(self.dropbox.put_file, path, StringIO(''), overwrite=True)
+        else:
+            self.run_dropbox_action(self.dropbox.commit_chunked_upload, path, upload_id, overwrite=True)
+
+    def upload_chunk(self, data, offset, upload_id):
+        """ Append data to the upload session at offset, retrying up to
+            DROPBOX_RETRIES times. Return the new (offset, upload_id).
+        """
+        governor.throttle_upload(len(data))
+        for attempt in range(self.DROPBOX_RETRIES + 1):
+            try:
+                new_offset, upload_id = self.dropbox.upload_chunk(StringIO(data), len(data), offset, upload_id)
+                if new_offset != offset + len(data):
+                    raise StorageError('Upload session is at offset %s, expected %s' % (
+                        new_offset, offset + len(data)))
+                return new_offset, upload_id
+            except Exception:
+                if attempt == self.DROPBOX_RETRIES:
+                    raise StorageError('ERROR %s' % (sys.exc_info()[1],))
+                self.count_retry()
+                print "  Retrying chunk at offset %s after error: %s" % (offset, sys.exc_info()[1])
+                time.sleep(2 ** attempt)
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        total_files = 0
         filehandle = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOLED_SIZE)
         try:
-            while True:
-                response = self.run_dropbox_action(
-                    self.dropbox.get_file, 
-                    self.get_numbered_path(filepath, total_files),
-                    ignore_404=(total_files > 0),
-                )
-                if not response:
-                    break
-
-                copyfileobj(response, filehandle)
-                total_files += 1
-
+            for chunk in self.read_stream(filepath):
+                filehandle.write(chunk)
         except:
             filehandle.close()
             raise
-
+        filehandle.seek(0)
         return filehandle
 
+    def read_stream(self, filepath):
+        """ Read the specified file in chunks as they are downloaded. With more
+            than one download thread, byte ranges are fetched concurrently and
+            yielded in order.
+        """
+        byte_ranges = self.byte_ranges(self.get_parts(filepath))
+        if self.DROPBOX_DOWNLOAD_THREADS > 1:
+            return parallel_map(self.download_range, byte_ranges, self.DROPBOX_DOWNLOAD_THREADS)
+        return (self.download_range(byte_range) for byte_range in byte_ranges)
+
+    def get_parts(self, filepath):
+        """ Return the (path, size) of each file making up the backup: the file
+            itself, or the numbered parts older versions split backups into.
+        """
+        metadata = self.run_dropbox_action(self.dropbox.metadata, filepath, ignore_404=True)
+        if metadata and not metadata.get('is_deleted') and not metadata['is_dir']:
+            return [(metadata['path'], metadata['bytes'])]
+        parts = {}
+        for metadata in self.list_metadata(os.path.dirname(filepath)):
+            match = NUMBERED_PART.match(metadata['path'])
+            if match and match.group(1) == filepath:
+                parts[int(match.group(2))] = (metadata['path'], metadata['bytes'])
+        if not parts:
+            raise StorageFileNotFound('File not found: %s' % filepath)
+        return [parts[number] for number in sorted(parts)]
+
+    def byte_ranges(self, parts):
+        """ Yield the (path, start, length) byte ranges to download. """
+        for path, size in parts:
+            for start in range(0, size, self.DROPBOX_RANGE_SIZE):
+                yield path, start, min(self.DROPBOX_RANGE_SIZE, size - start)
+
+    def download_range(self, byte_range):
+        """ Download one byte range, retrying up to DROPBOX_RETRIES times. """
+        path, start, length = byte_range
+        governor.throttle_download(length)
+        for attempt in range(self.DROPBOX_RETRIES + 1):
+            try:
+                response = self.dropbox.get_file(path, start=start, length=length)
+                try:
+                    data = response.read()
+                finally:
+                    response.close()
+                if len(data) != length:
+                    raise StorageError('Expected %s bytes at offset %s of %s, got %s' % (
+                        length, start, path, len(data)))
+                return data
+            except Exception:
+                if attempt == self.DROPBOX_RETRIES:
+                    raise StorageError('ERROR %s' % (sys.exc_info()[1],))
+                self.count_retry()
+                print "  Retrying bytes %s-%s of %s after error: %s" % (
+                    start, start + length - 1, path, sys.exc_info()[1])
+                time.sleep(2 ** attempt)
+
     def run_dropbox_action(self, method, *args, **kwargs):
         """ Check we have a valid 200 response from Dropbox. """
         ignore_404 = kwargs.pop("ignore_404", False)
@@ -2,7 +2,9 @@
 Filesystem Storage object.
 """
 import os
-from .base import BaseStorage, StorageError
+from .base import BaseStorage, StorageError, StorageFileNotFound
+from .. import governor
+from ..pipeline import iter_file
 from django.conf import settings
 
 
@@ -32,26 +34,98 @@ class Storage(BaseStorage):
         return self.BACKUP_DIRECTORY
 
     def delete_file(self, filepath):
-        """ Delete the specified filepath. """
+        """ Delete the specified filepath, and the directories it leaves empty. """
         os.unlink(filepath)
+        self._remove_empty_directories(os.path.dirname(filepath))
 
-    def list_directory(self):
-        """ List all stored backups for the specified. """
-        filepaths = os.listdir(self.BACKUP_DIRECTORY)
-        filepaths = [os.path.join(self.BACKUP_DIRECTORY, path) for path in filepaths]
-        return sorted(filter(os.path.isfile, filepaths))
+    def _remove_empty_directories(self, directory):
+        top = os.path.abspath(self.BACKUP_DIRECTORY)
+        while os.path.abspath(directory).startswith(top + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+    def list_directory(self, directory=''):
+        """ List all stored backups for the specified, including those in
+            subdirectories.
+        """
+        filepaths = []
+        for root, dirnames, filenames in os.walk(os.path.join(self.BACKUP_DIRECTORY, directory)):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            filepaths.extend(os.path.join(root, name) for name in filenames if not name.startswith('.'))
+        return sorted(filepaths)
+
+    def list_partition(self, directory=''):
+        """ Return the subdirectories and the files directly in directory. """
+        path = os.path.join(self.BACKUP_DIRECTORY, directory)
+        subdirectories = []
+        filepaths = []
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.startswith('.'):
+                    continue
+                if os.path.isdir(os.path.join(path, name)):
+                    subdirectories.append(os.path.join(directory, name))
+                else:
+                    filepaths.append(os.path.join(path, name))
+        return subdirectories, filepaths
+
+    def move_file(self, filepath, filename):
+        """ Move the file at filepath to filename. """
+        backuppath = os.path.join(self.BACKUP_DIRECTORY, filename)
+        self._make_directories(backuppath)
+        os.rename(filepath, backuppath)
+        self._remove_empty_directories(os.path.dirname(filepath))
+
+    @staticmethod
+    def _make_directories(backuppath):
+        directory = os.path.dirname(backuppath)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
 
     def write_file(self, filehandle):
         """ Write the specified file. """
         filehandle.seek(0)
         backuppath = os.path.join(self.BACKUP_DIRECTORY, filehandle.name)
+        self._make_directories(backuppath)
         backupfile = open(backuppath, 'w')
-        data = filehandle.read(1024)
-        while data:
-            backupfile.write(data)
-            data = filehandle.read(1024)
+        for chunk in iter_file(filehandle):
+            governor.throttle_upload(len(chunk))
+            backupfile.write(chunk)
         backupfile.close()
 
+    def write_stream(self, filename, chunks):
+        """ Write the chunks to a hidden temporary file as they arrive, and
+            rename it to the specified file once complete.
+        """
+        backuppath = os.path.join(self.BACKUP_DIRECTORY, filename)
+        temppath = os.path.join(os.path.dirname(backuppath), '.%s.tmp' % os.path.basename(backuppath))
+        self._make_directories(backuppath)
+        try:
+            with open(temppath, 'wb') as backupfile:
+                for chunk in chunks:
+                    governor.throttle_upload(len(chunk))
+                    backupfile.write(chunk)
+            os.rename(temppath, backuppath)
+        except:
+            if os.path.exists(temppath):
+                os.unlink(temppath)
+            raise
+
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
         return open(filepath, 'r')
+
+    def read_stream(self, filepath):
+        """ Read the specified file in chunks. """
+        if not os.path.isfile(filepath):
+            raise StorageFileNotFound('File not found: %s' % filepath)
+        with open(filepath, 'rb') as filehandle:
+            for chunk in iter_file(filehandle):
+                governor.throttle_download(len(chunk))
+                yield chunk
@@ -0,0 +1,81 @@
+"""
+Memory Storage object.
+"""
+import os
+import threading
+from cStringIO import StringIO
+from .base import BaseStorage, StorageFileNotFound
+from ..pipeline import iter_file
+from django.conf import settings
+
+# The stored files by path, shared by every storage object of the process
+FILES = {}
+_files_lock = threading.Lock()
+
+
+################################
+#  Memory Storage Object
+################################
+
+class Storage(BaseStorage):
+    """ Storage keeping the backups in memory, for as long as the process
+        runs. Useful for benchmarks and for trying out settings without
+        writing anything anywhere.
+    """
+    MEMORY_DIRECTORY = getattr(settings, 'DBBACKUP_MEMORY_DIRECTORY', 'django-dbbackups/')
+    MEMORY_DIRECTORY = '%s/' % MEMORY_DIRECTORY.strip('/')
+
+    def __init__(self, server_name=None):
+        self.name = 'Memory'
+        BaseStorage.__init__(self)
+
+    ###################################
+    #  DBBackup Storage Methods
+    ###################################
+
+    def backup_dir(self):
+        return self.MEMORY_DIRECTORY
+
+    def delete_file(self, filepath):
+        """ Delete the specified filepath. """
+        with _files_lock:
+            if FILES.pop(filepath, None) is None:
+                raise StorageFileNotFound('File not found: %s' % filepath)
+
+    def list_directory(self, directory=''):
+        """ List all stored backups, including those in subdirectories. """
+        prefix = os.path.join(self.MEMORY_DIRECTORY, directory, '')
+        with _files_lock:
+            return sorted(filepath for filepath in FILES if filepath.startswith(prefix))
+
+    def move_file(self, filepath, filename):
+        """ Move the file at filepath to filename. """
+        with _files_lock:
+            if filepath not in FILES:
+                raise StorageFileNotFound('File not found: %s' % filepath)
+            FILES[os.path.join(self.MEMORY_DIRECTORY, filename)] = FILES.pop(filepath)
+
+    def write_file(self, filehandle):
+        """ Write the specified file. """
+        filehandle.seek(0)
+        self.write_stream(filehandle.name, iter_file(filehandle))
+
+    def write_stream(self, filename, chunks):
+        """ Write the chunks, storing the file once complete. """
+        data = ''.join(chunks)
+        with _files_lock:
+            FILES[os.path.join(self.MEMORY_DIRECTORY, filename)] = data
+
+    def read_file(self, filepath):
+        """ Read the specified file and return it's handle. """
+        return StringIO(self._get_data(filepath))
+
+    def read_stream(self, filepath):
+        """ Read the specified file in chunks. """
+        return iter_file(StringIO(self._get_data(filepath)))
+
+    def _get_data(self, filepath):
+        with _files_lock:
+            if filepath not in FILES:
+                raise StorageFileNotFound('File not found: %s' % filepath)
+            return FILES[filepath]
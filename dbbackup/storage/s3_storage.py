@@ -2,16 +2,26 @@
 S3 Storage object.
 """
 import os
+import sys
 import tempfile
+import threading
+import time
 from cStringIO import StringIO
 
 import boto
 from boto.s3.key import Key
 from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
 
 from django.conf import settings
 
-from .base import BaseStorage, StorageError
+from .base import BaseStorage, StorageError, StorageFileNotFound
+from .. import governor
+from ..pipeline import iter_file, parallel_map, rechunk
+
+MAX_PARTS = 10000
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+MAX_DELETE_KEYS = 1000
 
 
 ################################
@@ -27,17 +37,35 @@ class Storage(BaseStorage):
     S3_IS_SECURE = getattr(settings, 'DBBACKUP_S3_USE_SSL', True)
     S3_DIRECTORY = getattr(settings, 'DBBACKUP_S3_DIRECTORY', "django-dbbackups/")
     S3_DIRECTORY = '%s/' % S3_DIRECTORY.strip('/')
+    S3_PART_SIZE = getattr(settings, 'DBBACKUP_S3_PART_SIZE', 8 * 1024 * 1024)
+    S3_UPLOAD_THREADS = getattr(settings, 'DBBACKUP_S3_UPLOAD_THREADS', 4)
+    S3_RETRIES = getattr(settings, 'DBBACKUP_S3_RETRIES', 3)
+    S3_DOWNLOAD_THREADS = getattr(settings, 'DBBACKUP_S3_DOWNLOAD_THREADS', 4)
+    S3_RANGE_SIZE = getattr(settings, 'DBBACKUP_S3_RANGE_SIZE', 8 * 1024 * 1024)
 
     def __init__(self, server_name=None):
         self._check_filesystem_errors()
         self.name = 'AmazonS3'
-        self.conn = S3Connection(aws_access_key_id=self.S3_ACCESS_KEY,
-                                 aws_secret_access_key=self.S3_SECRET_KEY,
-                                 host=self.S3_DOMAIN,
-                                 is_secure=self.S3_IS_SECURE)
+        self.conn = self.get_connection()
         self.bucket = self.conn.get_bucket(self.S3_BUCKET)
+        self._local = threading.local()
         BaseStorage.__init__(self)
 
+    def get_connection(self):
+        """ Return a new S3 connection. """
+        return S3Connection(aws_access_key_id=self.S3_ACCESS_KEY,
+                            aws_secret_access_key=self.S3_SECRET_KEY,
+                            host=self.S3_DOMAIN,
+                            is_secure=self.S3_IS_SECURE)
+
+    def get_thread_bucket(self):
+        """ Return the bucket through a connection private to the current
+            thread, as boto connections must not be shared between threads.
+        """
+        if not hasattr(self._local, 'bucket'):
+            self._local.bucket = self.get_connection().get_bucket(self.S3_BUCKET, validate=False)
+        return self._local.bucket
+
     def _check_filesystem_errors(self):
         """ Check we have all the required settings defined. """
         if not self.S3_BUCKET:
@@ -62,47 +90,232 @@ class Storage(BaseStorage):
         """ Delete the specified filepath. """
         self.bucket.delete_key(filepath)
 
-    def list_directory(self):
+    def delete_files(self, filepaths):
+        """ Delete the specified filepaths, MAX_DELETE_KEYS per request. """
+        for start in range(0, len(filepaths), MAX_DELETE_KEYS):
+            result = self.bucket.delete_keys(filepaths[start:start + MAX_DELETE_KEYS], quiet=True)
+            if result.errors:
+                raise StorageError('Could not delete %s files, first error: %s %s' % (
+                    len(result.errors), result.errors[0].key, result.errors[0].message))
+
+    def list_directory(self, directory=''):
         """ List all stored backups for the specified. """
         return [k.name for k in
-                self.bucket.list(prefix=self.S3_DIRECTORY)]
+                self.bucket.list(prefix=os.path.join(self.S3_DIRECTORY, directory, ''))]
+
+    def list_partition(self, directory=''):
+        """ Return the subdirectories and the files directly in directory. """
+        subdirectories = []
+        filepaths = []
+        for k in self.bucket.list(prefix=os.path.join(self.S3_DIRECTORY, directory, ''), delimiter='/'):
+            if k.name.endswith('/'):
+                subdirectories.append(k.name[len(self.S3_DIRECTORY):].rstrip('/'))
+            else:
+                filepaths.append(k.name)
+        return subdirectories, filepaths
+
+    def move_file(self, filepath, filename):
+        """ Move the file at filepath to filename. S3 has no move, so the key
+            is copied within the bucket and deleted. Keys over 5 GB are copied
+            as a multipart upload, S3_UPLOAD_THREADS parts at once.
+        """
+        key = self.get_key(filepath)
+        new_filepath = os.path.join(self.S3_DIRECTORY, filename)
+        if key.size <= MAX_COPY_SIZE:
+            self.bucket.copy_key(new_filepath, self.S3_BUCKET, filepath)
+        else:
+            mp = self.bucket.initiate_multipart_upload(new_filepath)
+            try:
+                part_size = max(self.S3_PART_SIZE, -(-key.size // MAX_PARTS))
+                parts = enumerate([(start, min(start + part_size, key.size) - 1)
+                                   for start in range(0, key.size, part_size)], 1)
+                for _ in parallel_map(lambda part: self.copy_part(mp, filepath, part), parts,
+                                      self.S3_UPLOAD_THREADS, inflight=self.S3_UPLOAD_THREADS):
+                    pass
+                mp.complete_upload()
+            except:
+                mp.cancel_upload()
+                raise
+        self.delete_file(filepath)
+
+    def copy_part(self, mp, filepath, part):
+        """ Copy one (part_number, (start, end)) part of filepath, retrying up
+            to S3_RETRIES times.
+        """
+        part_number, (start, end) = part
+        thread_mp = MultiPartUpload(self.get_thread_bucket())
+        thread_mp.key_name = mp.key_name
+        thread_mp.id = mp.id
+        for attempt in range(self.S3_RETRIES + 1):
+            try:
+                thread_mp.copy_part_from_key(self.S3_BUCKET, filepath, part_number, start, end)
+                return
+            except Exception:
+                if attempt == self.S3_RETRIES:
+                    raise
+                self.count_retry()
+                print "  Retrying part %s after error: %s" % (part_number, sys.exc_info()[1])
+                time.sleep(2 ** attempt)
 
     def write_file(self, filehandle):
         """ Write the specified file.
             Use multipart upload because normal upload maximum is 5 GB.
         """
-        filepath = os.path.join(self.S3_DIRECTORY, filehandle.name)
-
+        filehandle.seek(0, 2)
+        size = filehandle.tell()
         filehandle.seek(0)
+        self.multipart_upload(filehandle.name, iter_file(filehandle), size)
 
-        mp = self.bucket.initiate_multipart_upload(filepath)
+    def write_stream(self, filename, chunks):
+        """ Write the chunks using a multipart upload, sending each part as
+            soon as it is available.
+        """
+        self.multipart_upload(filename, chunks)
 
+    def multipart_upload(self, filename, chunks, size=None):
+        """ Upload the chunks as a multipart upload, sending up to
+            S3_UPLOAD_THREADS parts at once. At most that many parts are held
+            in memory, and each part is retried on its own.
+        """
+        filepath = os.path.join(self.S3_DIRECTORY, filename)
+        part_sizes = self.part_sizes(size)
+        mp = self.bucket.initiate_multipart_upload(filepath)
         try:
-            part_index = 1
-            while True:
-                buffer = filehandle.read(5 * 1024 * 1024)
-
-                if not buffer:
-                    break
-                else:
-                    string_file = StringIO(buffer)
-                    try:
-                        string_file.seek(0)
-                        mp.upload_part_from_file(string_file, part_index)
-                    finally:
-                        string_file.close()
-
-                    part_index += 1
-
+            parts = enumerate(self.split_parts(chunks, part_sizes), 1)
+            for _ in parallel_map(lambda part: self.upload_part(mp, part), parts,
+                                  self.S3_UPLOAD_THREADS, inflight=self.S3_UPLOAD_THREADS):
+                pass
             mp.complete_upload()
         except:
             mp.cancel_upload()
             raise
 
+    def part_sizes(self, size=None):
+        """ Yield the size of each part. A known size is split into at most
+            MAX_PARTS parts. For an unknown size the part size doubles every
+            MAX_PARTS / 10 parts, so the part limit is only reached past 5 TB,
+            the largest object S3 accepts.
+        """
+        part_size = self.S3_PART_SIZE
+        if size is not None:
+            part_size = max(part_size, -(-size // MAX_PARTS))
+            while True:
+                yield part_size
+        part_number = 0
+        while True:
+            yield part_size * 2 ** (part_number // (MAX_PARTS // 10))
+            part_number += 1
+
+    @staticmethod
+    def split_parts(chunks, part_sizes):
+        """ Split the chunks into parts, with a single empty part for no data. """
+        empty = True
+        for part in rechunk(chunks, part_sizes):
+            empty = False
+            yield part
+        if empty:
+            yield ''
+
+    def upload_part(self, mp, part):
+        """ Upload one (part_number, data) part, retrying up to S3_RETRIES times. """
+        part_number, data = part
+        thread_mp = MultiPartUpload(self.get_thread_bucket())
+        thread_mp.key_name = mp.key_name
+        thread_mp.id = mp.id
+        governor.throttle_upload(len(data))
+        for attempt in range(self.S3_RETRIES + 1):
+            try:
+                thread_mp.upload_part_from_file(StringIO(data), part_number)
+                return len(data)
+            except Exception:
+                if attempt == self.S3_RETRIES:
+                    raise
+                self.count_retry()
+                print "  Retrying part %s after error: %s" % (part_number, sys.exc_info()[1])
+                time.sleep(2 ** attempt)
+
     def read_file(self, filepath):
-        """ Read the specified file and return it's handle. """
-        key = Key(self.bucket)
-        key.key = filepath
+        """ Read the specified file and return it's handle. With more than one
+            download thread, byte ranges are fetched concurrently and written
+            at their offsets into a preallocated temporary file.
+        """
+        if self.S3_DOWNLOAD_THREADS > 1:
+            return self.parallel_read_file(filepath)
+        key = self.get_key(filepath)
         filehandle = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        key.get_contents_to_file(filehandle)
+        for chunk in self._read_key(key):
+            filehandle.write(chunk)
+        filehandle.seek(0)
+        return filehandle
+
+    def read_stream(self, filepath):
+        """ Read the specified file in chunks as they are downloaded. With more
+            than one download thread, byte ranges are fetched concurrently and
+            yielded in order.
+        """
+        key = self.get_key(filepath)
+        if self.S3_DOWNLOAD_THREADS > 1:
+            return parallel_map(lambda byte_range: self.download_range(filepath, byte_range),
+                                self.byte_ranges(key.size), self.S3_DOWNLOAD_THREADS)
+        return self._read_key(key)
+
+    def _read_key(self, key):
+        try:
+            for chunk in iter_file(key):
+                governor.throttle_download(len(chunk))
+                yield chunk
+        finally:
+            key.close()
+
+    def get_key(self, filepath):
+        """ Return the key of the specified file. """
+        key = self.bucket.get_key(filepath)
+        if key is None:
+            raise StorageFileNotFound('File not found: %s' % filepath)
+        return key
+
+    def parallel_read_file(self, filepath):
+        """ Download the byte ranges of the specified file concurrently. """
+        size = self.get_key(filepath).size
+        filehandle = tempfile.TemporaryFile()
+        filehandle.truncate(size)
+        lock = threading.Lock()
+
+        def download(byte_range):
+            data = self.download_range(filepath, byte_range)
+            with lock:
+                filehandle.seek(byte_range[0])
+                filehandle.write(data)
+
+        try:
+            for _ in parallel_map(download, self.byte_ranges(size), self.S3_DOWNLOAD_THREADS):
+                pass
+        except:
+            filehandle.close()
+            raise
+        filehandle.seek(0)
         return filehandle
+
+    def byte_ranges(self, size):
+        """ Yield the (start, end) byte ranges, end inclusive, to download. """
+        for start in range(0, size, self.S3_RANGE_SIZE):
+            yield start, min(start + self.S3_RANGE_SIZE, size) - 1
+
+    def download_range(self, filepath, byte_range):
+        """ Download one byte range, retrying up to S3_RETRIES times. """
+        start, end = byte_range
+        governor.throttle_download(end - start + 1)
+        for attempt in range(self.S3_RETRIES + 1):
+            try:
+                key = Key(self.get_thread_bucket(), filepath)
+                data = key.get_contents_as_string(headers={'Range': 'bytes=%d-%d' % (start, end)})
+                if len(data) != end - start + 1:
+                    raise StorageError('Expected %s bytes at offset %s of %s, got %s' % (
+                        end - start + 1, start, filepath, len(data)))
+                return data
+            except Exception:
+                if attempt == self.S3_RETRIES:
+                    raise
+                self.count_retry()
+                print "  Retrying bytes %s-%s after error: %s" % (start, end, sys.exc_info()[1])
+                time.sleep(2 ** attempt)
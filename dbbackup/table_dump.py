@@ -0,0 +1,198 @@
+"""
+Backups of the tables changed since the previous backup.
+Each backup holds the schema of the database and the data of the tables
+whose change indicator differs from the previous backup: their update time,
+or a checksum of their rows with DBBACKUP_TABLES_CHANGE_DETECTION
+'checksum'. The statistics counters of PostgreSQL are not transactional, so
+they are only a hint: tables whose counters changed are dumped, and the
+others are compared by checksum. Its manifest refers the other tables to the
+backups holding their data, and a database is restored by assembling the
+data of each table from there.
+"""
+import json
+import os
+import tarfile
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from .chains import INCREMENTAL_SUFFIX
+from .pipeline import ChunkReader, iter_file
+
+TABLES_FULL_EVERY = getattr(settings, 'DBBACKUP_TABLES_FULL_EVERY', 7)
+TABLES_CHANGE_DETECTION = getattr(settings, 'DBBACKUP_TABLES_CHANGE_DETECTION', 'stats')
+
+MANIFEST_VERSION = 1
+MANIFEST_MEMBER = 'dump/manifest.json'
+PRE_DATA_MEMBER = 'dump/schema/pre-data.sql'
+POST_DATA_MEMBER = 'dump/schema/post-data.sql'
+SEQUENCES_MEMBER = 'dump/data/sequences.sql'
+# The manifest comes first, so it is read without downloading the whole backup
+TAR_COMMAND = ['tar', '--directory={dumpdir}', '--create', '--file=-',
+               MANIFEST_MEMBER, 'dump/schema', 'dump/data', '>']
+
+
+def filename_extension(extension, incremental):
+    """ Return the extension of a backup of the tables format. """
+    return '%s%s.tar' % (extension, INCREMENTAL_SUFFIX if incremental else '')
+
+
+def is_tables_backup(filepath, extension):
+    """ Return whether the backup at filepath is of the tables format, whose
+    backups have extension.
+    """
+    name = os.path.basename(filepath)
+    return any('.%s' % filename_extension(extension, incremental) in name for incremental in (False, True))
+
+
+def parse_lines(output):
+    """ Return the tab separated names and values in the output of a query,
+    a value of NULL or nothing being None.
+    """
+    values = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        name, _, value = line.partition('\t')
+        values[name] = value if value not in ('', 'NULL') else None
+    return values
+
+
+###################################
+#  Backup
+###################################
+
+def plan(indicators, previous=None, full=False):
+    """ Return the manifest entries of the tables unchanged since the
+    previous manifest, and the names of the tables to dump. Tables without
+    an indicator are always dumped.
+    """
+    unchanged = {}
+    changed = []
+    for name, indicator in sorted(indicators.items()):
+        entry = previous['tables'].get(name) if previous and not full else None
+        if entry and indicator is not None and entry['indicator'] == indicator:
+            unchanged[name] = entry
+        else:
+            changed.append(name)
+    return unchanged, changed
+
+
+def unchanged_hints(hints, previous=None, full=False):
+    """ Return the names of the tables whose hint is the same as in the
+    previous manifest. They may still have changed, and need a checksum.
+    """
+    if not previous or full:
+        return []
+    return sorted(name for name, hint in hints.items()
+                  if hint is not None and previous['tables'].get(name, {}).get('hint') == hint)
+
+
+def split_data(chunks, dump_dir, table_marker, sequence_marker=None):
+    """ Split a data-only dump into a file per table in {dumpdir}/dump/data,
+    at the comment lines matching table_marker, and the sequence values
+    into SEQUENCES_MEMBER. The statements before the first table are
+    repeated at the start of every file. Return the members by table.
+    """
+    reader = ChunkReader(chunks)
+    preamble = []
+    members = {}
+    data_file = None
+    try:
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            match = table_marker.match(line)
+            if match or (sequence_marker and sequence_marker.match(line)):
+                if match:
+                    groups = match.groupdict()
+                    name = '%s.%s' % (groups['schema'], groups['table']) if groups.get('schema') else groups['table']
+                    member = members.get(name) or 'dump/data/%04d.sql' % len(members)
+                    members[name] = member
+                else:
+                    member = SEQUENCES_MEMBER
+                if data_file is None or data_file.name != os.path.join(dump_dir, member):
+                    if data_file:
+                        data_file.close()
+                    new_file = not os.path.exists(os.path.join(dump_dir, member))
+                    data_file = open(os.path.join(dump_dir, member), 'ab')
+                    if new_file:
+                        data_file.write(''.join(preamble))
+            if data_file is None:
+                preamble.append(line)
+            else:
+                data_file.write(line)
+    finally:
+        if data_file:
+            data_file.close()
+    return members
+
+
+def write_manifest(dump_dir, manifest):
+    """ Write the manifest of a backup into {dumpdir}/dump. """
+    with open(os.path.join(dump_dir, MANIFEST_MEMBER), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+
+###################################
+#  Restore
+###################################
+
+def read_manifest(chunks):
+    """ Return the manifest at the start of the backup in chunks. """
+    tar_file = tarfile.open(fileobj=ChunkReader(chunks), mode='r|')
+    try:
+        member = tar_file.next()
+        if member is None or member.name != MANIFEST_MEMBER:
+            raise CommandError("Not a backup of the tables format")
+        return json.loads(tar_file.extractfile(member).read())
+    finally:
+        tar_file.close()
+
+
+def find_backup(name, filepaths):
+    """ Return the filepath of the backup named name, before compression and
+    encryption, among filepaths.
+    """
+    for filepath in filepaths:
+        if os.path.basename(filepath).startswith(name):
+            return filepath
+    raise CommandError("Backup %s, which holds tables of the backup restored, was not found" % name)
+
+
+def sources(manifest, filepath, filepaths):
+    """ Return the members to read from each backup to restore the backup at
+    filepath: its schema and sequences, and the data of each table from the
+    backup holding it.
+    """
+    wanted = {filepath: set([PRE_DATA_MEMBER, POST_DATA_MEMBER, SEQUENCES_MEMBER])}
+    for entry in manifest['tables'].values():
+        if entry['member']:
+            wanted.setdefault(find_backup(entry['backup'], filepaths), set()).add(entry['member'])
+    return wanted
+
+
+def assemble(filepath, wanted, read_stream):
+    """ Yield the statements restoring the database, from the members wanted
+    of each backup: the schema of the backup at filepath, then the data of
+    the tables, then the constraints and indexes.
+    """
+    post_data = []
+    for backup in [filepath] + sorted(path for path in wanted if path != filepath):
+        tar_file = tarfile.open(fileobj=ChunkReader(read_stream(backup)), mode='r|')
+        try:
+            for member in tar_file:
+                if member.name not in wanted[backup] or not member.isfile():
+                    continue
+                chunks = iter_file(tar_file.extractfile(member))
+                if member.name == POST_DATA_MEMBER:
+                    post_data.extend(chunks)
+                    continue
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            tar_file.close()
+    for chunk in post_data:
+        yield chunk
+
@@ -0,0 +1,116 @@
+"""
+Stand-ins for the storage services, with the semantics of the real APIs.
+"""
+import os
+import threading
+
+from dropbox.rest import ErrorResponse
+
+from ..storage import dropbox_storage
+
+
+class DropboxNotFound(ErrorResponse):
+    """ The 404 error response of Dropbox. """
+
+    def __init__(self, path):
+        Exception.__init__(self, path)
+        self.status = 404
+        self.reason = 'Not Found'
+        self.body = {'error': 'Path not found: %s' % path}
+        self.error_msg = self.user_error_msg = self.body['error']
+        self.headers = []
+
+    def __str__(self):
+        return '[404] %s' % self.error_msg
+
+
+class DropboxResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class DropboxClient:
+    """ Stand-in for DropboxClient. Like the SDK, uploads to an existing
+    path are renamed to "name (1)" unless overwrite is set.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def metadata(self, path):
+        path = path.rstrip('/') or '/'
+        with self.lock:
+            if path in self.files:
+                return {'path': path, 'is_dir': False, 'bytes': len(self.files[path])}
+            prefix = path.rstrip('/') + '/'
+            children = set(prefix + filepath[len(prefix):].split('/')[0]
+                           for filepath in self.files if filepath.startswith(prefix))
+            if not children:
+                raise DropboxNotFound(path)
+            contents = [{'path': child, 'is_dir': child not in self.files,
+                         'bytes': len(self.files.get(child, ''))} for child in sorted(children)]
+        return {'path': path, 'is_dir': True, 'bytes': 0, 'contents': contents}
+
+    def file_delete(self, path):
+        with self.lock:
+            if self.files.pop(path, None) is None:
+                raise DropboxNotFound(path)
+
+    def file_move(self, from_path, to_path):
+        with self.lock:
+            if from_path not in self.files:
+                raise DropboxNotFound(from_path)
+            self.files[to_path] = self.files.pop(from_path)
+
+    def put_file(self, full_path, file_obj, overwrite=False, parent_rev=None):
+        self.store(full_path, file_obj.read(), overwrite)
+
+    def upload_chunk(self, file_obj, length, offset=0, upload_id=None):
+        data = file_obj.read(length)
+        with self.lock:
+            if upload_id is None:
+                upload_id = str(len(self.sessions) + 1)
+                self.sessions[upload_id] = ''
+            if offset == len(self.sessions[upload_id]):
+                self.sessions[upload_id] += data
+            return len(self.sessions[upload_id]), upload_id
+
+    def commit_chunked_upload(self, full_path, upload_id, overwrite=False, parent_rev=None):
+        self.store(full_path, self.sessions.pop(upload_id), overwrite)
+
+    def store(self, path, data, overwrite):
+        with self.lock:
+            if not overwrite:
+                base, extension = os.path.splitext(path)
+                number = 1
+                while path in self.files:
+                    path = '%s (%s)%s' % (base, number, extension)
+                    number += 1
+            self.files[path] = data
+
+    def get_file(self, path, start=None, length=None):
+        with self.lock:
+            if path not in self.files:
+                raise DropboxNotFound(path)
+            data = self.files[path]
+        if start is not None:
+            data = data[start:start + length]
+        return DropboxResponse(data)
+
+
+class DropboxStorage(dropbox_storage.Storage):
+    """ The Dropbox storage, connected to a DropboxClient stand-in. """
+
+    def _check_settings(self):
+        pass
+
+    def get_dropbox_client(self):
+        return DropboxClient()
@@ -0,0 +1,9 @@
+"""
+Settings to run the tests with:
+
+    $ DJANGO_SETTINGS_MODULE=dbbackup.tests.settings python -m unittest discover -s dbbackup/tests -t .
+"""
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+INSTALLED_APPS = ('dbbackup',)
+SECRET_KEY = 'dbbackup-tests'
+DBBACKUP_STORAGE = 'dbbackup.storage.memory_storage'
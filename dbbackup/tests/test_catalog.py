@@ -0,0 +1,47 @@
+import unittest
+
+from .. import catalog
+from .fakes import DropboxStorage
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = DropboxStorage()
+        self.catalog = catalog.Catalog(self.storage, enabled=True)
+
+    def test_save_load(self):
+        self.catalog.save({'a': {'size': 1}})
+        self.catalog.save({'b': {'size': 2}})
+        self.assertEqual(self.catalog.load(), {'b': {'size': 2}})
+        self.assertEqual(sorted(self.storage.dropbox.files), [self.catalog.filepath])
+
+    def test_add(self):
+        directory = self.storage.backup_dir()
+        self.catalog.add(directory + 'first.sqlite', timestamp='2014-01-01T00:00:00')
+        self.catalog.add(directory + 'second.sqlite', timestamp='2014-01-02T00:00:00')
+        self.assertEqual(self.catalog.list_directory(), [directory + 'first.sqlite', directory + 'second.sqlite'])
+
+    def test_concurrent_add(self):
+        directory = self.storage.backup_dir()
+        self.catalog.save({})
+        other = catalog.Catalog(self.storage, enabled=True)
+        self.catalog.add(directory + 'first.sqlite')
+        other.add(directory + 'second.sqlite')
+        self.assertEqual(other.list_directory(), [directory + 'first.sqlite', directory + 'second.sqlite'])
+
+    def test_merge(self):
+        directory = self.storage.backup_dir()
+        self.catalog.add(directory + 'first.sqlite')
+        self.catalog.add(directory + 'second.sqlite')
+        self.catalog.delete_files([directory + 'first.sqlite'])
+        self.catalog.merge()
+        self.assertEqual(len(self.catalog.journal()), 3)
+        self.assertEqual(self.catalog.list_directory(), [directory + 'second.sqlite'])
+        # Expired journal files are deleted, the catalog holds their changes
+        old_grace, catalog.JOURNAL_GRACE = catalog.JOURNAL_GRACE, catalog.timedelta(0)
+        try:
+            self.catalog.merge()
+        finally:
+            catalog.JOURNAL_GRACE = old_grace
+        self.assertEqual(self.catalog.journal(), [])
+        self.assertEqual(self.catalog.list_directory(), [directory + 'second.sqlite'])
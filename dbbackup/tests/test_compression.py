@@ -0,0 +1,83 @@
+import unittest
+
+from .. import compression
+
+
+def split(data, size):
+    """ Return data as chunks of size bytes. """
+    return [data[index:index + size] for index in range(0, len(data), size)]
+
+
+class CodecTest(unittest.TestCase):
+    data = ''.join('line %s of the dump\n' % line for line in range(5000))
+
+    def test_round_trip(self):
+        for name in ('gzip', 'bzip2'):
+            codec = compression.get_codec(name)
+            compressed = ''.join(codec.compress(split(self.data, 1000)))
+            self.assertEqual(''.join(codec.decompress(split(compressed, 100))), self.data)
+
+    def test_concatenated_streams(self):
+        codec = compression.get_codec('bzip2')
+        compressed = ''.join(codec.compress(['first\n'])) + ''.join(codec.compress(['second\n']))
+        # The first stream ends on a chunk boundary, then within a chunk
+        self.assertEqual(''.join(codec.decompress([compressed])), 'first\nsecond\n')
+        first = len(''.join(codec.compress(['first\n'])))
+        self.assertEqual(''.join(codec.decompress([compressed[:first], compressed[first:]])), 'first\nsecond\n')
+
+    def test_get_codec_by_extension(self):
+        self.assertEqual(compression.get_codec_by_extension('db-2014-01-01.psql.gz').name, 'gzip')
+        self.assertEqual(compression.get_codec_by_extension('db-2014-01-01.psql.bz2').name, 'bzip2')
+        self.assertEqual(compression.get_codec_by_extension('db-2014-01-01.psql.zst').name, 'zstd')
+        self.assertEqual(compression.get_codec_by_extension('db-2014-01-01.psql'), None)
+
+    def test_get_codec_by_magic(self):
+        for name in ('gzip', 'bzip2'):
+            head, _ = compression.peek(compression.get_codec(name).compress([self.data]))
+            self.assertEqual(compression.get_codec_by_magic(head).name, name)
+        self.assertEqual(compression.get_codec_by_magic('-- PostgreSQL dump'), None)
+
+    def test_peek(self):
+        head, chunks = compression.peek(iter(['ab', 'cd', 'efghijklmnopqrstuvwxyz']), size=3)
+        self.assertEqual(head, 'abc')
+        self.assertEqual(''.join(chunks), 'abcdefghijklmnopqrstuvwxyz')
+
+    def test_unknown_codec(self):
+        self.assertRaises(compression.CommandError, compression.get_codec, 'rar')
+
+
+class GzipBlockTest(unittest.TestCase):
+    data = ''.join('row %s\n' % row for row in range(20000))
+
+    def setUp(self):
+        self.codec = compression.GzipCodec(threads=4, block_size=10000)
+
+    def test_round_trip(self):
+        compressed = ''.join(self.codec.compress(split(self.data, 3000)))
+        self.assertEqual(''.join(self.codec.decompress(split(compressed, 777))), self.data)
+
+    def test_standard_gzip(self):
+        # The blocks are members of a standard gzip file
+        import gzip
+        from StringIO import StringIO
+        compressed = ''.join(self.codec.compress([self.data]))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), self.data)
+        self.assertEqual(''.join(compression.GzipCodec().decompress([compressed])), self.data)
+
+    def test_block_sizes(self):
+        members = list(self.codec.compress([self.data]))
+        self.assertEqual(len(members), (len(self.data) + 9999) // 10000)
+        for member in members:
+            header = member[:compression.GZIP_BLOCK_HEADER.size]
+            self.assertEqual(compression._gzip_block_size(header), len(member))
+
+    def test_empty(self):
+        compressed = ''.join(self.codec.compress([]))
+        self.assertEqual(''.join(self.codec.decompress([compressed])), '')
+
+    def test_serial_members(self):
+        # Members without a recorded size, as gzip writes them, are decompressed serially
+        serial = compression.GzipCodec()
+        first = ''.join(self.codec.compress(['block\n']))
+        rest = ''.join(serial.compress(['first\n'])) + ''.join(serial.compress(['second\n']))
+        self.assertEqual(''.join(self.codec.decompress(split(first + rest, 10))), 'block\nfirst\nsecond\n')
@@ -0,0 +1,33 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.core.management.base import CommandError
+
+from ..dbcommands import DBCommands
+
+
+def unreadable_backup():
+    raise CommandError("Backup is corrupt")
+    yield ''
+
+
+class StreamRestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.marker = os.path.join(self.directory, 'dropped')
+        self.dbcommands = DBCommands({'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:',
+                                      'USER': '', 'PASSWORD': 'secret', 'HOST': '', 'PORT': ''})
+        self.dbcommands.settings.RESTORE_COMMANDS = [['touch', self.marker], ['cat', '<']]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unreadable_backup_runs_no_command(self):
+        self.assertRaises(CommandError, self.dbcommands.stream_restore_commands, unreadable_backup())
+        self.assertFalse(os.path.exists(self.marker))
+
+    def test_restore(self):
+        self.dbcommands.stream_restore_commands(iter(['first', 'second']))
+        self.assertTrue(os.path.exists(self.marker))
@@ -0,0 +1,108 @@
+import json
+import random
+import time
+import unittest
+
+from .. import compression
+from .. import dedup
+from ..storage import memory_storage
+
+
+def text(lines, seed=0):
+    rng = random.Random(seed)
+    return ''.join('%s %s\n' % (number, rng.random()) for number in range(lines))
+
+
+class ChunkerTest(unittest.TestCase):
+    def setUp(self):
+        self.chunker = dedup.Chunker(chunk_size=4096)
+        self.data = text(20000)
+
+    def test_split(self):
+        pieces = list(self.chunker.split([self.data]))
+        self.assertEqual(''.join(pieces), self.data)
+        for piece in pieces[:-1]:
+            self.assertTrue(self.chunker.min_size <= len(piece) <= self.chunker.max_size)
+            self.assertTrue(piece.endswith('\n'))
+
+    def test_independent_of_reads(self):
+        reads = [self.data[index:index + 1000] for index in range(0, len(self.data), 1000)]
+        self.assertEqual(list(self.chunker.split(reads)), list(self.chunker.split([self.data])))
+
+    def test_local_change(self):
+        # A line inserted in the middle only changes the chunks around it
+        lines = self.data.splitlines(True)
+        changed = ''.join(lines[:10000] + ['inserted\n'] + lines[10000:])
+        before = set(self.chunker.split([self.data]))
+        after = list(self.chunker.split([changed]))
+        self.assertTrue(len([piece for piece in after if piece not in before]) <= 2)
+
+    def test_no_line_ends(self):
+        pieces = list(self.chunker.split(['x' * 40000]))
+        self.assertEqual([len(piece) for piece in pieces], [self.chunker.max_size] * 2 + [40000 - 2 * 16384])
+
+
+class WriteBackupTest(unittest.TestCase):
+    def setUp(self):
+        memory_storage.FILES.clear()
+        self.storage = memory_storage.Storage()
+        self.data = text(20000)
+
+    def tearDown(self):
+        memory_storage.FILES.clear()
+
+    def write(self, filename, data, recipes=()):
+        return dedup.write_backup(self.storage, filename, [data], recipes=recipes)
+
+    def test_round_trip(self):
+        recipe, stored, _ = self.write('first.dedup', self.data)
+        self.assertEqual(stored, len(recipe['chunks']))
+        self.assertEqual(recipe['size'], len(self.data))
+        path = self.storage.backup_dir() + 'first.dedup'
+        self.assertEqual(''.join(dedup.read_backup(self.storage, path)), self.data)
+
+    def test_compressed_round_trip(self):
+        recipe, _, _ = dedup.write_backup(self.storage, 'first.dedup', [self.data], compression.get_codec('gzip'))
+        self.assertEqual(recipe['extension'], '.gz')
+        path = self.storage.backup_dir() + 'first.dedup'
+        self.assertEqual(dedup.read_recipe(self.storage, path), recipe)
+        self.assertEqual(''.join(dedup.read_backup(self.storage, path)), self.data)
+
+    def test_chunks_of_older_backups_not_stored(self):
+        self.write('first.dedup', self.data)
+        self.write('second.dedup', text(100, seed=1))
+        recipes = [self.storage.backup_dir() + 'first.dedup', self.storage.backup_dir() + 'second.dedup']
+        _, stored, _ = self.write('third.dedup', self.data, recipes)
+        self.assertEqual(stored, 0)
+
+    def test_marker_removed(self):
+        self.write('first.dedup', self.data)
+        self.assertEqual(dedup.running_backups(self.storage), [])
+
+
+class CollectGarbageTest(unittest.TestCase):
+    def setUp(self):
+        memory_storage.FILES.clear()
+        self.storage = memory_storage.Storage()
+        dedup.write_backup(self.storage, 'first.dedup', [text(20000)])
+        dedup.write_backup(self.storage, 'second.dedup', [text(20000, seed=1)])
+        self.recipes = [self.storage.backup_dir() + 'second.dedup']
+
+    def tearDown(self):
+        memory_storage.FILES.clear()
+
+    def test_collect(self):
+        count = dedup.collect_garbage(self.storage, self.recipes)
+        self.assertTrue(count > 0)
+        self.assertEqual(dedup.collect_garbage(self.storage, self.recipes), 0)
+        self.assertEqual(''.join(dedup.read_backup(self.storage, self.recipes[0])), text(20000, seed=1))
+
+    def test_held_off_while_backing_up(self):
+        self.storage.write_stream(dedup.running_name('third.dedup'), [json.dumps({'started': time.time()})])
+        self.assertEqual(dedup.collect_garbage(self.storage, self.recipes), None)
+
+    def test_expired_marker(self):
+        started = time.time() - dedup.DEDUP_RUNNING_EXPIRY - 1
+        self.storage.write_stream(dedup.running_name('third.dedup'), [json.dumps({'started': started})])
+        self.assertTrue(dedup.collect_garbage(self.storage, self.recipes) > 0)
+        self.assertEqual(self.storage.list_directory(directory=dedup.RUNNING_DIRECTORY), [])
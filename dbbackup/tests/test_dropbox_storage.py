@@ -0,0 +1,21 @@
+import unittest
+
+from .fakes import DropboxStorage
+
+
+class UploadSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = DropboxStorage()
+
+    def test_write_twice_replaces(self):
+        self.storage.write_stream('catalog.json', ['first'])
+        self.storage.write_stream('catalog.json', ['second'])
+        path = self.storage.backup_dir() + 'catalog.json'
+        self.assertEqual(sorted(self.storage.dropbox.files), [path])
+        self.assertEqual(''.join(self.storage.read_stream(path)), 'second')
+
+    def test_write_empty_twice_replaces(self):
+        self.storage.write_stream('empty', ['data'])
+        self.storage.write_stream('empty', [])
+        path = self.storage.backup_dir() + 'empty'
+        self.assertEqual(self.storage.dropbox.files, {path: ''})
@@ -0,0 +1,18 @@
+import unittest
+
+from .. import mysql_binlog
+from .fakes import DropboxStorage
+
+
+class PositionTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = DropboxStorage()
+
+    def test_load_missing(self):
+        self.assertEqual(mysql_binlog.load_position(self.storage, 'default'), None)
+
+    def test_save_load(self):
+        mysql_binlog.save_position(self.storage, 'default', {'end': ['mysql-bin.000001', 120]})
+        mysql_binlog.save_position(self.storage, 'default', {'end': ['mysql-bin.000002', 4]})
+        self.assertEqual(mysql_binlog.load_position(self.storage, 'default'), {'end': ['mysql-bin.000002', 4]})
+        self.assertEqual(len(self.storage.dropbox.files), 1)
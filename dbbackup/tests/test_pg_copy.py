@@ -0,0 +1,14 @@
+import unittest
+
+from .. import pg_copy
+
+
+class ColumnDefinitionTest(unittest.TestCase):
+    def test_identity_options(self):
+        options = pg_copy.sequence_options(100, 5, 1, 1000, 10, True)
+        self.assertEqual(pg_copy.column_definition('id', 'integer', True, None, 'a', '', options=options),
+                         '"id" integer GENERATED ALWAYS AS IDENTITY (INCREMENT BY 5 MINVALUE 1 MAXVALUE 1000 '
+                         'START WITH 100 CACHE 10 CYCLE) NOT NULL')
+
+    def test_default(self):
+        self.assertEqual(pg_copy.column_definition('n', 'bigint', False, '0', '', ''), '"n" bigint DEFAULT 0')
@@ -0,0 +1,72 @@
+import unittest
+
+from .. import governor
+from .. import pipeline
+
+
+def failing_chunks():
+    yield 'first'
+    raise IOError("Dump failed")
+
+
+class RechunkTest(unittest.TestCase):
+    def test_sizes(self):
+        chunks = list(pipeline.rechunk(['ab', 'cdefg', '', 'hijklmnopq', 'r'], 4))
+        self.assertEqual(chunks, ['abcd', 'efgh', 'ijkl', 'mnop', 'qr'])
+
+    def test_exact(self):
+        self.assertEqual(list(pipeline.rechunk(['abcd', 'efgh'], 4)), ['abcd', 'efgh'])
+        self.assertEqual(list(pipeline.rechunk([], 4)), [])
+
+    def test_size_iterator(self):
+        chunks = list(pipeline.rechunk(['abcdefghij'], iter([1, 2, 3, 100])))
+        self.assertEqual(chunks, ['a', 'bc', 'def', 'ghij'])
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_chunks(self):
+        chunks = ['chunk %s' % index for index in range(100)]
+        self.assertEqual(list(pipeline.prefetch(iter(chunks), size=2)), chunks)
+
+    def test_error(self):
+        chunks = pipeline.prefetch(failing_chunks())
+        self.assertEqual(next(chunks), 'first')
+        self.assertRaises(IOError, next, chunks)
+
+    def test_close(self):
+        # Closing the consumer early stops the producer and closes its chunks
+        closed = []
+
+        def endless():
+            try:
+                while True:
+                    yield 'chunk'
+            finally:
+                closed.append(True)
+        chunks = pipeline.prefetch(endless(), size=1)
+        self.assertEqual(next(chunks), 'chunk')
+        chunks.close()
+        self.assertEqual(closed, [True])
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.max_load = governor.load_monitor.max_load
+        governor.load_monitor.max_load = float('inf')
+
+    def tearDown(self):
+        governor.load_monitor.max_load = self.max_load
+
+    def test_chunks(self):
+        chunks = ['first', '', 'second', 'x' * 100000]
+        self.assertEqual(list(pipeline.spool(iter(chunks))), chunks)
+
+    def test_error(self):
+        chunks = pipeline.spool(failing_chunks())
+        self.assertEqual(next(chunks), 'first')
+        self.assertRaises(IOError, list, chunks)
+
+    def test_disabled(self):
+        governor.load_monitor.max_load = None
+        chunks = iter(['first'])
+        self.assertTrue(pipeline.spool(chunks) is chunks)
@@ -0,0 +1,52 @@
+import unittest
+from datetime import datetime, timedelta
+
+from .. import retention
+
+
+def daily_backups(days, start=datetime(2014, 3, 31, 2)):
+    """ Return (datetime, filepath) backups of the last days, one a day. """
+    return [(start - timedelta(days=day), 'backup-%02d' % day) for day in range(days)]
+
+
+class PlanTest(unittest.TestCase):
+    def test_keep(self):
+        kept, deleted = retention.RetentionPolicy(keep=3).plan(daily_backups(5))
+        self.assertEqual(kept, [('backup-00', ['latest']), ('backup-01', ['last 3']), ('backup-02', ['last 3'])])
+        self.assertEqual(deleted, ['backup-03', 'backup-04'])
+
+    def test_periods(self):
+        kept, deleted = retention.RetentionPolicy(daily=2, weekly=2, monthly=2).plan(daily_backups(40))
+        self.assertEqual(kept, [
+            ('backup-00', ['latest', 'daily', 'weekly', 'monthly']),
+            # Monday 2014-03-31 starts a week, Sunday 2014-03-30 ends the one before
+            ('backup-01', ['daily', 'weekly']),
+            # 2014-02-28 is the newest of February
+            ('backup-31', ['monthly']),
+        ])
+        self.assertEqual(len(deleted), 37)
+
+    def test_first_of_month(self):
+        kept, _ = retention.RetentionPolicy(first_of_month=True).plan(daily_backups(40))
+        self.assertEqual([filepath for filepath, _ in kept], ['backup-00', 'backup-30'])
+
+    def test_max_age(self):
+        policy = retention.RetentionPolicy(keep=10, max_age=2)
+        kept, deleted = policy.plan(daily_backups(5), now=datetime(2014, 3, 31, 3))
+        self.assertEqual([filepath for filepath, _ in kept], ['backup-00', 'backup-01'])
+        self.assertEqual(deleted, ['backup-02', 'backup-03', 'backup-04'])
+        # The latest backup is kept however old
+        kept, deleted = policy.plan(daily_backups(2), now=datetime(2015, 1, 1))
+        self.assertEqual(kept, [('backup-00', ['latest'])])
+        self.assertEqual(deleted, ['backup-01'])
+
+    def test_dependencies(self):
+        kept, deleted = retention.RetentionPolicy(keep=1).plan(
+            daily_backups(3), dependencies={'backup-00': ['backup-01']})
+        self.assertEqual(kept, [('backup-00', ['latest']), ('backup-01', ['needed'])])
+        self.assertEqual(deleted, ['backup-02'])
+
+    def test_get_policy(self):
+        policy = retention.get_policy({'BACKUP_RETENTION': {'keep': 2, 'daily': 7}})
+        self.assertEqual(policy.keep, 2)
+        self.assertEqual(policy.counts['daily'], 7)
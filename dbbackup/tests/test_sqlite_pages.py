@@ -0,0 +1,78 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from .. import sqlite_pages
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'db.sqlite')
+        self.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, value TEXT)",
+                     *["INSERT INTO t (value) VALUES ('%s')" % (str(row) * 1000) for row in range(10)])
+        self.copy = os.path.join(self.directory, 'copy.sqlite')
+        shutil.copyfile(self.database, self.copy)
+        self.size = sqlite_pages.page_size(self.database)
+        self.base_digests = sqlite_pages.page_digests(self.database, self.size)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def execute(self, *statements):
+        connection = sqlite3.connect(self.database)
+        for statement in statements:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+    def delta(self, base='db-1'):
+        digests = sqlite_pages.page_digests(self.database, self.size)
+        pages = sqlite_pages.changed_pages(digests, self.base_digests)
+        return list(sqlite_pages.write_delta(self.database, self.size, len(digests), pages, base)), pages
+
+    def read(self, filepath):
+        with open(filepath, 'rb') as database_file:
+            return database_file.read()
+
+    def test_apply(self):
+        self.execute("UPDATE t SET value = 'changed' WHERE id = 5", "INSERT INTO t (value) VALUES ('added')")
+        chunks, pages = self.delta()
+        self.assertTrue(0 < len(pages) < len(self.read(self.database)) // self.size)
+        with open(self.copy, 'r+b') as database_file:
+            sqlite_pages.apply_delta(chunks, database_file, base='db-1')
+        self.assertEqual(self.read(self.copy), self.read(self.database))
+
+    def test_truncated_to_page_count(self):
+        self.execute("INSERT INTO t (value) VALUES ('%s')" % ('y' * 20000))
+        shutil.copyfile(self.database, self.copy)
+        self.base_digests = sqlite_pages.page_digests(self.database, self.size)
+        self.execute("DELETE FROM t WHERE id > 2", "VACUUM")
+        chunks, _ = self.delta()
+        with open(self.copy, 'r+b') as database_file:
+            sqlite_pages.apply_delta(chunks, database_file)
+        self.assertEqual(self.read(self.copy), self.read(self.database))
+
+    def test_wrong_base(self):
+        chunks, _ = self.delta(base='db-0')
+        with open(self.copy, 'r+b') as database_file:
+            self.assertRaises(sqlite_pages.CommandError, sqlite_pages.apply_delta, chunks, database_file, 'db-1')
+
+    def test_not_a_delta(self):
+        with open(self.copy, 'r+b') as database_file:
+            self.assertRaises(sqlite_pages.CommandError, sqlite_pages.apply_delta, ['SQLite format 3\n'],
+                              database_file)
+
+    def test_truncated_delta(self):
+        self.execute("INSERT INTO t (value) VALUES ('%s')" % ('y' * 20000))
+        chunks, _ = self.delta()
+        data = ''.join(chunks)
+        with open(self.copy, 'r+b') as database_file:
+            self.assertRaises(sqlite_pages.CommandError, sqlite_pages.apply_delta, [data[:-1]], database_file)
+
+    def test_page_map(self):
+        self.assertEqual(sqlite_pages.load_page_map(self.database), None)
+        sqlite_pages.save_page_map(self.database, {'backup': 'db-1'}, self.base_digests)
+        self.assertEqual(sqlite_pages.load_page_map(self.database), ({'backup': 'db-1'}, self.base_digests))
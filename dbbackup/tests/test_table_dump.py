@@ -0,0 +1,130 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from .. import table_dump
+from ..dbcommands import PostgreSQLSettings
+
+DUMP = '''SET client_encoding = 'UTF8';
+
+-- Data for Name: author; Type: TABLE DATA; Schema: public; Owner: app
+COPY public.author (id) FROM stdin;
+1
+\\.
+
+-- Data for Name: book; Type: TABLE DATA; Schema: shop; Owner: app
+COPY shop.book (id) FROM stdin;
+2
+\\.
+
+-- Name: author_id_seq; Type: SEQUENCE SET; Schema: public; Owner: app
+SELECT pg_catalog.setval('public.author_id_seq', 1, true);
+'''
+
+
+def tar_backup(members):
+    """ Return a tar archive of the members, a list of (name, data). """
+    output = StringIO()
+    tar_file = tarfile.open(fileobj=output, mode='w')
+    for name, data in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar_file.addfile(info, StringIO(data))
+    tar_file.close()
+    return output.getvalue()
+
+
+class SplitDataTest(unittest.TestCase):
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dump_dir, 'dump', 'data'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dump_dir)
+
+    def read(self, member):
+        with open(os.path.join(self.dump_dir, member)) as data_file:
+            return data_file.read()
+
+    def test_split(self):
+        chunks = [DUMP[index:index + 7] for index in range(0, len(DUMP), 7)]
+        members = table_dump.split_data(chunks, self.dump_dir, PostgreSQLSettings.table_data_marker,
+                                        PostgreSQLSettings.sequence_marker)
+        self.assertEqual(members, {'public.author': 'dump/data/0000.sql', 'shop.book': 'dump/data/0001.sql'})
+        preamble = "SET client_encoding = 'UTF8';\n\n"
+        self.assertTrue(self.read(members['public.author']).startswith(preamble + '-- Data for Name: author;'))
+        self.assertTrue(self.read(members['public.author']).endswith('1\n\\.\n\n'))
+        self.assertTrue(self.read(members['shop.book']).startswith(preamble + '-- Data for Name: book;'))
+        self.assertTrue(self.read(table_dump.SEQUENCES_MEMBER).endswith("'public.author_id_seq', 1, true);\n"))
+
+    def test_no_tables(self):
+        members = table_dump.split_data(['SET client_encoding = 1;\n'], self.dump_dir,
+                                        PostgreSQLSettings.table_data_marker)
+        self.assertEqual(members, {})
+
+
+class PlanTest(unittest.TestCase):
+    previous = {'tables': {
+        'a': {'indicator': '1', 'hint': '10', 'backup': 'db-1', 'member': 'dump/data/0000.sql'},
+        'b': {'indicator': '2', 'hint': '20', 'backup': 'db-1', 'member': 'dump/data/0001.sql'},
+    }}
+
+    def test_plan(self):
+        unchanged, changed = table_dump.plan({'a': '1', 'b': '3', 'c': '4', 'd': None}, self.previous)
+        self.assertEqual(unchanged, {'a': self.previous['tables']['a']})
+        self.assertEqual(changed, ['b', 'c', 'd'])
+
+    def test_full(self):
+        unchanged, changed = table_dump.plan({'a': '1'}, self.previous, full=True)
+        self.assertEqual((unchanged, changed), ({}, ['a']))
+
+    def test_unchanged_hints(self):
+        self.assertEqual(table_dump.unchanged_hints({'a': '10', 'b': '21', 'c': None}, self.previous), ['a'])
+        self.assertEqual(table_dump.unchanged_hints({'a': '10'}, self.previous, full=True), [])
+        self.assertEqual(table_dump.unchanged_hints({'a': '10'}), [])
+
+    def test_is_tables_backup(self):
+        self.assertTrue(table_dump.is_tables_backup('default/db-2014-01-01.psql-tables.tar.gz', 'psql-tables'))
+        self.assertTrue(table_dump.is_tables_backup('default/db-2014-01-01.psql-tables-inc.tar', 'psql-tables'))
+        self.assertFalse(table_dump.is_tables_backup('default/db-2014-01-01.psql.gz', 'psql-tables'))
+
+
+class AssembleTest(unittest.TestCase):
+    def test_assemble(self):
+        backups = {
+            'db-1.psql-tables.tar': tar_backup([
+                (table_dump.MANIFEST_MEMBER, '{}'),
+                (table_dump.PRE_DATA_MEMBER, 'old schema;\n'),
+                ('dump/data/0000.sql', 'old a;\n'),
+                ('dump/data/0001.sql', 'b;\n'),
+            ]),
+            'db-2.psql-tables-inc.tar': tar_backup([
+                (table_dump.MANIFEST_MEMBER, '{}'),
+                (table_dump.PRE_DATA_MEMBER, 'schema;\n'),
+                ('dump/data/0000.sql', 'a;\n'),
+                (table_dump.SEQUENCES_MEMBER, 'sequences;\n'),
+                (table_dump.POST_DATA_MEMBER, 'indexes;\n'),
+            ]),
+        }
+        manifest = {'tables': {
+            'a': {'backup': 'db-2', 'member': 'dump/data/0000.sql'},
+            'b': {'backup': 'db-1', 'member': 'dump/data/0001.sql'},
+            'c': {'backup': 'db-1', 'member': None},
+        }}
+        wanted = table_dump.sources(manifest, 'db-2.psql-tables-inc.tar', sorted(backups))
+        self.assertEqual(wanted, {
+            'db-2.psql-tables-inc.tar': set([table_dump.PRE_DATA_MEMBER, table_dump.POST_DATA_MEMBER,
+                                             table_dump.SEQUENCES_MEMBER, 'dump/data/0000.sql']),
+            'db-1.psql-tables.tar': set(['dump/data/0001.sql']),
+        })
+        statements = table_dump.assemble('db-2.psql-tables-inc.tar', wanted, lambda backup: [backups[backup]])
+        self.assertEqual(''.join(statements), 'schema;\na;\nsequences;\nb;\nindexes;\n')
+        manifest = table_dump.read_manifest([backups['db-1.psql-tables.tar']])
+        self.assertEqual(manifest, {})
+
+    def test_missing_backup(self):
+        manifest = {'tables': {'a': {'backup': 'db-0', 'member': 'dump/data/0000.sql'}}}
+        self.assertRaises(table_dump.CommandError, table_dump.sources, manifest, 'db-2.tar', ['db-2.tar'])
@@ -0,0 +1,35 @@
+import unittest
+
+from .. import wal
+
+
+class ObsoleteFilesTest(unittest.TestCase):
+    def test_oldest_segment_ignores_timeline(self):
+        starts = ['000000010000000000000050', '000000020000000000000010']
+        self.assertEqual(wal.oldest_segment(starts), '000000020000000000000010')
+
+    def test_newer_timeline_segments_kept(self):
+        filepaths = ['wal/00000002000000000000000F.gz', 'wal/000000020000000000000010.gz',
+                     'wal/000000020000000000000030.gz', 'wal/00000002.history']
+        oldest = wal.oldest_segment(['000000010000000000000050', '000000020000000000000010'])
+        self.assertEqual(wal.obsolete_files(filepaths, oldest), ['wal/00000002000000000000000F.gz'])
+
+    def test_older_segments_obsolete(self):
+        filepaths = ['wal/000000010000000000000001', 'wal/000000010000000000000002.gz.gpg',
+                     'wal/000000010000000000000002.00000028.backup', 'wal/000000010000000000000003.gz',
+                     'wal/000000010000000100000000.gz']
+        self.assertEqual(wal.obsolete_files(filepaths, '000000010000000000000003'),
+                         ['wal/000000010000000000000001', 'wal/000000010000000000000002.gz.gpg',
+                          'wal/000000010000000000000002.00000028.backup'])
+
+    def test_other_files_kept(self):
+        filepaths = ['wal/00000001.history', 'wal/README', 'wal/000000010000000000000001.partial']
+        self.assertEqual(wal.obsolete_files(filepaths, '000000010000000000000003'),
+                         ['wal/000000010000000000000001.partial'])
+
+
+class NextSegmentsTest(unittest.TestCase):
+    def test_next_segments(self):
+        self.assertEqual(wal.next_segments('0000000100000000000000FE', 3), [
+            '0000000100000000000000FF', '000000010000000100000000', '000000010000000100000001'])
+        self.assertEqual(wal.next_segments('00000001.history', 3), [])
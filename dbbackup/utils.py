@@ -3,13 +3,19 @@ Util functions for dropbox application.
 """
 import sys
 import os
+import stat
 import tempfile
+import threading
+from cStringIO import StringIO
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.db import connection
 from django.http import HttpRequest
 from django.views.debug import ExceptionReporter
 from functools import wraps
+from subprocess import Popen, PIPE
+
+from . import pipeline
 
 FAKE_HTTP_REQUEST = HttpRequest()
 FAKE_HTTP_REQUEST.META['SERVER_NAME'] = ''
@@ -47,6 +53,86 @@ def handle_size(filehandle):
     return bytes_to_str(filehandle.tell())
 
 
+###################################
+#  Parallel Backups
+###################################
+
+class ThreadedOutput:
+    """ Stand-in for sys.stdout that collects the output of threads which
+    called capture() separately, so it can be printed in one piece. Output of
+    helper threads is collected with that of the thread which started them
+    (see pipeline.child_thread()).
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffers = {}
+
+    def _buffer(self):
+        thread = threading.current_thread()
+        while thread is not None:
+            if thread in self.buffers:
+                return self.buffers[thread]
+            thread = getattr(thread, 'parent', None)
+        return None
+
+    def write(self, data):
+        buffer = self._buffer()
+        if buffer is None:
+            self.stream.write(data)
+        else:
+            buffer.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def capture(self):
+        """ Start collecting the output of the current thread. """
+        self.buffers[threading.current_thread()] = StringIO()
+
+    def release(self):
+        """ Stop collecting the output of the current thread and return it. """
+        return self.buffers.pop(threading.current_thread()).getvalue()
+
+
+class HostScheduler:
+    """ Hand out database keys to worker threads, running at most per_host
+    backups against the same database server at once.
+    """
+
+    def __init__(self, database_keys, per_host):
+        self.pending = list(database_keys)
+        self.per_host = per_host
+        self.running = {}
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def get_host(database_key):
+        database = settings.DATABASES[database_key]
+        return (database.get('HOST') or 'localhost', str(database.get('PORT', '')))
+
+    def next(self):
+        """ Return the next database key whose server has a free slot,
+        waiting for one if needed, or None once every key was handed out.
+        """
+        with self.condition:
+            while self.pending:
+                for database_key in self.pending:
+                    host = self.get_host(database_key)
+                    if self.running.get(host, 0) < self.per_host:
+                        self.pending.remove(database_key)
+                        self.running[host] = self.running.get(host, 0) + 1
+                        return database_key
+                self.condition.wait()
+            return None
+
+    def done(self, database_key):
+        """ Release the slot taken by database_key. """
+        with self.condition:
+            self.running[self.get_host(database_key)] -= 1
+            self.condition.notify_all()
+
+
 ###################################
 #  Email Exception Decorator
 ###################################
@@ -77,6 +163,38 @@ def email_uncaught_exception(func):
     return wrapper
 
 
+def is_gpg_agent_running():
+    """ Check if gpg agent is running """
+    if 'GPG_AGENT_INFO' in os.environ:
+        # Example GPG_AGENT_INFO:
+        # /Users/lorin/.gnupg/S.gpg-agent:192:1
+        socket = os.environ['GPG_AGENT_INFO'].split(':')[0]
+    else:
+        # GnuPG 2.1 and later no longer set GPG_AGENT_INFO, gpgconf knows the socket
+        try:
+            socket = Popen(['gpgconf', '--list-dirs', 'agent-socket'], stdout=PIPE).communicate()[0].strip()
+        except OSError:
+            return False
+    # Verify it's there and it's a socket
+    return bool(socket) and os.path.exists(socket) and stat.S_ISSOCK(os.stat(socket).st_mode)
+
+
+def get_passphrase():
+    """ Get the gpg passphrase from GPG_PASSPHRASE or prompt for it """
+    if 'GPG_PASSPHRASE' in os.environ:
+        return os.environ['GPG_PASSPHRASE']
+    print 'Input Passphrase: '
+    return raw_input()
+
+
+def gpg_decrypt(chunks):
+    """ Decrypt the chunks with GPG_PASSPHRASE if set, with the gpg agent if
+    it is running, or with the passphrase asked for otherwise.
+    """
+    passphrase = None if 'GPG_PASSPHRASE' not in os.environ and is_gpg_agent_running() else get_passphrase()
+    return pipeline.gpg_decrypt(chunks, passphrase)
+
+
 def encrypt_file(input_file):
     """ Encrypt the file using gpg.
     The input and the output are filelike objects. Closes the input file.
@@ -85,7 +203,7 @@ def encrypt_file(input_file):
 
     temp_dir = tempfile.mkdtemp()
     try:
-        temp_filename = os.path.join(temp_dir, input_file.name + '.gpg')
+        temp_filename = os.path.join(temp_dir, os.path.basename(input_file.name) + '.gpg')
         try:
             input_file.seek(0)
 
@@ -0,0 +1,295 @@
+"""
+Continuous archiving of PostgreSQL WAL segments in the storage.
+dbbackup_wal_push is used as the archive_command and dbbackup_wal_fetch as
+the restore_command of PostgreSQL, and dbbackup_basebackup takes the base
+backups the archived WAL is replayed on.
+"""
+import fcntl
+import os
+import re
+import sys
+import tempfile
+
+from django.conf import settings
+
+from . import compression
+from . import pipeline
+from . import utils
+from .storage.base import BaseStorage
+from .storage.base import StorageFileNotFound
+
+WAL_DIRECTORY = getattr(settings, 'DBBACKUP_WAL_DIRECTORY', 'wal')
+WAL_COMPRESSION = getattr(settings, 'DBBACKUP_WAL_COMPRESSION', None)
+WAL_ENCRYPT = getattr(settings, 'DBBACKUP_WAL_ENCRYPT', False)
+WAL_PUSH_THREADS = getattr(settings, 'DBBACKUP_WAL_PUSH_THREADS', 4)
+WAL_PREFETCH = getattr(settings, 'DBBACKUP_WAL_PREFETCH', 8)
+WAL_SEGMENT_SIZE = getattr(settings, 'DBBACKUP_WAL_SEGMENT_SIZE', 16 * 1024 * 1024)
+WAL_RESTORE_COMMAND = getattr(settings, 'DBBACKUP_WAL_RESTORE_COMMAND', None)
+BASEBACKUP_EXTENSION = getattr(settings, 'DBBACKUP_POSTGRESQL_BASEBACKUP_EXTENSION', 'basebackup.tar')
+
+SEGMENT_NAME = re.compile(r'^[0-9A-F]{24}$')
+BACKUP_LABEL = re.compile(r'^LABEL: (.*)$', re.MULTILINE)
+PREFETCH_DIRECTORY = '.dbbackup-prefetch'
+
+
+###################################
+#  Segment Names
+###################################
+
+def next_segments(name, count):
+    """ Return the names of the count segments following the segment name
+    on the same timeline.
+    """
+    if not SEGMENT_NAME.match(name):
+        return []
+    timeline, log, segment = int(name[:8], 16), int(name[8:16], 16), int(name[16:], 16)
+    segments_per_log = 0x100000000 // WAL_SEGMENT_SIZE
+    names = []
+    for _ in range(count):
+        segment += 1
+        if segment >= segments_per_log:
+            log, segment = log + 1, 0
+        names.append('%08X%08X%08X' % (timeline, log, segment))
+    return names
+
+
+def segment_position(name):
+    """ Return the position of the segment name in the WAL, without its
+    timeline: a newer timeline goes on from the position it forked at.
+    """
+    return name[8:]
+
+
+def oldest_segment(names):
+    """ Return the segment at the oldest position among names. """
+    return min(names, key=segment_position)
+
+
+def wal_filename(name, codec=None, encrypt=False):
+    """ Return the name of a WAL file in the storage, relative to the backup
+    directory.
+    """
+    return '%s/%s%s%s' % (WAL_DIRECTORY, name, codec.extension if codec else '', '.gpg' if encrypt else '')
+
+
+###################################
+#  Push
+###################################
+
+def ready_files(path, limit):
+    """ Return the paths of up to limit WAL files besides path which
+    PostgreSQL has marked ready to archive, oldest first.
+    """
+    wal_dir, name = os.path.split(path)
+    try:
+        status = sorted(os.listdir(os.path.join(wal_dir, 'archive_status')))
+    except OSError:
+        return []
+    ready = [filename[:-len('.ready')] for filename in status if filename.endswith('.ready')]
+    return [os.path.join(wal_dir, ready_name) for ready_name in ready if ready_name != name][:limit]
+
+
+def mark_done(path):
+    """ Mark a WAL file archived, so PostgreSQL does not archive it again. """
+    wal_dir, name = os.path.split(path)
+    status = os.path.join(wal_dir, 'archive_status', name)
+    os.rename(status + '.ready', status + '.done')
+
+
+def push_file(storage, path, codec=None, encrypt=WAL_ENCRYPT):
+    """ Store the WAL file at path, compressed with codec. """
+    with open(path, 'rb') as wal_file:
+        chunks = pipeline.iter_file(wal_file)
+        if codec:
+            chunks = codec.compress(chunks)
+        if encrypt:
+            chunks = pipeline.gpg_encrypt(chunks)
+        storage.write_stream(wal_filename(os.path.basename(path), codec, encrypt), chunks)
+
+
+def push(storage_factory, path, threads=WAL_PUSH_THREADS):
+    """ Store the WAL file at path, along with up to threads - 1 other files
+    ready to archive, uploaded at once. The other files are marked archived
+    so PostgreSQL does not ask for them again. Return the paths stored.
+    """
+    codec = compression.get_codec(WAL_COMPRESSION)
+    paths = [path] + ready_files(path, threads - 1)
+
+    def upload(wal_path):
+        push_file(storage_factory(), wal_path, codec)
+        return wal_path
+
+    for pushed in pipeline.parallel_map(upload, paths, threads):
+        if pushed != path:
+            mark_done(pushed)
+    return paths
+
+
+###################################
+#  Fetch
+###################################
+
+def read_file(storage, name):
+    """ Return the decrypted and decompressed chunks of a WAL file in the
+    storage, trying the configured codec first. Raise StorageFileNotFound
+    if it is not archived.
+    """
+    codec = compression.get_codec(WAL_COMPRESSION)
+    codecs = [codec, None] + [compression.get_codec(other) for other in sorted(compression.CODECS)
+                              if other != codec.name]
+    for candidate in codecs:
+        for encrypted in (WAL_ENCRYPT, not WAL_ENCRYPT):
+            filepath = os.path.join(storage.backup_dir(), wal_filename(name, candidate, encrypted))
+            try:
+                chunks = compression.peek(storage.read_stream(filepath))[1]
+            except StorageFileNotFound:
+                continue
+            if encrypted:
+                chunks = utils.gpg_decrypt(chunks)
+            return candidate.decompress(chunks) if candidate else chunks
+    raise StorageFileNotFound("WAL file %s is not archived" % name)
+
+
+def download(storage, name, destination):
+    """ Write the archived WAL file name to destination, through a temporary
+    file in the same directory so PostgreSQL never sees a partial file.
+    """
+    handle, temp_path = tempfile.mkstemp(prefix='.%s.' % name, dir=os.path.dirname(destination) or '.')
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            for chunk in read_file(storage, name):
+                temp_file.write(chunk)
+        os.rename(temp_path, destination)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def fetch(storage, name, destination):
+    """ Write the WAL file name to destination, from the prefetched files if
+    it was prefetched and from the storage otherwise. Prefetched files
+    older than name are removed.
+    """
+    prefetch_dir = os.path.join(os.path.dirname(destination), PREFETCH_DIRECTORY)
+    if os.path.isdir(prefetch_dir):
+        for prefetched in os.listdir(prefetch_dir):
+            if SEGMENT_NAME.match(prefetched) and prefetched < name:
+                os.unlink(os.path.join(prefetch_dir, prefetched))
+        if os.path.exists(os.path.join(prefetch_dir, name)):
+            os.rename(os.path.join(prefetch_dir, name), destination)
+            return
+    download(storage, name, destination)
+
+
+def prefetch(storage_factory, name, destination, count=WAL_PREFETCH):
+    """ Download the count segments following name next to destination, so
+    the next fetches find them locally. Stop at the first segment not
+    archived yet.
+    """
+    prefetch_dir = os.path.join(os.path.dirname(destination), PREFETCH_DIRECTORY)
+    if not os.path.isdir(prefetch_dir):
+        os.makedirs(prefetch_dir)
+    # A single prefetch runs at once, the next fetches skip theirs meanwhile
+    lock_file = open(os.path.join(prefetch_dir, '.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return
+    names = [segment for segment in next_segments(name, count)
+             if not os.path.exists(os.path.join(prefetch_dir, segment))]
+
+    def prefetch_segment(segment):
+        try:
+            download(storage_factory(), segment, os.path.join(prefetch_dir, segment))
+        except StorageFileNotFound:
+            return False
+        return True
+
+    try:
+        for found in pipeline.parallel_map(prefetch_segment, names, count):
+            if not found:
+                break
+    finally:
+        lock_file.close()
+
+
+def prefetch_in_background(name, destination, count=WAL_PREFETCH):
+    """ Prefetch the segments following name in a detached child process,
+    so PostgreSQL can replay name while they are downloaded.
+    """
+    if not count or not SEGMENT_NAME.match(name) or os.fork():
+        return
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for descriptor in (0, 1, 2):
+            os.dup2(devnull, descriptor)
+        prefetch(BaseStorage.storage_factory, name, destination, count)
+    finally:
+        os._exit(0)
+
+
+###################################
+#  Retention
+###################################
+
+def backup_start_segments(storage, filepaths):
+    """ Return the first WAL segment each base backup needs, by the label of
+    the base backup, from the backup history files among filepaths.
+    """
+    starts = {}
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        if '.backup' not in filename or not SEGMENT_NAME.match(filename.split('.')[0]):
+            continue
+        name = filename[:filename.index('.backup') + len('.backup')]
+        match = BACKUP_LABEL.search(''.join(read_file(storage, name)))
+        if match:
+            starts[match.group(1).strip()] = filename.split('.')[0]
+    return starts
+
+
+def obsolete_files(filepaths, oldest):
+    """ Return the WAL segments and backup history files among filepaths
+    older than the segment oldest, which no base backup kept needs. The
+    timeline history files are always kept.
+    """
+    obsolete = []
+    for filepath in filepaths:
+        name = os.path.basename(filepath).split('.')[0]
+        if SEGMENT_NAME.match(name) and segment_position(name) < segment_position(oldest):
+            obsolete.append(filepath)
+    return obsolete
+
+
+###################################
+#  Recovery
+###################################
+
+def restore_command():
+    """ Return the restore_command PostgreSQL runs to fetch WAL segments,
+    DBBACKUP_WAL_RESTORE_COMMAND or dbbackup_wal_fetch of this project.
+    """
+    if WAL_RESTORE_COMMAND:
+        return WAL_RESTORE_COMMAND
+    command = '%s %s dbbackup_wal_fetch %%f %%p' % (sys.executable, os.path.abspath(sys.argv[0]))
+    if os.environ.get('DJANGO_SETTINGS_MODULE'):
+        command += ' --settings=%s' % os.environ['DJANGO_SETTINGS_MODULE']
+    return command
+
+
+def write_recovery_settings(pgdata, target_time=None):
+    """ Configure the restored data directory pgdata to replay the archived
+    WAL, up to target_time if given, then start as a primary. Written for
+    PostgreSQL 12 and later: a recovery.signal file and settings appended to
+    postgresql.auto.conf.
+    """
+    options = [('restore_command', restore_command())]
+    if target_time:
+        options += [('recovery_target_time', target_time), ('recovery_target_action', 'promote')]
+    with open(os.path.join(pgdata, 'postgresql.auto.conf'), 'a') as conf_file:
+        conf_file.write('# Added by dbbackup_basebackup --restore\n')
+        for option, value in options:
+            conf_file.write("%s = '%s'\n" % (option, value.replace("'", "''")))
+    open(os.path.join(pgdata, 'recovery.signal'), 'w').close()